@@ -39,10 +39,115 @@ def version_info():
         return "swood ??? (dependencies unknown)"
 
 
+def parse_size(size):
+    """Parse a size in bytes like "512M" or "2G" (binary units) for argparse."""
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+    text = size.strip().upper().rstrip("B")
+    multiplier = 1
+    if text and text[-1] in units:
+        multiplier = units[text[-1]]
+        text = text[:-1]
+    try:
+        value = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: '{}'".format(size))
+    if value < 0:
+        raise argparse.ArgumentTypeError("the size can't be negative")
+    return int(value * multiplier)
+
+
+def parse_gain(gain):
+    """Parse a gain for argparse: a positive number, or "velocity"."""
+    if gain.strip().lower() == "velocity":
+        return "velocity"
+    try:
+        value = float(gain)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid gain: '{}'".format(gain))
+    if not 0 < value < float("inf"):
+        raise argparse.ArgumentTypeError("the gain has to be a positive number")
+    return value
+
+
+def add_gain_argument(parser):
+    """Add the option for how loud the output is."""
+    parser.add_argument("--gain", type=parse_gain, default=None, metavar="GAIN",
+                        help="what to multiply the mix by, or 'velocity' to scale notes by the most velocity "
+                             "the MIDI plays at once (how loud swood used to be). By default, the output is "
+                             "normalized so its loudest sample is at 90%% of full scale, which means the whole "
+                             "mix is kept until the end; with a gain, it's written out as it's rendered")
+
+
+def add_font_arguments(parser, cache_mem=None,
+                       cache_mem_help="the most memory to use for cached notes, like 512M or 2G (default: no limit)"):
+    """Add the options for loading samples and rendering notes that every command shares."""
+    parser.add_argument("--cachesize", "-c", type=float,
+                        default=7.5, help="deprecated: set to 0 to turn off caching rendered notes; "
+                                          "any other value does nothing, use --cache-mem to limit the cache")
+    parser.add_argument("--cache-mem", type=parse_size, default=cache_mem, metavar="SIZE",
+                        help=cache_mem_help)
+    parser.add_argument("--binsize", "-b", type=int, default=8192,
+                        help="FFT bin size; lower numbers make it faster but more off-pitch")
+    parser.add_argument("--pitch-method", choices=("fft", "yin"), default="fft",
+                        help="how to detect the pitch of samples; yin is faster and more accurate on tonal samples")
+    parser.add_argument("--fullclip", "-f", action="store_true",
+                        help="always use the full sample without cropping")
+    parser.add_argument("--resampler", choices=("linear", "cubic", "sinc"), default="cubic",
+                        help="how to interpolate when pitch shifting; sinc is the cleanest but slowest")
+
+
+def add_common_arguments(parser, version):
+    """Add the options for loading samples and reporting bugs that every command shares."""
+    parser.add_argument("--memmap", "-m", action="store_true",
+                        help="keep samples on disk instead of in memory (for very long samples)")
+    parser.add_argument("--sample-cache", type=float, default=0, metavar="GB",
+                        help="keep up to this many GB of analyzed samples on disk to load them faster next time")
+    parser.add_argument("--no-pbar", "-p", action="store_false", dest="pbar",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--optout", "-o", action="store_true",
+                        help="opt out of automatic bug reporting (or set the env variable SWOOD_OPTOUT)")
+    parser.add_argument("--version", "-v", action="version", version=version,
+                        help="get the versions of swood and its dependencies")
+
+
+def load_font(args, parser):
+    """Load the sample or soundfont in args.infile, letting its config fill in any options left at their default."""
+    from . import samplecache, soundfont
+
+    if args.sample_cache > 0:
+        cache = samplecache.SampleCache(max_size=int(args.sample_cache * 2 ** 30))
+    else:
+        cache = None
+    config_options = {}
+    font = soundfont.load(args.infile, config_options, binsize=args.binsize, pbar=args.pbar, memmap=args.memmap,
+                          cache=cache, pitch_method=args.pitch_method)
+    # ensure cli args take precedence over config
+    # by only changing arguments currently at their default
+    for name, value in config_options.items():
+        for option in parser._actions:
+            if option.dest == name:
+                if option.default == vars(args)[name]:
+                    vars(args)[name] = value
+                break
+    if args.cachesize not in (0, parser.get_default("cachesize")):
+        print("Warning: cachesize no longer sets how long notes stay cached, only 0 (to turn caching off) "
+              "does anything. Use --cache-mem to limit how much memory cached notes use.", file=sys.stderr)
+    return font
+
+
 def run_cmd(argv=sys.argv[1:]):
+    if argv and argv[0] == "batch":
+        return run_batch(argv[1:])
+    if argv and argv[0] == "serve":
+        return run_serve(argv[1:])
+    if argv and argv[0] == "stitch":
+        return run_stitch(argv[1:])
+
     basename = os.path.basename(sys.argv[0])
     parser = argparse.ArgumentParser(prog="swood" if basename == "swood-script.py" else basename,
                                      description="swood.exe: the automatic ytpmv generator",
+                                     epilog="To render many MIDIs with the same samples, see 'swood batch --help'. "
+                                            "To keep them loaded between renders, see 'swood serve --help'.",
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
 
     parser.add_argument("infile", type=str,
@@ -57,21 +162,36 @@ def run_cmd(argv=sys.argv[1:]):
                         default=0, help="amount to transpose (semitones)")
     parser.add_argument("--speed", "-s", type=float,
                         default=1.0, help="speed multiplier for the MIDI")
-    parser.add_argument("--cachesize", "-c", type=float,
-                        default=7.5, help="how long to save cached notes")
-    parser.add_argument("--binsize", "-b", type=int, default=8192,
-                        help="FFT bin size; lower numbers make it faster but more off-pitch")
-    parser.add_argument("--fullclip", "-f", action="store_true",
-                        help="always use the full sample without cropping")
-    parser.add_argument("--no-pbar", "-p", action="store_false", dest="pbar",
-                        help=argparse.SUPPRESS)
-
+    add_font_arguments(parser)
+    add_gain_argument(parser)
+    parser.add_argument("--bank", action="store_true",
+                        help="pitch-shift every sample up front using all CPU cores (uses more memory)")
+    parser.add_argument("--jobs", "-j", type=int, default=1, metavar="N",
+                        help="pitch-shift samples on N processes while mixing (0 uses every CPU core); "
+                             "MIDIs with under 1000 notes and single-core machines render serially anyway")
+    parser.add_argument("--mix-threads", type=int, default=1, metavar="N",
+                        help="mix notes into the output on N threads (0 uses every CPU core)")
+    parser.add_argument("--live", action="store_true",
+                        help="play live from the MIDI input port named instead of the MIDI ('-' for the default; "
+                             "a MIDI file is played in real time), writing raw PCM to the output")
+    parser.add_argument("--block-frames", type=int, default=512, metavar="N",
+                        help="how many frames of PCM to write at a time with --live")
+    parser.add_argument("--segments", type=int, default=None, metavar="N",
+                        help="render N segments of time on separate processes, then stitch them together")
+    parser.add_argument("--segment-dir", type=str, default=None, metavar="DIR",
+                        help="keep the segments in DIR instead of a temporary directory (it can be shared "
+                             "between computers)")
+    parser.add_argument("--segment-index", type=int, default=None, metavar="I",
+                        help="only render segment I (from 0) into --segment-dir, for 'swood stitch' to join later")
+    parser.add_argument("--server", type=str, default=None, metavar="URL",
+                        help="send the job to a running 'swood serve' (like http://127.0.0.1:7341) instead; "
+                             "options for how samples are loaded and cached (like --memmap, --cache-mem and "
+                             "--jobs) are the server's to set")
+    parser.add_argument("--profile", type=str, default=None, metavar="FILE",
+                        help="save how long each part of the render took to FILE as JSON, and a Chrome trace "
+                             "next to it (like out.trace.json for out.json)")
     version = version_info()
-
-    parser.add_argument("--optout", "-o", action="store_true",
-                        help="opt out of automatic bug reporting (or set the env variable SWOOD_OPTOUT)")
-    parser.add_argument("--version", "-v", action="version", version=version,
-                        help="get the versions of swood and its dependencies")
+    add_common_arguments(parser, version)
 
     args = parser.parse_args(argv)
 
@@ -83,34 +203,245 @@ def run_cmd(argv=sys.argv[1:]):
         sys.stdout = open(os.devnull, "w")
         # args.pbar = False
 
-    from . import complain, midiparse, render, sample, soundfont
+    if args.server is not None:
+        return run_client(args, parser, version)
+
+    from . import complain
 
     with complain.ComplaintFormatter(version=version):
-        if sample.is_wav(args.infile):
-            # load wav file natively
-            sample = soundfont.DefaultFont(
-                sample.Sample(args.infile, args.binsize, pbar=args.pbar))
-        elif "." in args.infile and args.infile.split(".")[-1] in ("swood", "ini", "txt", ".soundfont"):
-            # it's a known soundfont extension, so load it as such
-            config_options = {}
-            sample = soundfont.SoundFont(
-                args.infile, config_options, binsize=args.binsize, pbar=args.pbar)
-            # ensure cli args take precedence over config
-            # by only changing arguments currently at their default
-            for name, value in config_options.items():
-                for option in parser._actions:
-                    if option.dest == name:
-                        if option.default == vars(args)[name]:
-                            vars(args)[name] = value
-                        break
+        if args.profile is None:
+            render_args(args, parser)
+            return
+        from .profiling import Profiler
+        with Profiler() as profiler:
+            renderer = render_args(args, parser)
+        if renderer is not None:
+            profiler.add_counters("note cache", renderer.cache_stats)
+        save_profile(profiler, args.profile)
+
+
+def render_args(args, parser):
+    """Render (or play live) what the main command's arguments ask for, returning the NoteRenderer used.
+
+    Returns None if the segments were each rendered on their own process.
+    """
+    from . import complain, midiparse, render
+
+    if args.segments is not None:
+        from . import segments
+        if args.segments < 1:
+            raise complain.ComplainToUser("There has to be at least one segment.")
+        if args.segment_index is not None:
+            if args.segment_dir is None or not 0 <= args.segment_index < args.segments:
+                raise complain.ComplainToUser(
+                    "--segment-index needs --segment-dir and has to be less than --segments.")
+        else:
+            if not isinstance(args.infile, str):
+                raise complain.ComplainToUser("Segments can't be rendered from stdin, as each process loads the samples itself.")
+            # each process loads the samples and the MIDI (and works out its segment) itself
+            options = {
+                "infile": os.path.abspath(args.infile),
+                "midi": os.path.abspath(args.midi),
+                "transpose": args.transpose,
+                "speed": args.speed,
+                "binsize": args.binsize,
+                "pitch_method": args.pitch_method,
+                "fullclip": args.fullclip,
+                "cachesize": args.cachesize,
+                "resampler": args.resampler,
+                "gain": args.gain,
+                "memmap": args.memmap,
+                "sample_cache": args.sample_cache,
+                "cache_mem": args.cache_mem,
+            }
+            segments.render_segmented(options, args.output, args.segments,
+                                      min(args.segments, os.cpu_count() or 1), args.segment_dir)
+            return None
+
+    sample = load_font(args, parser)
+    renderer = render.NoteRenderer(sample, args.fullclip, args.cachesize,
+                                   resampler=args.resampler, cache_mem=args.cache_mem)
+    if args.live:
+        from . import live
+        if args.gain == "velocity":
+            raise complain.ComplainToUser("--gain velocity needs the whole MIDI ahead of time, so it can't be used live.")
+        live_parser = midiparse.LiveMIDIParser(sample, None if args.midi == "-" else args.midi, args.transpose)
+        if os.path.isfile(args.midi):
+            source = live.ScriptedInput(mido.MidiFile(args.midi), realtime=True)
         else:
-            # use ffmpeg to convert to a supported format
-            sample = soundfont.DefaultFont(
-                sample.Sample(args.infile, args.binsize, pbar=args.pbar))
-        midi = midiparse.MIDIParser(
-            args.midi, sample, args.transpose, args.speed)
-        renderer = render.NoteRenderer(sample, args.fullclip, args.cachesize)
-        renderer.render(midi, args.output, pbar=args.pbar)
+            source = live_parser.open()
+        engine = live.LiveEngine(renderer, live_parser, source, args.output, block_frames=args.block_frames,
+                                 gain=args.gain)
+        engine.prewarm()
+        engine.run()
+        stats = engine.stats
+        print("Wrote {} blocks with {} underruns.".format(stats["blocks"], stats["underruns"]), file=sys.stderr)
+        if stats["latency_mean"] is not None:
+            print("Latency: {:.1f} ms on average, {:.1f} ms at most.".format(
+                stats["latency_mean"] * 1000, stats["latency_max"] * 1000), file=sys.stderr)
+        return renderer
+    midi = midiparse.MIDIParser(
+        args.midi, sample, args.transpose, args.speed)
+    if args.segments is not None:
+        segments.render_to(renderer, midi, args.segment_dir, args.segment_index, args.segments)
+        return renderer
+    if args.bank:
+        renderer.build_bank(midi)
+    jobs = args.jobs or os.cpu_count() or 1
+    if jobs > 1:
+        from .parallel import useful_jobs
+        jobs = useful_jobs(jobs, midi.notecount)
+    renderer.render(midi, args.output, pbar=args.pbar, jobs=jobs, gain=args.gain,
+                    mix_threads=args.mix_threads or os.cpu_count() or 1)
+    return renderer
+
+
+def save_profile(profiler, filename):
+    """Save a profile's summary to filename and its trace next to it, and show the summary."""
+    profiler.write_json(filename)
+    profiler.write_trace(os.path.splitext(filename)[0] + ".trace.json")
+    print(profiler.format_summary(), file=sys.stderr)
+
+
+def run_batch(argv):
+    from . import batch, complain
+
+    basename = os.path.basename(sys.argv[0])
+    parser = argparse.ArgumentParser(prog=("swood" if basename == "swood-script.py" else basename) + " batch",
+                                     description="render many MIDIs with the same samples, loading them only once",
+                                     epilog="Each line of the job list is a MIDI, an output path, and optionally "
+                                            "how many semitones to transpose and a speed multiplier, separated by "
+                                            "spaces (quote paths with spaces in them). Blank lines and lines "
+                                            "starting with # are skipped.",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("infile", type=str,
+                        help="a short wav file to sample as the instrument, or a swood config file")
+    parser.add_argument("joblist", type=str,
+                        help="a text file listing the MIDIs to render and where to save them")
+    parser.add_argument("--transpose", "-t", type=int,
+                        default=0, help="amount to transpose jobs that don't say (semitones)")
+    parser.add_argument("--speed", "-s", type=float,
+                        default=1.0, help="speed multiplier for jobs that don't say")
+    add_font_arguments(parser, batch.DEFAULT_CACHE_MEM,
+                       "the most memory to use for cached notes, like 512M or 2G, split evenly between the "
+                       "workers; the caches are kept between jobs, so they'd grow with every MIDI without one "
+                       "(default: 512M)")
+    add_gain_argument(parser)
+    parser.add_argument("--workers", "-w", type=int, default=1, metavar="N",
+                        help="render N jobs at once (0 uses every CPU core); each keeps its own note cache")
+    version = version_info()
+    add_common_arguments(parser, version)
+
+    args = parser.parse_args(argv)
+
+    with complain.ComplaintFormatter(version=version):
+        jobs = batch.parse_jobs(args.joblist, args.transpose, args.speed)
+        font = load_font(args, parser)
+        failed = batch.run_jobs(font, jobs, workers=args.workers or os.cpu_count() or 1, pbar=args.pbar,
+                                gain=args.gain,
+                                fullclip=args.fullclip, cachesize=args.cachesize, resampler=args.resampler,
+                                cache_mem=args.cache_mem)
+    if failed:
+        sys.exit(1)
+
+
+def run_client(args, parser, version):
+    from . import complain, server
+
+    with complain.ComplaintFormatter(version=version):
+        for path in (args.infile, args.output):
+            if not isinstance(path, str):
+                raise complain.ComplainToUser("The server can't read from stdin or write to stdout.")
+        # these are about how this process loads samples or renders, which the server does its own way
+        unsupported = ["--" + name.replace("_", "-")
+                       for name in ("cache_mem", "memmap", "sample_cache", "jobs", "bank", "live", "block_frames",
+                                    "segments", "segment_dir", "segment_index", "profile")
+                       if getattr(args, name) != parser.get_default(name)]
+        if unsupported:
+            raise complain.ComplainToUser("{} can't be used with --server, since the server loads samples and "
+                                          "caches notes its own way (see 'swood serve --help').".format(
+                                              ", ".join(unsupported)))
+        # the server doesn't run in this directory
+        options = {
+            "infile": os.path.abspath(args.infile),
+            "midi": os.path.abspath(args.midi),
+            "output": os.path.abspath(args.output),
+            "transpose": args.transpose,
+            "speed": args.speed,
+            "binsize": args.binsize,
+            "pitch_method": args.pitch_method,
+            "fullclip": args.fullclip,
+            "cachesize": args.cachesize,
+            "resampler": args.resampler,
+            "gain": args.gain,
+            "mix_threads": args.mix_threads or os.cpu_count() or 1,
+        }
+        status = server.submit(args.server, options, pbar=args.pbar)
+        if status["state"] == "failed":
+            raise complain.ComplainToUser(status["error"])
+        elif status["state"] == "cancelled":
+            print("The render was cancelled.", file=sys.stderr)
+
+
+def run_stitch(argv):
+    basename = os.path.basename(sys.argv[0])
+    parser = argparse.ArgumentParser(prog=("swood" if basename == "swood-script.py" else basename) + " stitch",
+                                     description="join segments rendered with --segment-index into one file")
+    parser.add_argument("segment_dir", type=str,
+                        help="the --segment-dir every segment was rendered into")
+    parser.add_argument("output", type=str,
+                        help="path for the output wav file")
+    add_gain_argument(parser)
+    version = version_info()
+    parser.add_argument("--optout", "-o", action="store_true",
+                        help="opt out of automatic bug reporting (or set the env variable SWOOD_OPTOUT)")
+    args = parser.parse_args(argv)
+
+    if args.output == "-":
+        args.output = sys.stdout.buffer
+
+    from . import complain, segments
+
+    with complain.ComplaintFormatter(version=version):
+        segments.stitch(args.segment_dir, args.output, gain=args.gain)
+
+
+def run_serve(argv):
+    from . import server
+
+    basename = os.path.basename(sys.argv[0])
+    parser = argparse.ArgumentParser(prog=("swood" if basename == "swood-script.py" else basename) + " serve",
+                                     description="keep samples and note caches loaded, rendering jobs sent over "
+                                                 "localhost HTTP",
+                                     epilog="Send jobs to it with 'swood infile midi output --server URL'.")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="the address to listen on (default: only this computer)")
+    parser.add_argument("--allow-remote", action="store_true",
+                        help="let --host be an address other computers can reach; the server has no "
+                             "authentication, so they can read and write any file you can")
+    parser.add_argument("--port", type=int, default=server.DEFAULT_PORT,
+                        help="the port to listen on")
+    parser.add_argument("--workers", "-w", type=int, default=1, metavar="N",
+                        help="render N jobs at once (0 uses every CPU core)")
+    parser.add_argument("--queue-size", type=int, default=16, metavar="N",
+                        help="how many jobs can wait for a worker before new ones are turned away")
+    parser.add_argument("--cache-mem", type=parse_size, default=server.DEFAULT_CACHE_MEM, metavar="SIZE",
+                        help="the most memory all the note caches can use together, like 512M or 2G, split "
+                             "evenly between the workers (default: 512M)")
+    version = version_info()
+    parser.add_argument("--optout", "-o", action="store_true",
+                        help="opt out of automatic bug reporting (or set the env variable SWOOD_OPTOUT)")
+    parser.add_argument("--version", "-v", action="version", version=version,
+                        help="get the versions of swood and its dependencies")
+
+    args = parser.parse_args(argv)
+
+    from . import complain
+
+    with complain.ComplaintFormatter(version=version):
+        renderserver = server.RenderServer(args.workers or os.cpu_count() or 1, args.queue_size, args.cache_mem)
+        server.serve(renderserver, args.host, args.port, args.allow_remote)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+"""Renders many MIDIs with the same samples, keeping the note cache warm between them."""
+
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import shlex
+import sys
+import time
+
+from . import complain, midiparse, render
+
+# the most memory all of the workers' note caches can use between them, by default
+DEFAULT_CACHE_MEM = 512 * 2 ** 20
+
+
+class Job:
+    """One MIDI to render, and where to save it."""
+
+    def __init__(self, midi, output, transpose=0, speed=1.0, line=None):
+        self.midi = midi
+        self.output = output
+        self.transpose = transpose
+        self.speed = speed
+        self.line = line
+
+    def __repr__(self):
+        return "Job(midi={!r}, output={!r}, transpose={}, speed={})".format(
+            self.midi, self.output, self.transpose, self.speed)
+
+
+def parse_jobs(filename, transpose=0, speed=1.0):
+    """Read a job list: a MIDI, an output, and optionally a transposition and speed on each line.
+
+    Blank lines and lines starting with # are skipped. Jobs that don't give a
+    transposition or speed get the ones passed in.
+    """
+    jobs = []
+    try:
+        with (open(filename) if isinstance(filename, str) else filename) as joblist:
+            for line_number, line in enumerate(joblist, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    fields = shlex.split(line)
+                    if not 2 <= len(fields) <= 4:
+                        raise ValueError("expected a MIDI, an output, and optionally a transposition and speed")
+                    job = Job(fields[0], fields[1], transpose, speed, line_number)
+                    if len(fields) > 2:
+                        job.transpose = int(fields[2])
+                    if len(fields) > 3:
+                        job.speed = float(fields[3])
+                except ValueError as e:
+                    raise complain.ComplainToUser(
+                        "Line {} of the job list is invalid: {}".format(line_number, e))
+                jobs.append(job)
+    except IOError:
+        raise complain.ComplainToUser(
+            "Error opening job list '{}'.".format(filename))
+    return jobs
+
+
+def warm_up(font):
+    """Work out every lazy property of a soundfont's samples so threads don't race to."""
+    for instruments in list(font.instruments.values()) + list(font.percussion.values()):
+        for instrument in instruments:
+            if instrument.sample is not None:
+                instrument.sample.scaled
+                instrument.sample.fundamental_freq
+
+
+def run_jobs(font, jobs, workers=1, pbar=True, gain=None, cache_mem=DEFAULT_CACHE_MEM, **renderer_options):
+    """Render every job with a loaded soundfont, returning the jobs that failed.
+
+    Each worker thread has its own NoteRenderer that renders its jobs one after
+    another without clearing its note cache, so pitches shifted for one job
+    are ready for the next. Since the caches are never cleared, they share a
+    cache_mem budget, split evenly between them.
+    Jobs that fail with an error the user can fix (like a missing MIDI) are
+    reported and skipped.
+
+    Args:
+        font: The SoundFont (or DefaultFont) to render with.
+        jobs: A list of Jobs.
+        workers: How many jobs to render at once.
+        pbar: Show a progress bar for each job (only with one worker).
+        gain: The gain to render every job with (see NoteRenderer.render).
+        cache_mem: The most memory all the note caches can use together, or
+        None for no limit.
+        renderer_options: Passed on to each NoteRenderer.
+    """
+    workers = max(1, min(workers, len(jobs)))
+    if cache_mem is not None:
+        cache_mem //= workers
+    warm_up(font)
+    # each renderer is only used by one thread at a time
+    renderers = queue.Queue()
+    for _ in range(workers):
+        renderers.put(render.NoteRenderer(font, cache_mem=cache_mem, **renderer_options))
+    failed = []
+
+    def run(job):
+        renderer = renderers.get()
+        try:
+            start = time.perf_counter()
+            midi = midiparse.MIDIParser(job.midi, font, job.transpose, job.speed)
+            renderer.render(midi, job.output, pbar=pbar and workers == 1, clear_cache=False, gain=gain)
+            print("Rendered '{}' to '{}' in {:.2f} seconds.".format(
+                job.midi, job.output, time.perf_counter() - start), file=sys.stderr)
+        except complain.ComplainToUser as e:
+            print("Error: job on line {} ('{}') failed: {}".format(job.line, job.midi, e), file=sys.stderr)
+            failed.append(job)
+        finally:
+            renderers.put(renderer)
+
+    if workers == 1:
+        for job in jobs:
+            run(job)
+    else:
+        with ThreadPoolExecutor(workers) as pool:
+            # list() so exceptions that aren't the user's fault get raised here
+            list(pool.map(run, jobs))
+
+    if failed:
+        print("{} of {} jobs failed.".format(len(failed), len(jobs)), file=sys.stderr)
+    return failed
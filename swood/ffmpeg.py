@@ -476,12 +476,17 @@ class AudioFile(FFmpegFile):
     def tofile(self, filename, desc=None):
         if self.mode == "w":
             return io.UnsupportedOperation("not readable")
+        if isinstance(filename, str):
+            out, stdout = filename, subprocess.DEVNULL
+        else:
+            # write to an already open file (i.e. a temporary file)
+            out, stdout = "-", filename
         if self._is_buffer:
             self.run_ffmpeg(*self.in_format, "-i", "-", *self.out_format,
-                            *self.map, filename, stdin=self.name, desc=desc)
+                            *self.map, out, stdin=self.name, stdout=stdout, desc=desc)
         else:
             self.run_ffmpeg(*self.in_format, "-i", self.name,
-                            *self.out_format, *self.map, filename, desc=desc)
+                            *self.out_format, *self.map, out, stdout=stdout, desc=desc)
 
     def tobuffer(self, desc=None):
         if self.mode == "w":
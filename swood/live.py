@@ -0,0 +1,405 @@
+"""Plays notes from live MIDI input as they come in, a block at a time."""
+
+from time import perf_counter, sleep
+import threading
+
+from numpy import zeros, empty, full, int32, float32, float64
+
+from .midiparse import Note, note_to_freq
+from .render import MAX_VELOCITY, cut
+from .wavout import mix_into, quantize, write_array
+
+# how many full-velocity notes can play at once before the output clips, by default
+HEADROOM = 4
+
+
+class ScriptedInput:
+    """Stands in for a MIDI input port by playing back messages on a schedule.
+
+    Args:
+        messages: An iterable of mido messages, each with its time set to how
+        many seconds after the last one it comes (like iterating over a
+        mido.MidiFile gives).
+        realtime: Hand out each message once its time comes on the clock, like
+        a real port. Otherwise every message is placed exactly at its time, and
+        the engine runs as fast as it can.
+    """
+
+    def __init__(self, messages, realtime=False):
+        self.realtime = realtime
+        self.messages = []
+        time = 0
+        for message in messages:
+            time += message.time
+            self.messages.append((time, message))
+        self.next = 0
+
+    @property
+    def done(self):
+        """Whether every message has been handed out."""
+        return self.next >= len(self.messages)
+
+    def pending(self, until):
+        """Get every message up to a time (in seconds) as (time, message) pairs.
+
+        The time is None when the message should play right away.
+        """
+        messages = self.messages
+        start = self.next
+        while self.next < len(messages) and messages[self.next][0] <= until:
+            self.next += 1
+        if self.realtime:
+            return [(None, message) for _, message in messages[start:self.next]]
+        return messages[start:self.next]
+
+    def close(self):
+        pass
+
+
+class PortInput:
+    """Reads messages from a mido input port as they come in."""
+
+    def __init__(self, port):
+        self.port = port
+        self.realtime = True
+
+    @property
+    def done(self):
+        return self.port.closed
+
+    def pending(self, until):
+        return [(None, message) for message in self.port.iter_pending()]
+
+    def close(self):
+        self.port.close()
+
+
+class RingBuffer:
+    """A fixed number of preallocated PCM blocks handed from the mixer to the writer.
+
+    The mixer claim()s the next free block, fills it in and commit()s it. The
+    writer take()s the oldest filled block, writes it and release()s it. The
+    mixer waits when every block is full, so it can't get further ahead of the
+    output than the ring is long.
+    """
+
+    def __init__(self, blocks, channels, block_frames, dtype=int32):
+        self.slots = zeros((blocks, channels, block_frames), dtype=dtype)
+        self.stamps = [None] * blocks
+        self.head = 0
+        self.tail = 0
+        self.closed = False
+        self.ready = threading.Condition()
+
+    def claim(self):
+        """Wait for a free block and return it."""
+        with self.ready:
+            self.ready.wait_for(lambda: self.head - self.tail < len(self.slots) or self.closed)
+            return self.slots[self.head % len(self.slots)]
+
+    def commit(self, stamps):
+        """Hand the claimed block to the writer, with when each note in it came in."""
+        with self.ready:
+            self.stamps[self.head % len(self.slots)] = stamps
+            self.head += 1
+            self.ready.notify_all()
+
+    def take(self, timeout=None):
+        """Get the oldest filled block and its stamps, or (None, None) if there isn't one in time."""
+        with self.ready:
+            if not self.ready.wait_for(lambda: self.head > self.tail or self.closed, timeout):
+                return None, None
+            if self.head == self.tail:
+                return None, None
+            idx = self.tail % len(self.slots)
+            return self.slots[idx], self.stamps[idx]
+
+    def release(self):
+        """Free the block take() returned."""
+        with self.ready:
+            self.tail += 1
+            self.ready.notify_all()
+
+    def close(self):
+        """Wake everything up so it can stop."""
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+
+class Voice:
+    """A note that's playing, and how far into it the output is."""
+
+    def __init__(self, note, data, cutoffs, position, gain, volumes):
+        self.note = note
+        self.data = data
+        self.cutoffs = cutoffs
+        # negative until the note starts partway into a block
+        self.position = position
+        self.gain = gain
+        self.volumes = volumes
+
+    @property
+    def finished(self):
+        return self.position >= min(self.data.shape[1], int(self.cutoffs.max()))
+
+
+class LiveEngine:
+    """Mixes notes from live MIDI input into fixed-size blocks of PCM as they're played.
+
+    Each note starts playing the whole pitch-shifted sample as soon as it comes
+    in, and is cut off at the same place render() would cut it off once it
+    stops, so playing a MIDI through a ScriptedInput gives the same output as
+    render_iter() with the same gain. Pitch-shifted samples come from the
+    renderer's note cache, which prewarm() fills ahead of time; a pitch that
+    isn't there yet is shifted on the spot, which holds up the output.
+
+    In realtime mode, a writer thread writes one block every block's worth of
+    time, and the mixer can only get as far ahead of it as the ring buffer is
+    long. If the next block isn't ready when it's due, the writer writes
+    silence instead and counts an underrun. The time from each note coming in
+    to the block it starts in being written is kept in latencies.
+
+    Blocks are written as raw interleaved PCM of dtype. Since they're written
+    before the loudest sample is known, the gain is fixed (by default, so
+    HEADROOM notes at full velocity can play at once without clipping).
+
+    Args:
+        renderer: The NoteRenderer whose settings and note cache to use.
+        parser: The LiveMIDIParser to turn messages into notes with.
+        source: A mido input port, a ScriptedInput, or any iterable of mido
+        messages (which gets wrapped in a ScriptedInput).
+        output: A file or file path to write the PCM to.
+        block_frames: How many frames are in each block.
+        ring_blocks: How many blocks the mixer can get ahead of the writer.
+        gain: What to multiply the mix by when converting it to dtype.
+        realtime: Write blocks in real time. Defaults to whatever source does.
+    """
+
+    def __init__(self, renderer, parser, source, output, block_frames=512, ring_blocks=4, gain=None,
+                 realtime=None, dtype=int32):
+        self.renderer = renderer
+        self.parser = parser
+        if hasattr(source, "iter_pending"):
+            source = PortInput(source)
+        elif not hasattr(source, "pending"):
+            source = ScriptedInput(source)
+        self.source = source
+        self.realtime = source.realtime if realtime is None else realtime
+        self.output = output
+        self.block_frames = block_frames
+        self.channels = renderer.sample.channels
+        self.framerate = renderer.sample.framerate
+        self.dtype = dtype
+        self.gain = 1 / HEADROOM if gain is None else gain
+        self.ring = RingBuffer(ring_blocks, self.channels, block_frames, dtype)
+
+        self.voices = []
+        self.held = {}
+        self.frame = 0
+        self.running = False
+        self._stamps = []
+
+        self.blocks = 0
+        self.notes = 0
+        self.underruns = 0
+        self.cold_pitches = 0
+        self.latencies = []
+
+        self._bus = zeros((self.channels, block_frames), dtype=float32)
+        self._scratch = empty(block_frames, dtype=float64)
+
+    def prewarm(self, notes=range(21, 109), threads=None):
+        """Pitch-shift every instrument each channel starts with to every MIDI note number in notes, plus percussion.
+
+        The pitches are pinned in the note cache so they're never evicted.
+        """
+        parser = self.parser
+        to_bank = []
+        for instrument in set(parser.channel_instruments):
+            for notenum in notes:
+                to_bank.append(Note(pitch=note_to_freq(notenum + parser.transpose), instrument=instrument))
+        for key, instruments in parser.sample.percussion.items():
+            if isinstance(key, int):
+                to_bank.extend(Note(instrument=instrument, percussion=True) for instrument in instruments)
+        self.renderer.bank_notes(to_bank, threads)
+
+    def start(self, note, frame, arrived):
+        """Start playing a note at a frame."""
+        renderer = self.renderer
+        instrument = note.instrument
+        if instrument.sample is None:
+            return
+        pitch = (instrument.sample, renderer.pitch_multiplier(note))
+        if pitch not in renderer.notecache:
+            self.cold_pitches += 1
+        data = renderer.pitched(*pitch)
+        if pitch not in renderer.notecache:
+            # keep it even with caching turned off, since it'll likely be played again
+            renderer.notecache.put_pitch(pitch, data)
+        cutoffs = full(instrument.sample.channels, data.shape[1], dtype=int32)
+        gain = note.volume / MAX_VELOCITY * instrument.volume
+        if instrument.pan == 0.5:
+            volumes = None
+        else:
+            volumes = ((1 - instrument.pan) * 2, instrument.pan * 2)
+        voice = Voice(note, data, cutoffs, self.frame - frame, gain, volumes)
+        self.voices.append(voice)
+        if not (renderer.fullclip or instrument.fullclip):
+            self.held[id(note)] = voice
+        self.notes += 1
+        self._stamps.append(arrived)
+
+    def stop(self, note):
+        """Cut off a note where render() would cut it off, now that its length is known."""
+        voice = self.held.pop(id(note), None)
+        if voice is None:
+            return
+        if note.length < voice.data.shape[1]:
+            voice.cutoffs = cut(voice.data, note.length, note.instrument.sample.channels,
+                                self.renderer.threshold, self.renderer.distance_multiplier)
+
+    def handle(self, time, message, arrived):
+        """Start or stop a note for a message that came in at time (in seconds, or None for right away)."""
+        if time is None:
+            frame = self.frame
+        else:
+            frame = max(self.frame, int(round(time * self.framerate)))
+        event = self.parser.parse(message, frame)
+        if event is not None:
+            kind, note = event
+            if kind == "start":
+                self.start(note, frame, arrived)
+            else:
+                self.stop(note)
+
+    def mix_block(self, out):
+        """Mix the next block of every voice into out (converting it to dtype)."""
+        bus = self._bus
+        bus.fill(0)
+        block_frames = self.block_frames
+        scratch = self._scratch
+        playing = []
+        for voice in self.voices:
+            data = voice.data
+            position = voice.position
+            bus_offset = max(0, -position)
+            offset = max(0, position)
+            for chan in range(self.channels):
+                selectChan = min(chan, data.shape[0])
+                cutoff = min(voice.cutoffs[selectChan], len(data[selectChan]))
+                frames = min(block_frames - bus_offset, cutoff - offset)
+                if frames > 0:
+                    mix_into(bus[chan][bus_offset:bus_offset + frames],
+                             data[selectChan][offset:offset + frames], voice.gain,
+                             None if voice.volumes is None else voice.volumes[selectChan], scratch)
+            voice.position += block_frames
+            if not voice.finished:
+                playing.append(voice)
+            elif id(voice.note) in self.held and voice.position >= data.shape[1]:
+                # it ran out of sample before it was let go
+                del self.held[id(voice.note)]
+        self.voices = playing
+        quantize(bus, self.gain, self.dtype, out=out)
+
+    def _write(self, f, block, stamps):
+        write_array(f, block)
+        now = perf_counter()
+        self.latencies.extend(now - arrived for arrived in stamps)
+        self.blocks += 1
+
+    def _writer(self, f):
+        """Write a block every block's worth of time, writing silence when the mixer falls behind."""
+        period = self.block_frames / self.framerate
+        silence = zeros((self.channels, self.block_frames), dtype=self.dtype)
+        due = None
+        while True:
+            if due is not None:
+                wait = due - perf_counter()
+                if wait > 0:
+                    sleep(wait)
+            # wait as long as it takes for the first block, then never past when each one is due
+            block, stamps = self.ring.take(None if due is None else 0)
+            if block is None:
+                if self.ring.closed:
+                    return
+                self.underruns += 1
+                write_array(f, silence)
+            else:
+                self._write(f, block, stamps)
+                self.ring.release()
+            if due is None:
+                due = perf_counter()
+            due += period
+
+    def run(self):
+        """Play until the source runs out of messages and every note is done (or until stop_running())."""
+        if isinstance(self.output, str):
+            f = open(self.output, "wb")
+        else:
+            f = self.output
+        self.running = True
+        source = self.source
+        start_time = perf_counter()
+        writer = None
+        if self.realtime:
+            writer = threading.Thread(target=self._writer, args=(f,), daemon=True)
+            writer.start()
+        try:
+            while self.running:
+                if source.done:
+                    for note in self.parser.stop_all(self.frame):
+                        self.stop(note)
+                    if not self.voices:
+                        break
+                if self.realtime:
+                    until = perf_counter() - start_time
+                else:
+                    until = (self.frame + self.block_frames) / self.framerate
+                self._stamps = []
+                for time, message in source.pending(until):
+                    self.handle(time, message, perf_counter())
+                out = self.ring.claim()
+                if self.ring.closed:
+                    break
+                self.mix_block(out)
+                self.frame += self.block_frames
+                if writer is None:
+                    self._write(f, out, self._stamps)
+                else:
+                    self.ring.commit(self._stamps)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if writer is not None:
+                # let the writer finish what's been mixed
+                with self.ring.ready:
+                    self.ring.ready.wait_for(lambda: self.ring.tail == self.ring.head or not writer.is_alive())
+                self.ring.close()
+                writer.join()
+            source.close()
+            if isinstance(self.output, str):
+                f.close()
+            else:
+                f.flush()
+            self.running = False
+
+    def stop_running(self):
+        """Stop run() from another thread."""
+        self.running = False
+        self.ring.close()
+
+    @property
+    def stats(self):
+        """How the engine has kept up so far, as a dict (latencies are in seconds)."""
+        latencies = sorted(self.latencies)
+        return {
+            "blocks": self.blocks,
+            "block_seconds": self.block_frames / self.framerate,
+            "notes": self.notes,
+            "underruns": self.underruns,
+            "cold_pitches": self.cold_pitches,
+            "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+            "latency_p99": latencies[int(len(latencies) * 0.99)] if latencies else None,
+            "latency_max": latencies[-1] if latencies else None,
+        }
@@ -8,6 +8,7 @@ import sys
 import mido
 
 from . import complain, soundfont
+from .profiling import timed
 from .sample import Sample
 
 
@@ -53,6 +54,7 @@ class Note:
 class MIDIParser:
     """Parses a MIDI file into a chronological list of notes."""
 
+    @timed("parse midi")
     def __init__(self, filename, sample, transpose=0, speed=1):
         playing = collections.defaultdict(list)
         notes = collections.defaultdict(list)
@@ -140,7 +142,12 @@ class MIDIParser:
 
 
 class LiveMIDIParser:
-    """Parses a MIDI file into a chronological list of notes."""
+    """Turns MIDI messages into notes as they come in, for playing live.
+
+    Notes are handed out as soon as they start, before their length is known.
+    Their pitch is already a frequency, and their length is filled in when
+    they stop.
+    """
 
     def __init__(self, sample, port=None, transpose=0):
         # default to acoustic piano
@@ -150,43 +157,70 @@ class LiveMIDIParser:
         self.sample = sample
         self.port = port
 
-    def callback_factory(self, render_callback):
-        def callback(message):
-            if message.type == "note_on":
-                if message.channel == 10:
-                    try:
-                        instrument = self.sample.percussion[message.note][0]
-                        self.playing[message.note].append(
-                            Note(start=time_samples,
-                                 volume=message.velocity * instrument.volume,
-                                 instrument=instrument,
-                                 percussion=True))
-                        arr, cutoffs = render_callback(message.note)
-                        self.buffer
-                    except KeyError:
-                        print(
-                            "Warning: Percussion note number outside typical 35-81 range: {}".format(message.note), file=sys.stderr)
-            elif message.type == "note_off":
+    def parse(self, message, time):
+        """Handle one message at a time (in samples).
+
+        Returns ("start", note) or ("stop", note) if the message starts or stops
+        a note, and None otherwise.
+        """
+        kind = message.type
+        if kind == "note_on" and message.velocity == 0:
+            # most keyboards send these instead of note_off
+            kind = "note_off"
+        if kind == "note_on":
+            if message.channel == 10:
                 try:
-                    note = playing[message.note].pop()
-                except IndexError:  # the pop will fail if there aren't any matching notes playing
+                    instrument = self.sample.percussion[message.note][0]
+                except KeyError:
                     print(
-                        "Warning: Note end event with no matching begin event @ {}".format(time), file=sys.stderr)
-                if len(playing[message.note]) == 0:
-                    del playing[message.note]
-                # now stop the note in the compositor
-            elif message.type == "program_change":
-                self.channel_instruments[message.channel] = \
-                    self.sample.instruments[message.program + 1][0]
-
-    def eloop(self, render_callback):
-        cb = callback_factory(render_callback)
+                        "Warning: Percussion note number outside typical 35-81 range: {}".format(message.note), file=sys.stderr)
+                    return None
+                note = Note(start=time,
+                            volume=message.velocity * instrument.volume,
+                            instrument=instrument,
+                            percussion=True)
+            else:
+                instrument = self.channel_instruments[message.channel]
+                note = Note(start=time,
+                            volume=message.velocity * instrument.volume,
+                            pitch=note_to_freq(message.note + self.transpose),
+                            instrument=instrument)
+            self.playing[message.note].append(note)
+            return "start", note
+        elif kind == "note_off":
+            try:
+                note = self.playing[message.note].pop()
+            except IndexError:  # the pop will fail if there aren't any matching notes playing
+                print(
+                    "Warning: Note end event with no matching begin event @ {}".format(time), file=sys.stderr)
+                return None
+            finally:
+                if len(self.playing[message.note]) == 0:
+                    del self.playing[message.note]
+            note.length = time - note.start
+            return "stop", note
+        elif kind == "program_change":
+            self.channel_instruments[message.channel] = \
+                self.sample.instruments[message.program + 1][0]
+        return None
+
+    def stop_all(self, time):
+        """Stop every note that's still playing, returning them."""
+        stopped = []
+        for notelist in self.playing.values():
+            for note in notelist:
+                note.length = time - note.start
+                stopped.append(note)
+        self.playing.clear()
+        return stopped
+
+    def open(self):
+        """Open the MIDI input port (a virtual one if the backend can make it)."""
         try:
-            midin = mido.open_input(
-                name=self.port, virtual=True, callback=cb)
-        except IOError:  # couldn't create virtual port
-            midin = mido.open_input(name=self.port, callback=cb)
-        except:
+            return mido.open_input(name=self.port, virtual=True)
+        except Exception:  # couldn't create a virtual port
+            pass
+        try:
+            return mido.open_input(name=self.port)
+        except Exception:
             raise complain.ComplainToUser("Could not find a valid MIDI input")
-
-        midin.close()
@@ -0,0 +1,184 @@
+"""A memory-bounded cache of pitch-shifted samples and the notes cut from them."""
+
+from collections import OrderedDict
+
+
+class PitchEntry:
+    """A sample resampled to one pitch, plus the notes of each length cut from it."""
+
+    def __init__(self, data):
+        self.data = data
+        self.notes = {}
+        self.used = 0
+        self.nbytes = data.nbytes
+
+
+class NoteCache:
+    """Holds rendered notes within a budget of bytes, evicting the least recently used.
+
+    There are two levels: each (sample, pitch multiplier) has one resampled
+    array, and each note length played at that pitch has its cutoffs stored
+    next to it. Notes are evicted along with the pitch they were cut from.
+
+    Eviction starts from the least recently used pitch, but pitches that have
+    been used at least reuse_threshold times since they were last considered
+    get a second chance (with their use count halved), so a pitch played all
+    through a song isn't pushed out by a run of one-off notes. Every pitch
+    can only be given so many second chances before its count runs out, so
+    eviction is O(1) amortized.
+
+    If the order notes will be played in is known ahead of time, next_use can
+    be set to a dict of when each pitch will be used next. Eviction then
+    drops the pitch that will be needed furthest in the future instead
+    (Belady's algorithm), which is optimal but O(number of pitches) per
+    eviction. Pitches that aren't in next_use are never needed again.
+
+    Args:
+        max_bytes: How many bytes of audio to keep at most, or None for no limit.
+        reuse_threshold: How many uses earn a pitch a second chance.
+    """
+
+    def __init__(self, max_bytes=None, reuse_threshold=3):
+        self.max_bytes = max_bytes
+        self.reuse_threshold = reuse_threshold
+        self._entries = OrderedDict()
+        # pitches that are kept no matter what (like the ones from build_bank)
+        self._pinned = {}
+        self.next_use = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry(self, pitch):
+        entry = self._entries.get(pitch)
+        if entry is not None:
+            self._entries.move_to_end(pitch)
+            return entry
+        return self._pinned.get(pitch)
+
+    def get_pitch(self, pitch):
+        """Get the resampled array for a (sample, multiplier), or None if it isn't cached."""
+        entry = self._entry(pitch)
+        if entry is None:
+            return None
+        return entry.data
+
+    def put_pitch(self, pitch, data, pinned=False):
+        """Cache the resampled array for a (sample, multiplier).
+
+        Pinned pitches are never evicted, though they still count towards the
+        budget. Anything else that won't fit in the budget on its own isn't
+        cached at all.
+        """
+        self.discard(pitch)
+        entry = PitchEntry(data)
+        if pinned:
+            self._pinned[pitch] = entry
+        elif self.max_bytes is not None and entry.nbytes > self.max_bytes:
+            return
+        else:
+            self._entries[pitch] = entry
+        self.bytes += entry.nbytes
+        self.evict()
+
+    def get_note(self, pitch, length):
+        """Look up a note cut from a pitch, counting it as a hit or a miss."""
+        entry = self._entry(pitch)
+        note = None if entry is None else entry.notes.get(length)
+        if note is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            entry.used += 1
+            note.used += 1
+        return note
+
+    def put_note(self, pitch, length, note):
+        """Cache a note cut from a pitch, if that pitch is still cached."""
+        entry = self._entry(pitch)
+        if entry is None:
+            return
+        old = entry.notes.get(length)
+        if old is not None:
+            entry.nbytes -= old.cutoffs.nbytes
+            self.bytes -= old.cutoffs.nbytes
+        entry.notes[length] = note
+        entry.used += 1
+        entry.nbytes += note.cutoffs.nbytes
+        self.bytes += note.cutoffs.nbytes
+        self.evict()
+
+    def discard(self, pitch):
+        """Remove a pitch and all of its notes if they're cached."""
+        entry = self._entries.pop(pitch, None)
+        if entry is None:
+            entry = self._pinned.pop(pitch, None)
+        if entry is not None:
+            self.bytes -= entry.nbytes
+
+    def discard_note(self, pitch, length):
+        """Remove one note cut from a pitch, keeping the pitch itself."""
+        entry = self._entries.get(pitch)
+        if entry is None:
+            entry = self._pinned.get(pitch)
+        if entry is not None:
+            note = entry.notes.pop(length, None)
+            if note is not None:
+                entry.nbytes -= note.cutoffs.nbytes
+                self.bytes -= note.cutoffs.nbytes
+
+    def evict(self):
+        """Evict pitches until everything fits in the budget."""
+        if self.max_bytes is None:
+            return
+        entries = self._entries
+        if self.next_use is not None:
+            never = float("inf")
+            next_use = self.next_use
+            while self.bytes > self.max_bytes and entries:
+                pitch = max(entries, key=lambda pitch: next_use.get(pitch, never))
+                self.bytes -= entries.pop(pitch).nbytes
+                self.evictions += 1
+            return
+        while self.bytes > self.max_bytes and entries:
+            pitch, entry = entries.popitem(last=False)
+            if entry.used >= self.reuse_threshold:
+                entry.used //= 2
+                entries[pitch] = entry
+            else:
+                self.bytes -= entry.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        """Remove everything, including pinned pitches."""
+        self._entries.clear()
+        self._pinned.clear()
+        self.bytes = 0
+
+    def __contains__(self, pitch):
+        return pitch in self._entries or pitch in self._pinned
+
+    def __len__(self):
+        return sum(len(entry.notes) for entry in self._entries.values()) + \
+            sum(len(entry.notes) for entry in self._pinned.values())
+
+    @property
+    def pitches(self):
+        """How many pitch-shifted samples are cached."""
+        return len(self._entries) + len(self._pinned)
+
+    @property
+    def stats(self):
+        """How well the cache has worked so far, as a dict."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+            "pitches": self.pitches,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,247 @@
+"""Stretches samples to each pitch on a pool of processes, sharing the audio through shared memory."""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+from collections import OrderedDict, deque
+from multiprocessing import shared_memory
+
+from numpy import ndarray, full, int32
+
+from .render import CachedNote, stretch, stretched_shape, cut
+
+# set in each worker process by _init_worker
+_settings = None
+# samples each worker has attached to, by shared memory block name
+_attached = {}
+# how many pitches to hand out ahead of time for each process
+LOOKAHEAD = 2
+# with fewer notes than this, starting the processes takes longer than they save
+MIN_PARALLEL_NOTES = 1000
+
+
+def useful_jobs(jobs, notecount):
+    """How many of jobs processes are worth starting to render notecount notes (1 means render serially)."""
+    if (os.cpu_count() or 1) == 1 or notecount < MIN_PARALLEL_NOTES:
+        return 1
+    return jobs
+
+
+def _init_worker(settings):
+    global _settings
+    _settings = settings
+
+
+def _render_pitch(task):
+    """Stretch a shared sample to one pitch and find where to cut it off for each note.
+
+    Runs in a worker process. The stretched sample is written into a shared
+    memory block the main process already made, and the cutoffs are returned.
+    """
+    kernel, font_channels, threshold, distance_multiplier = _settings
+    sample_name, sample_shape, sample_dtype, multiplier, out_name, notes = task
+    if sample_name not in _attached:
+        shm = shared_memory.SharedMemory(sample_name)
+        _attached[sample_name] = (shm, ndarray(sample_shape, sample_dtype, buffer=shm.buf))
+    data = _attached[sample_name][1]
+
+    scaled = stretch(data, multiplier, kernel, font_channels)
+    if out_name is not None:
+        shm = shared_memory.SharedMemory(out_name)
+        out = ndarray(scaled.shape, scaled.dtype, buffer=shm.buf)
+        out[...] = scaled
+        del out
+        shm.close()
+
+    cutoffs = []
+    for length, channels, fullclip in notes:
+        if fullclip:
+            cutoffs.append(full(channels, scaled.shape[1], dtype=int32))
+        else:
+            cutoffs.append(cut(scaled, length, channels, threshold, distance_multiplier))
+    return cutoffs
+
+
+class PitchJobs:
+    """Stretches every pitch a MIDI plays on a pool of processes while the main process mixes.
+
+    Every sample is copied into shared memory once so the workers don't each
+    need their own copy, and each worker writes the stretched sample straight
+    into a shared block the main process then reads without copying. Pitches
+    are handed out in the order they're first played, and the renderer calls
+    collect() to wait for one the first time it's needed. The results are
+    exactly the same as rendering the notes one at a time.
+
+    Only a few pitches per process are handed out ahead of time, and with a
+    cache_mem budget, only as many as fit in what the note cache leaves free
+    (but always at least one). Each pitch's block is made just before it's
+    handed out. Stretched pitches go in the note cache like any other, so the
+    budget applies to them too, and a block is freed as soon as the cache
+    lets go of its pitch.
+
+    Args:
+        renderer: The NoteRenderer to put the rendered notes in the cache of.
+        midi: The MIDI that's about to be rendered.
+        plan: The RenderPlan for the MIDI.
+        jobs: How many processes to use.
+        copy: Copy each stretched sample out of shared memory once it's done, so
+        it can stay in the note cache after the render.
+        mix_pending: Called before a block is freed, to mix any notes still
+        queued up that point into it (like the output's mix_pending).
+    """
+
+    def __init__(self, renderer, midi, plan, jobs, copy=False, mix_pending=None):
+        self.renderer = renderer
+        self.copy = copy
+        self.mix_pending = mix_pending
+        self.lookahead = jobs * LOOKAHEAD
+        self.inputs = {}
+        self.blocks = {}
+        self.pending = {}
+        # pitches that were collected and still have a block
+        self.collected = set()
+        # blocks that couldn't be unmapped yet because something pointed into them
+        self.lingering = []
+
+        # the first note with each key decides how it gets cut off
+        firsts = {}
+        index = 0
+        for _, notes in midi.notes:
+            for note in notes:
+                key = plan.keys[index]
+                if key is not None and key not in firsts and key[:2] not in renderer.notecache:
+                    firsts[key] = note
+                index += 1
+        pitches = OrderedDict()
+        for key in firsts:
+            pitches.setdefault(key[:2], []).append(key)
+        # (pitch, keys, how each note is cut off) in the order they're first played
+        self.waiting = deque((pitch, keys, [(firsts[key].length, pitch[0].channels,
+                                             renderer.fullclip or firsts[key].instrument.fullclip)
+                                            for key in keys])
+                             for pitch, keys in pitches.items())
+        self.waiting_pitches = set(pitches)
+
+        settings = (renderer.resampler, renderer.sample.channels,
+                    renderer.threshold, renderer.distance_multiplier)
+        self.pool = ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(settings,))
+        self._submit()
+
+    def _shape(self, pitch):
+        sample, multiplier = pitch
+        return stretched_shape(sample.scaled.shape, multiplier, self.renderer.sample.channels)
+
+    def _submit(self):
+        """Hand out waiting pitches until the lookahead window or the cache budget is full."""
+        cache = self.renderer.notecache
+        while self.waiting and len(self.pending) < self.lookahead:
+            if self.pending and cache.max_bytes is not None:
+                pitch = self.waiting[0][0]
+                channels, length = self._shape(pitch)
+                needed = channels * length * pitch[0].scaled.itemsize
+                in_flight = sum(self.blocks[pitch].size for pitch in self.pending if pitch in self.blocks)
+                if cache.bytes + in_flight + needed > cache.max_bytes:
+                    break
+            self._hand_out()
+
+    def _hand_out(self):
+        """Make a block for the next waiting pitch and give it to the pool."""
+        pitch, keys, notes = self.waiting.popleft()
+        self.waiting_pitches.discard(pitch)
+        sample, multiplier = pitch
+        scaled = sample.scaled
+        shape = self._shape(pitch)
+        if shape == scaled.shape and multiplier == 1.0:
+            # stretch() gives back the sample itself
+            out_name = None
+        else:
+            shm = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1] * scaled.itemsize))
+            self.blocks[pitch] = shm
+            out_name = shm.name
+        task = self._share(sample) + (multiplier, out_name, notes)
+        self.pending[pitch] = (self.pool.submit(_render_pitch, task), keys, shape)
+
+    def _share(self, sample):
+        """Copy a sample into shared memory if it isn't already there."""
+        scaled = sample.scaled
+        if sample not in self.inputs:
+            shm = shared_memory.SharedMemory(create=True, size=max(1, scaled.nbytes))
+            ndarray(scaled.shape, scaled.dtype, buffer=shm.buf)[...] = scaled
+            self.inputs[sample] = shm
+        return self.inputs[sample].name, scaled.shape, scaled.dtype.str
+
+    def __contains__(self, pitch):
+        return pitch in self.pending or pitch in self.waiting_pitches
+
+    def collect(self, pitch):
+        """Wait for a pitch to be stretched, then put it and its notes in the note cache."""
+        while pitch not in self.pending:
+            # the budget held it back, but it's needed now
+            self._hand_out()
+        future, keys, shape = self.pending.pop(pitch)
+        cutoffs = future.result()
+        sample, _ = pitch
+        shm = self.blocks.get(pitch)
+        if shm is None:
+            data = sample.scaled
+        else:
+            # the worker is done with it, so it only has to live as long as it's mapped
+            shm.unlink()
+            self.collected.add(pitch)
+            data = ndarray(shape, sample.scaled.dtype, buffer=shm.buf)
+            if self.copy:
+                data = data.copy()
+                self.release(pitch)
+        cache = self.renderer.notecache
+        cache.put_pitch(pitch, data)
+        for key, note_cutoffs in zip(keys, cutoffs):
+            cache.put_note(pitch, key[2], CachedNote(0, data, note_cutoffs))
+        self.renderer.resamples += 1
+        del data
+        # free the blocks of any pitches the cache let go of to make room
+        for collected in [collected for collected in self.collected if collected not in cache]:
+            self.release(collected)
+        self._submit()
+
+    def release(self, pitch):
+        """Unmap a pitch's shared block once it's out of the note cache."""
+        shm = self.blocks.pop(pitch, None)
+        if shm is not None:
+            self.collected.discard(pitch)
+            if self.mix_pending is not None:
+                self.mix_pending()
+            self.lingering.append(shm)
+        self._close_lingering()
+
+    def _close_lingering(self):
+        """Unmap every released block that nothing points into anymore."""
+        lingering = []
+        for shm in self.lingering:
+            try:
+                shm.close()
+            except BufferError:
+                # something still points into it, so try again later
+                lingering.append(shm)
+        self.lingering = lingering
+
+    def close(self):
+        """Stop the workers and free all the shared memory."""
+        self.waiting.clear()
+        self.waiting_pitches.clear()
+        for future, _, _ in self.pending.values():
+            future.cancel()
+        self.pool.shutdown(wait=True)
+        for pitch in self.pending:
+            if pitch in self.blocks:
+                # collect() never got to unlink these
+                self.blocks[pitch].unlink()
+        self.pending.clear()
+        if self.mix_pending is not None:
+            self.mix_pending()
+        for pitch in list(self.blocks):
+            self.release(pitch)
+        # anything still lingering gets unmapped when the last array pointing into it is gone
+        self.lingering.clear()
+        for shm in self.inputs.values():
+            shm.close()
+            shm.unlink()
+        self.inputs.clear()
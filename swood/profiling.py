@@ -0,0 +1,193 @@
+"""Records how long each phase of loading and rendering takes, for finding out why a render is slow.
+
+Functions that make up a phase are wrapped with timed(), which does nothing
+but check whether a Profiler is running unless one is. Times are inclusive,
+so render_note's time includes the zoom and cut calls inside it.
+
+    with Profiler() as profiler:
+        renderer.render(midi, "out.wav")
+    profiler.add_counters("note cache", renderer.cache_stats)
+    profiler.write_json("profile.json")
+    profiler.write_trace("trace.json")  # open in chrome://tracing or Perfetto
+"""
+
+from functools import wraps
+import threading
+import json
+import time
+import sys
+import os
+
+# the profiler that's recording right now, if any
+_active = None
+# how many calls to keep in the trace before only counting them
+TRACE_LIMIT = 1000000
+
+
+def timed(name):
+    """Decorate a function to record each call to it as part of a phase."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return func(*args, **kwargs)
+            wall = time.perf_counter()
+            cpu = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.record(name, wall, time.perf_counter() - wall, time.thread_time() - cpu)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    """Add to a counter, if a Profiler is running."""
+    profiler = _active
+    if profiler is not None:
+        profiler.counters[name] = profiler.counters.get(name, 0) + amount
+
+
+def peak_rss():
+    """Get the most memory this process has used at once, in bytes (or None if it can't be found)."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS gives bytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class Phase:
+    """How many times a phase ran, and how long it took in total and per call."""
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.longest = 0.0
+        # calls by how many microseconds they took, in powers of two
+        self.histogram = {}
+
+    def add(self, wall, cpu):
+        self.calls += 1
+        self.wall += wall
+        self.cpu += cpu
+        self.longest = max(self.longest, wall)
+        bucket = max(0, int(wall * 1e6)).bit_length()
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    @property
+    def summary(self):
+        return {
+            "calls": self.calls,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "mean": self.wall / self.calls if self.calls else 0.0,
+            "longest": self.longest,
+            # "under 2**k us": calls, only for buckets that have any
+            "histogram": {"<{}us".format(2 ** bucket): calls
+                          for bucket, calls in sorted(self.histogram.items())},
+        }
+
+
+class Profiler:
+    """Records every timed() phase while it's running (as a context manager, or between start() and stop())."""
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self.groups = {}
+        self.events = []
+        self.dropped = 0
+        self.started = None
+        self.wall = 0.0
+        self.cpu = 0.0
+        self._previous = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        global _active
+        self._previous = _active
+        _active = self
+        self.started = time.perf_counter()
+        self._cpu_start = time.process_time()
+        return self
+
+    def stop(self):
+        global _active
+        _active = self._previous
+        self.wall += time.perf_counter() - self.started
+        self.cpu += time.process_time() - self._cpu_start
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def record(self, name, start, wall, cpu):
+        """Record one call that was part of a phase."""
+        with self._lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = Phase()
+            phase.add(wall, cpu)
+            if len(self.events) < TRACE_LIMIT:
+                self.events.append((name, start, wall, threading.get_ident()))
+            else:
+                self.dropped += 1
+
+    def add_counters(self, group, counters):
+        """Keep a dict of counters (like NoteRenderer.cache_stats) to put in the summary."""
+        self.groups[group] = dict(counters)
+
+    @property
+    def summary(self):
+        """Everything that was recorded, as a dict."""
+        return {
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "peak_rss": peak_rss(),
+            "phases": {name: phase.summary for name, phase in
+                       sorted(self.phases.items(), key=lambda item: -item[1].wall)},
+            "counters": dict(self.counters, **self.groups),
+            "dropped_events": self.dropped,
+        }
+
+    def format_summary(self):
+        """Describe where the time went in a table for the terminal."""
+        lines = ["{:<16} {:>9} {:>10} {:>10} {:>11}".format("phase", "calls", "wall (s)", "cpu (s)", "mean (ms)")]
+        for name, phase in self.summary["phases"].items():
+            lines.append("{:<16} {:>9} {:>10.3f} {:>10.3f} {:>11.3f}".format(
+                name, phase["calls"], phase["wall"], phase["cpu"], phase["mean"] * 1000))
+        lines.append("{:<16} {:>9} {:>10.3f} {:>10.3f}".format("total", "", self.wall, self.cpu))
+        for name, value in self.counters.items():
+            lines.append("{}: {}".format(name, value))
+        for group, counters in self.groups.items():
+            lines.append("{}: {}".format(group, ", ".join(
+                "{} {}".format(name, round(value, 3) if isinstance(value, float) else value)
+                for name, value in counters.items())))
+        rss = peak_rss()
+        if rss is not None:
+            lines.append("peak memory: {:.1f} MB".format(rss / 2 ** 20))
+        return "\n".join(lines)
+
+    def write_json(self, filename):
+        """Save the summary as JSON."""
+        with open(filename, "w") as f:
+            json.dump(self.summary, f, indent=2)
+
+    def write_trace(self, filename):
+        """Save every recorded call in Chrome's trace event format (for chrome://tracing or Perfetto)."""
+        pid = os.getpid()
+        origin = self.started or 0.0
+        events = [{"name": name, "ph": "X", "pid": pid, "tid": tid,
+                   "ts": (start - origin) * 1e6, "dur": wall * 1e6}
+                  for name, start, wall, tid in self.events]
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                       "otherData": {"dropped_events": self.dropped}}, f)
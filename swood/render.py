@@ -1,20 +1,100 @@
 """Renders music by pitch bending samples according to a MIDI."""
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import tempfile
-import math
+import sys
 import os
 
-from numpy import zeros, full, asarray, resize, int32, int64
-from PIL import Image
+from numpy import zeros, full, repeat, abs as np_abs, arange, floor, argmax, int32
 from tqdm import tqdm
 
 from . import wavout, ffmpeg
+from .notecache import NoteCache
+from .profiling import timed
+from .resample import resample
 
 from .__init__ import patch_tqdm
 
 patch_tqdm(tqdm)
 
+# notes are mixed at their velocity out of this (the output is normalized when it's saved)
+MAX_VELOCITY = 127
+
+
+def velocity_gain(midi):
+    """Get the gain swood used to scale every render by: the most velocity the MIDI ever plays at once is full scale.
+
+    It can never clip without panning, but quiet MIDIs come out quiet.
+    """
+    return MAX_VELOCITY / midi.maxvolume if midi.maxvolume else 1.0
+
+
+def find_cutoffs(note_ending, distance_multiplier):
+    """Find the best place to cut off each channel of the end of a note.
+
+    Each sample is scored by how loud it is plus how far it is from the start
+    (times distance_multiplier), and the lowest score wins. This gives exactly
+    the same results as scoring one sample at a time while keeping the best
+    score so far in an int64, which is how it used to be done: every score is
+    compared against the truncated best score, so ties can go to a later
+    sample when the best score is a negative fraction.
+    """
+    channels, length = note_ending.shape
+    if length == 0:
+        return zeros(channels, dtype=int32)
+    scores = np_abs(note_ending) + arange(length) * distance_multiplier
+    # a score beats an integer best score iff its floor is lower
+    floored = floor(scores)
+    ties = floored == floored.min(axis=1)[:, None]
+    # negative fractions truncate upwards, so an equal floor still wins after them
+    keeps_ties = (scores < 0) & (scores != floored)
+    stops = ties & ~keeps_ties
+    cutoffs = argmax(stops, axis=1)
+    for channel in (~stops.any(axis=1)).nonzero()[0]:
+        # every tie let the next one through, so the last one won
+        cutoffs[channel] = length - 1 - argmax(ties[channel, ::-1])
+    return cutoffs
+
+
+def stretch(data, multiplier, kernel="cubic", channels=1):
+    """Scale a (channels, n) sound clip by a multiplier, playing mono clips on every channel."""
+    if multiplier != 1.0:
+        data = resample(data, int(round(data.shape[1] * multiplier)), kernel)
+    if data.shape[0] < channels:
+        # play mono samples on every channel
+        data = repeat(data, channels, axis=0)
+    return data
+
+
+def stretched_shape(shape, multiplier, channels=1):
+    """Get the shape stretch() will return for an array of the given shape."""
+    rows, length = shape
+    if multiplier != 1.0:
+        length = int(round(length * multiplier))
+    if rows < channels:
+        rows *= channels
+    return rows, length
+
+
+@timed("cutoff search")
+def cut(scaled, length, channels, threshold, distance_multiplier):
+    """Find where to cut off each channel of a stretched sample to play it for length samples."""
+    # get the area on the end of the clip that it's ok to cut off at
+    if scaled.shape[1] > length:
+        note_ending = scaled[:, length:length + threshold]
+    else:
+        distance_multiplier = -distance_multiplier
+        start = min(0, length - threshold)
+        note_ending = scaled[start:]
+
+    # find the closest zero crossing within the threshold & cut off there
+    # removes "clicking" sounds from the audio suddenly cutting out
+    cutoffs = zeros(channels, dtype=int32)
+    cutoffs[:note_ending.shape[0]] = find_cutoffs(note_ending, distance_multiplier)
+    cutoffs += length
+    return cutoffs
+
 
 class CachedNote:
     """Holds pre-rendered versions of notes, tracking # of uses."""
@@ -29,6 +109,103 @@ class CachedNote:
         return len(self.data)
 
 
+class RenderPlan:
+    """Works out what a MIDI will need from the note cache before rendering it.
+
+    MIDIParser sorts every note ahead of time, so the renderer knows exactly
+    which notes and pitches are coming up. The plan counts how many times each
+    one is played and when, so the renderer can free them right after they're
+    played for the last time and evict whichever one is needed furthest in the
+    future when it runs out of room.
+
+    Attributes:
+        keys: The note_key for each note, in the order they're played.
+        uses: How many plays of each note key are left.
+        pitch_uses: When each (sample, multiplier) is played next, as a list of
+        note indices (the first is the next one).
+        next_use: When each pitch is played next, for NoteCache.next_use.
+        peak_bytes: The most memory the note cache will need at once if it has
+        no budget and notes are freed after their last use.
+    """
+
+    def __init__(self, renderer, midi):
+        self.keys = []
+        self.uses = {}
+        self.pitch_uses = {}
+        for _, notes in midi.notes:
+            for note in notes:
+                key = renderer.note_key(note)
+                if key is not None:
+                    self.uses[key] = self.uses.get(key, 0) + 1
+                    self.pitch_uses.setdefault(key[:2], []).append(len(self.keys))
+                self.keys.append(key)
+        for indices in self.pitch_uses.values():
+            # so the next use can be popped off the end
+            indices.reverse()
+        self.next_use = {pitch: indices[-1] for pitch, indices in self.pitch_uses.items()}
+        self.peak_bytes = self.predict_peak(renderer)
+
+    def predict_peak(self, renderer):
+        """Walk through the notes, adding up what the cache holds after each one."""
+        cache = renderer.notecache
+        resident = cache.bytes
+        peak = resident
+        note_uses = dict(self.uses)
+        pitch_uses = {pitch: len(indices) for pitch, indices in self.pitch_uses.items()}
+        for key in self.keys:
+            if key is None:
+                continue
+            pitch = key[:2]
+            sample, multiplier = pitch
+            if note_uses[key] == self.uses[key]:
+                # the cutoffs for each channel
+                resident += sample.channels * 4
+            if pitch_uses[pitch] == len(self.pitch_uses[pitch]) and pitch not in cache:
+                resident += self.pitch_bytes(renderer, sample, multiplier)
+            peak = max(peak, resident)
+            note_uses[key] -= 1
+            if note_uses[key] == 0:
+                resident -= sample.channels * 4
+            pitch_uses[pitch] -= 1
+            if pitch_uses[pitch] == 0 and pitch not in cache:
+                resident -= self.pitch_bytes(renderer, sample, multiplier)
+        return peak
+
+    def pitch_bytes(self, renderer, sample, multiplier):
+        """How big a sample will be once zoom() stretches it."""
+        scaled = sample.scaled
+        channels, length = stretched_shape(scaled.shape, multiplier, renderer.sample.channels)
+        return channels * length * scaled.itemsize
+
+    def played(self, index):
+        """Mark a note as played, returning whether its note key and its pitch are still needed."""
+        key = self.keys[index]
+        pitch = key[:2]
+        self.uses[key] -= 1
+        indices = self.pitch_uses[pitch]
+        indices.pop()
+        if indices:
+            self.next_use[pitch] = indices[-1]
+        else:
+            del self.next_use[pitch]
+        return self.uses[key] > 0, len(indices) > 0
+
+
+class MIDISegment:
+    """The notes of a MIDI that are heard during part of the output.
+
+    It has everything a MIDIParser has that rendering uses, so it can be
+    rendered like one.
+    """
+
+    def __init__(self, midi, notes):
+        self.notes = notes
+        self.notecount = sum(len(notelist) for _, notelist in notes)
+        self.length = midi.length
+        self.maxpitch = midi.maxpitch
+        self.maxvolume = midi.maxvolume
+
+
 class FileSaveType(Enum):
     """Enum for selecting where to render to.
 
@@ -47,28 +224,122 @@ class FileSaveType(Enum):
 class NoteRenderer:
     """Renders a WAV file from a MIDI by pitch bending the samples."""
 
-    def __init__(self, sample, fullclip=False, cachesize=7.5, threshold=0.075):
+    def __init__(self, sample, fullclip=False, cachesize=7.5, threshold=0.075, resampler="cubic",
+                 cache_mem=None):
         if threshold < 0:
             return ValueError("The threshold must be a positive number.")
         self.sample = sample
         self.fullclip = fullclip
+        self.resampler = resampler
 
+        # only whether this is 0 matters now; cache_mem is what limits the cache
         self.cachesize = cachesize * sample.framerate
         self.threshold = int(threshold * sample.framerate)
 
         self.distance_multiplier = (2**32 - 1) / self.threshold * 0.5
 
-        self.notecache = {}
+        # holds each sample resampled to each pitch it's played at, and where
+        # to cut those off for each note length
+        self.notecache = NoteCache(cache_mem)
+        self.resamples = 0
+
+    @timed("zoom")
+    def zoom(self, data, multiplier):
+        """Scales the sound clip (a (channels, n) array) by the given multiplier."""
+        return stretch(data, multiplier, self.resampler, self.sample.channels)
 
-    def zoom(self, img, multiplier):
-        """Scales the sound clip (in PIL Image form) by the given multiplier."""
-        if multiplier == 1.0:
-            return asarray(img, dtype=int32)
+    def pitch_multiplier(self, note):
+        """Get how much a note's sample has to be stretched to play at its pitch."""
+        if note.instrument.noscale:
+            return 1.0
         else:
-            return asarray(img.resize((int(round(img.size[0] * multiplier)),
-                                       self.sample.channels),
-                                      resample=Image.BICUBIC), dtype=int32)
+            return note.instrument.sample.fundamental_freq / note.pitch
+
+    def build_bank(self, midi, threads=None):
+        """Resample every instrument ahead of time for each pitch it plays in a MIDI.
 
+        The resampling is spread over a pool of threads (one per core by default;
+        NumPy releases the GIL while resampling). Afterwards render_note only has
+        to look up the pitch-shifted sample and find where to cut it off.
+        """
+        self.bank_notes((note for _, notes in midi.notes for note in notes), threads)
+
+    def bank_notes(self, notes, threads=None):
+        """Resample ahead of time for each pitch in an iterable of notes, like build_bank does for a MIDI."""
+        needed = set()
+        for note in notes:
+            if note.instrument.sample is not None:
+                # this also runs the FFT for each sample up front
+                needed.add((note.instrument.sample, self.pitch_multiplier(note)))
+        needed = {key for key in needed if key not in self.notecache}
+        for sample, _ in needed:
+            # create the lazy properties now so the threads don't race to
+            sample.scaled
+
+        def stretch(key):
+            return self.zoom(key[0].scaled, key[1])
+
+        needed = list(needed)
+        with ThreadPoolExecutor(threads or os.cpu_count() or 1) as pool:
+            for key, scaled in zip(needed, pool.map(stretch, needed)):
+                # keep these around for the whole render, even between uses
+                self.notecache.put_pitch(key, scaled, pinned=True)
+        self.resamples += len(needed)
+
+    def pitched(self, sample, multiplier):
+        """Get a sample stretched by the multiplier, only resampling it the first time.
+
+        While caching is on, the stretched sample is kept in the note cache so
+        notes of any length at the same pitch can share it.
+        """
+        key = (sample, multiplier)
+        scaled = self.notecache.get_pitch(key)
+        if scaled is None:
+            scaled = self.zoom(sample.scaled, multiplier)
+            self.resamples += 1
+            if self.cachesize > 0:
+                self.notecache.put_pitch(key, scaled)
+        return scaled
+
+    def note_key(self, note):
+        """Get a cache key for everything that affects how a note sounds.
+
+        That's the sample, how much it's stretched, and the length of the note,
+        but only if the note is short enough to cut the sample off. Where the
+        note starts and how loud it is are applied when it's mixed in, so they
+        aren't part of the key. Returns None if the note has no sample to play.
+        """
+        sample = note.instrument.sample
+        if sample is None:
+            return None
+        multiplier = self.pitch_multiplier(note)
+        if self.fullclip or note.instrument.fullclip:
+            return (sample, multiplier, None)
+        _, scaled_length = stretched_shape(sample.scaled.shape, multiplier)
+        if note.length >= scaled_length:
+            # the whole sample gets played no matter how long the note is
+            return (sample, multiplier, None)
+        return (sample, multiplier, note.length)
+
+    def note_span(self, note):
+        """Get the fewest and the most frames a note can play for, without rendering it."""
+        sample = note.instrument.sample
+        if sample is None:
+            return 0, 0
+        _, scaled_length = stretched_shape(sample.scaled.shape, self.pitch_multiplier(note))
+        if self.fullclip or note.instrument.fullclip:
+            return scaled_length, scaled_length
+        # cut() looks for where to stop within threshold frames of the end of the note
+        return min(note.length, scaled_length), min(note.length + self.threshold, scaled_length)
+
+    @property
+    def cache_stats(self):
+        """How well the note cache has worked so far, as a dict."""
+        stats = self.notecache.stats
+        stats["resamples"] = self.resamples
+        return stats
+
+    @timed("render_note")
     def render_note(self, note):
         """Render a single note and return an array (with optional cutoffs)."""
         instrument = note.instrument
@@ -76,42 +347,41 @@ class NoteRenderer:
         if instrument.sample is None:
             return None, None
 
-        if instrument.noscale:
-            scaled = self.zoom(instrument.sample.img, 1.0)
-        else:
-            scaled = self.zoom(instrument.sample.img,
-                               instrument.sample.fundamental_freq / note.pitch)
+        scaled = self.pitched(instrument.sample, self.pitch_multiplier(note))
         if self.fullclip or instrument.fullclip:
             return scaled, full(instrument.sample.channels, scaled.shape[1], dtype=int32)
+        return scaled, cut(scaled, note.length, instrument.sample.channels,
+                           self.threshold, self.distance_multiplier)
 
-        # cache variables for faster lookups
-        # see https://stackoverflow.com/q/37202463
-        length = note.length
-        channels = instrument.sample.channels
+    def output_length(self, midi):
+        """Work out exactly how many frames long the output of a MIDI is, up to the end of the last note.
 
-        # get the area on the end of the clip that it's ok to cut off at
-        if scaled.shape[1] > length:
-            distance_multiplier = self.distance_multiplier
-            note_ending = scaled[:, length:length + self.threshold]
-        else:
-            distance_multiplier = -self.distance_multiplier
-            start = min(0, length - self.threshold)
-            note_ending = scaled[start:]
-
-        # find the closest zero crossing within the threshold & cut off there
-        # removes "clicking" sounds from the audio suddenly cutting out
-        cutoffs = zeros(channels, dtype=int32)
-        cutoff_scores = full(channels, 2**63 - 1, dtype=int64)
-        for channel, audio in enumerate(note_ending):
-            for distance, val in enumerate(audio):
-                score = abs(val) + (distance * distance_multiplier)
-                if score < cutoff_scores[channel]:
-                    cutoff_scores[channel] = score
-                    cutoffs[channel] = distance
-        cutoffs += length
-        return scaled, cutoffs
-
-    def render(self, midi, filename=None, pbar=False, savetype=FileSaveType.SMART_CACHING, clear_cache=True):
+        How long each note plays is known to within the threshold without
+        rendering it (see note_span), so only the few notes that might be the
+        last to end get rendered to find where they're cut off. Their
+        pitch-shifted samples stay in the note cache for the render.
+        """
+        length = 0
+        unsure = []
+        for time, notes in midi.notes:
+            for note in notes:
+                shortest, longest = self.note_span(note)
+                length = max(length, time + shortest)
+                if longest > shortest:
+                    unsure.append((time + longest, time, note))
+        unsure.sort(key=lambda end: end[0], reverse=True)
+        for longest, time, note in unsure:
+            if longest <= length:
+                # none of the rest can end any later
+                break
+            data, cutoffs = self.render_note(note)
+            played = max(min(cutoffs[min(chan, data.shape[0])], data.shape[1])
+                         for chan in range(self.sample.channels))
+            length = max(length, time + int(played))
+        return length
+
+    def render(self, midi, filename=None, pbar=False, savetype=FileSaveType.SMART_CACHING, clear_cache=True,
+               jobs=1, mix_threads=1, gain=None, progress=None):
         """Renders from a MIDIParser to an array or WAV file using Samples.
 
         Args:
@@ -124,18 +394,27 @@ class NoteRenderer:
             clear_cache: Remove all notes from the temporary cache after rendering
             the MIDI. It's recommended to disable this if you're rendering many MIDIs
             and have memory to spare. Defaults to True.
+            jobs: How many processes to stretch samples with. With more than one,
+            each pitch is stretched on a worker process ahead of when it's
+            needed while this one mixes. Defaults to 1.
+            mix_threads: How many threads to mix notes into the output with. Each
+            thread mixes a different slab of time. Defaults to 1.
+            gain: What to multiply the mix by when converting it to integers, or
+            "velocity" for velocity_gain(midi). By default, the loudest sample is
+            brought to wavout.PEAK_LEVEL, which means the whole mix has to be
+            held (or spooled to disk) before anything is written. With a gain,
+            it's written as it's mixed.
+            progress: A function to call with how many notes have been rendered
+            so far, every time notes start. It can raise an exception to stop
+            rendering partway through.
         """
 
         if savetype != FileSaveType.ARRAY_IN_MEM and filename is None:
             return ValueError("When not outputting to an array in memory, you need to specify a filename.")
 
-        if self.fullclip:
-            # leave a small buffer at the end with space for one more sample
-            output_length = midi.length + \
-                int(math.ceil(midi.maxpitch * len(self.sample)))
-        else:
-            # it has to cut off sounds at the threshold anyway
-            output_length = midi.length + self.threshold
+        output_length = self.output_length(midi)
+        if gain == "velocity":
+            gain = velocity_gain(midi)
 
         if savetype == FileSaveType.ARRAY_IN_MEM or (isinstance(filename, str) and filename.endswith(".wav")):
             wav_filename = filename
@@ -144,15 +423,92 @@ class NoteRenderer:
 
         if savetype == FileSaveType.SMART_CACHING:
             output = wavout.CachedWavFile(output_length, wav_filename,
-                                          self.sample.framerate, self.sample.channels)
+                                          self.sample.framerate, self.sample.channels,
+                                          threads=mix_threads, gain=gain)
         else:
             output = wavout.UncachedWavFile(output_length, wav_filename,
-                                            self.sample.framerate, self.sample.channels)
+                                            self.sample.framerate, self.sample.channels,
+                                            threads=mix_threads, gain=gain)
 
         if isinstance(wav_filename, ffmpeg.AudioFile):
             output._auto_close = True
 
+        for done in self._mix(midi, output, pbar, clear_cache, jobs):
+            if progress is not None:
+                progress(done)
+
+        if savetype == FileSaveType.ARRAY_IN_MEM:
+            return output.result()
+        else:
+            output.save()
+
+    def render_iter(self, midi, block_frames=32768, pbar=False, clear_cache=True, jobs=1, mix_threads=1,
+                    gain=None):
+        """Renders from a MIDIParser a block at a time, yielding each one as soon as it's finished.
+
+        A block is finished once the notes left to play all start after it, so
+        only the blocks that are still being mixed are kept in memory. Every
+        block is a (channels, block_frames) int32 array except the last, which
+        is cut short at the end of the output. Joined together, the blocks are
+        the same as render() to an array with the same gain.
+
+        Since blocks are handed out before the loudest sample is known, they
+        can't be normalized like render() does. By default, they're scaled by
+        velocity_gain(midi) instead.
+
+        Args:
+            midi: The (pre-parsed) MIDI file to render.
+            block_frames: How many frames long each block is.
+            gain: What to multiply the mix by when converting it to integers, or
+            "velocity" (the default).
+            The other arguments are the same as for render().
+        """
+        if gain is None or gain == "velocity":
+            gain = velocity_gain(midi)
+        output = wavout.BlockStream(self.output_length(midi), self.sample.framerate, self.sample.channels,
+                                    chunksize=block_frames, threads=mix_threads, gain=gain)
+        mixing = self._mix(midi, output, pbar, clear_cache, jobs)
+        try:
+            for _ in mixing:
+                yield from output.blocks()
+        finally:
+            # stop the workers and clear the cache even if the caller stops early
+            mixing.close()
+        output.save()
+        yield from output.blocks()
+
+    def segment(self, midi, start, stop):
+        """Get the notes of a MIDI that can be heard from frame start to frame stop of the output."""
+        notes = []
+        for time, notelist in midi.notes:
+            if time >= stop:
+                break
+            heard = [note for note in notelist if time + self.note_span(note)[1] > start]
+            if heard:
+                notes.append((time, heard))
+        return MIDISegment(midi, notes)
+
+    def render_segment(self, midi, start, stop, clear_cache=True, jobs=1):
+        """Render frames start to stop of the output as a float32 array, before the output gain.
+
+        Only the notes that can be heard in the segment are rendered. Joining
+        the segments of the whole output back together gives exactly the same
+        mix render() makes, and the loudest sample in all of them decides the
+        gain (see wavout.output_gain).
+        """
+        output = wavout.SegmentWavFile(start, stop - start, self.sample.framerate, self.sample.channels)
+        for _ in self._mix(self.segment(midi, start, stop), output, False, clear_cache, jobs):
+            pass
+        return output.bus
+
+    def _mix(self, midi, output, pbar, clear_cache, jobs):
+        """Render and mix in every note of a MIDI, yielding how many are done each time notes start."""
+        # work out what the cache will need before starting
+        plan = self.plan = RenderPlan(self, midi)
         if pbar:
+            print("The note cache will use up to {:.1f} MB.".format(
+                min(plan.peak_bytes, self.notecache.max_bytes or plan.peak_bytes) / 2 ** 20),
+                file=sys.stderr)
             bar = tqdm(total=midi.notecount, dynamic_ncols=True, desc="Rendering",
                        bar_format="{l_bar}{bar}| ETA: {remaining}")
             update = bar.update
@@ -160,57 +516,72 @@ class NoteRenderer:
         # "inlining" these variables can speed up the lookup, making it faster
         # see https://stackoverflow.com/questions/37202463
         caching = self.cachesize > 0
-        add_data = output.add_data
-        maxvolume = midi.maxvolume
-        cachesize = self.cachesize
+        add_voice = output.add_voice
 
+        notecache = self.notecache
+        keys = plan.keys
+        played = plan.played
         if caching:
-            tick = 8
-            notecache = self.notecache
-
-        for time, notes in midi.notes:
-            for note in notes:
-                if note in notecache:
-                    rendered_note = notecache[note]
-                    rendered_note.used += 1  # increment the used counter each time for the "GC" below
-                else:
-                    rendered_note = CachedNote(
-                        time, *self.render_note(note))
-                    notecache[note] = rendered_note
-                if rendered_note.data is not None and rendered_note.data.shape[0] != 0:
-                    if note.instrument.pan == 0.5:
-                        add_data(time, rendered_note.data *
-                                 (note.volume / midi.maxvolume *
-                                     note.instrument.volume),
-                                 rendered_note.cutoffs)
+            notecache.next_use = plan.next_use
+
+        if jobs > 1:
+            from .parallel import PitchJobs
+            # queued notes can point into the shared blocks, so they're mixed before one is freed
+            pending = PitchJobs(self, midi, plan, jobs, copy=not clear_cache, mix_pending=output.mix_pending)
+            # the workers fill the cache even if it's turned off
+            caching = True
+        else:
+            pending = ()
+
+        index = 0
+        try:
+            for time, notes in midi.notes:
+                for note in notes:
+                    key = keys[index]
+                    if key is None:
+                        # the instrument has no sample, so there's nothing to play
+                        rendered_note = None
                     else:
-                        add_data(time, rendered_note.data *
-                                 (note.volume / midi.maxvolume *
-                                     note.instrument.volume),
-                                 rendered_note.cutoffs,
-                                 ((1 - note.instrument.pan) * 2, note.instrument.pan * 2))
-                if pbar:
-                    update()
-
-            if caching:
-                # cache "garbage collection":
-                # if a CachedNote is more than <cachesize> seconds old and not
-                # used >2 times it removes it from the cache to save
-                # mem(e)ory
-                tick += 1
-                if tick == 15:
-                    tick = 0
-                    for k in list(notecache.keys()):
-                        if time - notecache[k].length > cachesize and notecache[k].used < 3:
-                            del notecache[k]
+                        pitch, length = key[:2], key[2]
+                        if pitch in pending:
+                            pending.collect(pitch)
+                        rendered_note = notecache.get_note(pitch, length)
+                        if rendered_note is None:
+                            rendered_note = CachedNote(
+                                time, *self.render_note(note))
+                            if caching:
+                                notecache.put_note(pitch, length, rendered_note)
+                    if rendered_note is not None and rendered_note.data.shape[0] != 0:
+                        # the cached note is scaled as it's mixed in, not copied
+                        if note.instrument.pan == 0.5:
+                            add_voice(time, rendered_note.data, rendered_note.cutoffs,
+                                      note.volume / MAX_VELOCITY * note.instrument.volume)
+                        else:
+                            add_voice(time, rendered_note.data, rendered_note.cutoffs,
+                                      note.volume / MAX_VELOCITY * note.instrument.volume,
+                                      ((1 - note.instrument.pan) * 2, note.instrument.pan * 2))
+                    if key is not None and caching:
+                        note_needed, pitch_needed = played(index)
+                        # if the cache is kept for the next MIDI, leave it all in
+                        if clear_cache and not pitch_needed:
+                            # it's never played again, so free it right away
+                            rendered_note = None
+                            notecache.discard(pitch)
+                            if pending:
+                                pending.release(pitch)
+                        elif clear_cache and not note_needed:
+                            notecache.discard_note(pitch, length)
+                    index += 1
+                    if pbar:
+                        update()
+                yield index
+        finally:
+            rendered_note = None
+            notecache.next_use = None
+            if clear_cache:
+                notecache.clear()
+            if pending:
+                pending.close()
 
         if pbar:
             bar.close()
-
-        if caching and clear_cache:
-            notecache.clear()
-
-        if savetype == FileSaveType.ARRAY_IN_MEM:
-            return output.channels
-        else:
-            output.save()
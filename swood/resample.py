@@ -0,0 +1,160 @@
+"""Resamples (channels, n) sound arrays to a new length for pitch shifting."""
+
+from PIL import Image
+import numpy as np
+
+
+def linear(x):
+    """Triangle (linear interpolation) kernel."""
+    x = np.abs(x)
+    return np.maximum(1.0 - x, 0.0, out=x)
+
+
+def cubic(x, a=-0.5):
+    """Keys cubic convolution kernel (the same one Pillow's BICUBIC uses)."""
+    x = np.abs(x)
+    near = ((a + 2.0) * x - (a + 3.0)) * x * x + 1
+    far = (((x - 5.0) * x + 8.0) * x - 4.0) * a
+    far[x >= 2.0] = 0.0
+    return np.where(x < 1.0, near, far)
+
+
+def sinc(x, lobes=3):
+    """Windowed-sinc (Lanczos) kernel."""
+    weights = np.sinc(x) * np.sinc(x / lobes)
+    weights[np.abs(x) >= lobes] = 0.0
+    return weights
+
+
+# name: (kernel function, support on each side in input samples)
+KERNELS = {
+    "linear": (linear, 1.0),
+    "cubic": (cubic, 2.0),
+    "sinc": (sinc, 3.0),
+}
+# the Pillow filter with the same kernel as each of ours
+PIL_FILTERS = {
+    "linear": Image.BILINEAR,
+    "cubic": Image.BICUBIC,
+    "sinc": Image.LANCZOS,
+}
+
+
+def coefficients(in_length, out_length, kernel="cubic", out_start=0, out_stop=None):
+    """Work out which input samples (and how much of each) make up each output sample.
+
+    This is a polyphase filter with one phase per output sample. When shrinking,
+    the kernel is stretched so it also acts as a low-pass filter against aliasing.
+    Only the outputs from out_start to out_stop are computed, so the weights for
+    a long sample don't all have to be in memory at once.
+
+    Returns:
+        A tuple of the first input index for each output sample and an array of
+        weights of shape (taps, outputs).
+    """
+    try:
+        func, support = KERNELS[kernel]
+    except KeyError:
+        raise ValueError("Unknown resampling kernel '{}'".format(kernel))
+    if out_stop is None:
+        out_stop = out_length
+    scale = in_length / out_length
+    filterscale = max(scale, 1.0)
+    support *= filterscale
+
+    center = (np.arange(out_start, out_stop) + 0.5) * scale
+    start = np.maximum((center - support + 0.5).astype(np.int64), 0)
+    stop = np.minimum((center + support + 0.5).astype(np.int64), in_length)
+    taps = int((stop - start).max())
+    # every window gets the same number of taps, so near the ends the window is
+    # moved back to stay inside the input and the extra taps get a weight of 0
+    first = np.minimum(start, in_length - taps)
+    positions = first + np.arange(taps)[:, None]
+    weights = func((positions - (center - 0.5)) / filterscale)
+    edges = np.flatnonzero((first != start) | (stop - start != taps))
+    if len(edges) > 0:
+        outside = (positions[:, edges] < start[edges]) | (positions[:, edges] >= stop[edges])
+        weights[:, edges] = np.where(outside, 0.0, weights[:, edges])
+    total = weights.sum(axis=0)
+    total[total == 0.0] = 1.0
+    weights /= total
+    return first, weights
+
+
+def resample(data, length, kernel="cubic", dtype=np.int32, chunksize=65536):
+    """Stretch or shrink a (channels, n) array to (channels, length).
+
+    32-bit integer samples go through Pillow's resampler (see pillow_resample),
+    which is about twice as fast as convolve() and gives the same result (to
+    within rounding).
+    Anything else is resampled with convolve().
+
+    Args:
+        data: The array to resample. Each row is a channel.
+        length: How many samples long each channel of the output should be.
+        kernel: "linear", "cubic" (the default) or "sinc".
+        dtype: The type of the output.
+        chunksize: How many output samples convolve() computes at a time.
+    """
+    if kernel not in KERNELS:
+        raise ValueError("Unknown resampling kernel '{}'".format(kernel))
+    if data.dtype == np.int32 and np.dtype(dtype) == np.int32 and length > 0 and data.shape[1] > 0:
+        return pillow_resample(data, length, kernel)
+    return convolve(data, length, kernel, dtype, chunksize)
+
+
+def pillow_resample(data, length, kernel="cubic"):
+    """Stretch or shrink a (channels, n) int32 array to (channels, length) with Pillow.
+
+    Each channel is a row of a 32-bit integer image, which Pillow resizes
+    horizontally with the same kernels (and the same rounding) as convolve(),
+    all in C. The result is read-only.
+    """
+    channels, in_length = data.shape
+    img = Image.frombuffer("I", (in_length, channels), np.ascontiguousarray(data, dtype=np.int32),
+                           "raw", "I", 0, 1)
+    # Pillow recommends those last args because of a bug in the raw parser
+    # See
+    # http://pillow.readthedocs.io/en/3.2.x/reference/Image.html?highlight=%22raw%22#PIL.Image.frombuffer
+    return np.asarray(img.resize((length, channels), resample=PIL_FILTERS[kernel]), dtype=np.int32)
+
+
+def convolve(data, length, kernel="cubic", dtype=np.int32, chunksize=65536):
+    """Stretch or shrink a (channels, n) array to (channels, length) with NumPy.
+
+    Args:
+        data: The array to resample. Each row is a channel.
+        length: How many samples long each channel of the output should be.
+        kernel: "linear", "cubic" (the default) or "sinc".
+        dtype: The type of the output. Integer outputs are rounded (half away
+        from zero) and clipped to fit.
+        chunksize: How many output samples to compute at a time, which limits
+        how much temporary memory is used.
+    """
+    channels, in_length = data.shape
+    out = np.empty((channels, length), dtype=dtype)
+    if length == 0 or in_length == 0:
+        out.fill(0)
+        return out
+    if np.issubdtype(dtype, np.integer):
+        limits = np.iinfo(dtype)
+    else:
+        limits = None
+
+    for start in range(0, length, chunksize):
+        end = min(start + chunksize, length)
+        first, weights = coefficients(in_length, length, kernel, start, end)
+        acc = np.zeros((channels, end - start), dtype=np.float64)
+        gathered = np.empty(acc.shape, dtype=data.dtype)
+        product = np.empty_like(acc)
+        # add up one tap at a time (in the same order Pillow does)
+        for tap, tap_weights in enumerate(weights):
+            np.take(data, first + tap, axis=1, out=gathered)
+            np.multiply(gathered, tap_weights, out=product)
+            acc += product
+        if limits is not None:
+            acc += np.copysign(0.5, acc)
+            np.trunc(acc, out=acc)
+            np.clip(acc, limits.min, limits.max, out=acc)
+        out[:, start:end] = acc
+    return out
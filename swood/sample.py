@@ -1,11 +1,27 @@
 from . import complain, ffmpeg
-from PIL import Image
+from .profiling import timed
 import numpy as np
+import tempfile
 import pyfftw
 import wave
+import os
 
 pyfftw.interfaces.cache.enable()
 
+# how many frames to decode at once when spilling a sample to disk
+SPILL_BLOCKSIZE = 65536
+# how many samples to send through FFTW at once, and on how many threads
+FFT_BATCHSIZE = 2 ** 20
+FFT_THREADS = os.cpu_count() or 1
+# YIN pitch detection settings: the lowest detectable pitch, the dip
+# threshold, and when to consider the estimate converged
+YIN_MIN_FREQ = 30.0
+YIN_THRESHOLD = 0.1
+YIN_TOLERANCE_CENTS = 0.5
+YIN_MAX_WINDOWS = 16
+
+PITCH_METHODS = ("fft", "yin")
+
 
 class CalculatedFFT:
     """Stores data about FFTs calculated in a Sample."""
@@ -26,22 +42,140 @@ def is_wav(f):
     return riff and wave
 
 
+def data_offset(filename):
+    """Find where the sound data starts in a WAV file by walking its RIFF chunks."""
+    with open(filename, "rb") as f:
+        f.seek(12)  # skip the RIFF/WAVE header
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise wave.Error("data chunk not found")
+            size = int.from_bytes(header[4:], byteorder="little")
+            if header[:4] == b"data":
+                return f.tell()
+            # chunks are padded to an even number of bytes
+            f.seek(size + (size & 1), 1)
+
+
+def pcm_dtype(sampwidth):
+    """Get the NumPy type used to hold samples of the given byte width."""
+    if sampwidth == 1:
+        return np.int8
+    elif sampwidth == 2:
+        return np.int16
+    elif sampwidth == 3 or sampwidth == 4:
+        return np.int32
+    else:
+        raise wave.Error
+
+
+def decode_pcm(buf, sampwidth, channels):
+    """Decode interleaved little-endian PCM into a (channels, length) array in one pass.
+
+    8-bit data is unsigned (as in WAV files) and gets recentered around zero;
+    16, 24 (packed 3-byte) and 32-bit data is signed. Trailing bytes that
+    don't make up a whole frame are ignored.
+    """
+    framesize = sampwidth * channels
+    length = len(buf) // framesize
+    if sampwidth == 1:
+        raw = np.frombuffer(buf, dtype=np.uint8, count=length * framesize)
+        frames = (raw ^ 0x80).view(np.int8)
+    elif sampwidth == 2:
+        frames = np.frombuffer(buf, dtype="<i2", count=length * channels)
+    elif sampwidth == 3:
+        raw = np.frombuffer(buf, dtype=np.uint8, count=length * framesize)
+        # put the 3 bytes in the top of an int32 and shift the sign back down
+        widened = np.zeros((length * channels, 4), dtype=np.uint8)
+        widened[:, 1:] = raw.reshape(-1, 3)
+        frames = widened.view("<i4").reshape(-1) >> 8
+    elif sampwidth == 4:
+        frames = np.frombuffer(buf, dtype="<i4", count=length * channels)
+    else:
+        raise wave.Error
+    # the transpose is a view, so every channel is strided over the same buffer
+    return frames.reshape(length, channels).astype(pcm_dtype(sampwidth), copy=False).T
+
+
+def yin_period(x, window, max_lag, threshold=YIN_THRESHOLD):
+    """Estimate the period (in samples) of a mono signal with the YIN algorithm.
+
+    x needs to hold at least window + max_lag samples. The difference function
+    for every lag is computed at once from an FFT cross-correlation, and the
+    result is refined with parabolic interpolation to get a fractional period.
+    See http://audition.ens.fr/adc/pdf/2002_JASA_YIN.pdf
+    """
+    x = np.asarray(x[:window + max_lag], dtype=np.float64)
+    n = 1 << int(np.ceil(np.log2(window + max_lag)))
+    spectrum = pyfftw.interfaces.numpy_fft.rfft(x, n)
+    head_spectrum = pyfftw.interfaces.numpy_fft.rfft(x[:window], n)
+    correlation = pyfftw.interfaces.numpy_fft.irfft(
+        spectrum * head_spectrum.conj(), n)[:max_lag]
+    # energy of x[lag:lag + window] for every lag via a running sum
+    energy = np.concatenate(((0.0,), np.cumsum(x * x)))
+    lagged_energy = energy[window:window + max_lag] - energy[:max_lag]
+    diff = energy[window] + lagged_energy - 2 * correlation
+    diff[0] = 0
+
+    # cumulative mean normalized difference
+    cmnd = np.ones(max_lag)
+    running = np.cumsum(diff[1:])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cmnd[1:] = diff[1:] * np.arange(1, max_lag) / running
+    cmnd[1:][running == 0] = 1
+
+    # take the first dip under the threshold (to avoid octave errors),
+    # falling back on the global minimum
+    below = np.flatnonzero(cmnd[2:] < threshold)
+    if len(below) == 0:
+        lag = int(np.argmin(cmnd[2:])) + 2
+    else:
+        lag = int(below[0]) + 2
+        while lag + 1 < max_lag and cmnd[lag + 1] < cmnd[lag]:
+            lag += 1
+    if 0 < lag < max_lag - 1:
+        # the raw difference function is smoother to interpolate than the normalized one
+        a, b, c = diff[lag - 1:lag + 2]
+        curve = a - 2 * b + c
+        if curve > 0:
+            return lag + 0.5 * (a - c) / curve
+    return float(lag)
+
+
 class Sample:
     """Reads and analyzes WAV files."""
 
-    def __init__(self, filename, binsize=8192, volume=0.9, fundamental_freq=None, pbar=True):
+    def __init__(self, filename, binsize=8192, volume=0.9, fundamental_freq=None, pbar=True, memmap=False, cache=None, pitch_method="fft"):
         self.binsize = binsize
 
         if binsize < 2:
             raise complain.ComplainToUser("FFT bin size must be at least 2.")
+        if pitch_method not in PITCH_METHODS:
+            raise complain.ComplainToUser(
+                "Unknown pitch detection method '{}'.".format(pitch_method))
+        self.pitch_method = pitch_method
 
         self._fundamental_freq = fundamental_freq
         self.filename = filename
         self.pbar = pbar
+        self.memmap = memmap
         self._fft = None
-        self._img = None
+        self._scaled = None
+        self._spill = None
+
+        self.cache = cache
+        self._cache_binsize = binsize
+        self._cache_key = None if cache is None else cache.key(filename)
+        cached = None if self._cache_key is None else cache.load(self._cache_key)
 
-        if (isinstance(filename, str) and filename.endswith(".wav")) or is_wav(filename):
+        if cached is not None:
+            self.wav, metadata = cached
+            self.sampwidth = metadata["sampwidth"]
+            self.framerate = metadata["framerate"]
+            self.channels, self.length = self.wav.shape
+            self.size = pcm_dtype(self.sampwidth)
+            self.max_amplitude = metadata["max_amplitude"]
+        elif (isinstance(filename, str) and filename.endswith(".wav")) or is_wav(filename):
             self.wav = self.parse_wav(filename)
         else:
             probed = ffmpeg.MediaInfo(filename).streams
@@ -56,14 +190,38 @@ class Sample:
                 except:
                     pass
             converted = ffmpeg.AudioFile(filename, streams=stream,
-                                         out_format="s32le").tobuffer("Importing sample" if pbar else None)
-            self.wav = self.parse_raw(
-                converted, 4, stream.sample_rate, stream.channels)
+                                         out_format="s32le")
+            if memmap:
+                # have FFmpeg decode straight into a spill file we can map
+                self._spill = tempfile.TemporaryFile()
+                converted.tofile(self._spill,
+                                 "Importing sample" if pbar else None)
+                self.wav = self.map_raw(
+                    self._spill, 4, stream.sample_rate, stream.channels)
+            else:
+                self.wav = self.parse_raw(
+                    converted.tobuffer("Importing sample" if pbar else None),
+                    4, stream.sample_rate, stream.channels)
+
+        if cached is None:
+            # widen before negating so the most negative value can't overflow
+            self.max_amplitude = max(-int(self.wav.min()),
+                                     int(self.wav.max()), 1)
+            if self._cache_key is not None:
+                cache.store(self._cache_key, self.wav, sampwidth=self.sampwidth,
+                            framerate=self.framerate, max_amplitude=self.max_amplitude)
+        self.volume = 256 ** 4 / (self.max_amplitude * 2) * volume
 
-        max_amplitude = int(max(max(abs(min(chan)), abs(max(chan)))
-                                for chan in self.wav))
-        self.volume = 256 ** 4 / (max_amplitude * 2) * volume
+        if self._cache_key is not None:
+            analysis = cache.load_analysis(self._cache_key, binsize)
+            if analysis is not None:
+                avgdata, metadata = analysis
+                self.binsize = metadata["fft_binsize"]
+                self._fft = CalculatedFFT(avgdata, metadata["spacing"])
+                if self._fundamental_freq is None and pitch_method == "fft":
+                    self._fundamental_freq = metadata["fundamental_freq"]
 
+    @timed("import sample")
     def parse_wav(self, filename):
         """Load a WAV file into a NumPy array."""
         try:
@@ -73,21 +231,13 @@ class Sample:
                 self.channels = wavfile.getnchannels()
                 self.length = wavfile.getnframes()
 
-                if self.sampwidth == 1:
-                    self.size = np.int8
-                elif self.sampwidth == 2:
-                    self.size = np.int16
-                elif self.sampwidth == 3 or self.sampwidth == 4:
-                    self.size = np.int32
-                else:
-                    raise wave.Error
-
-                wav = np.empty((self.channels, self.length), dtype=self.size)
-                for i in range(0, self.length):
-                    frame = wavfile.readframes(1)
-                    for chan in range(self.channels):
-                        wav[chan][i] = int.from_bytes(
-                            frame[self.sampwidth * chan:self.sampwidth * (chan + 1)], byteorder="little", signed=True)
+                self.size = pcm_dtype(self.sampwidth)
+                if self.memmap and self.length > 0:
+                    return self.map_wav(wavfile, filename)
+                wav = decode_pcm(wavfile.readframes(self.length),
+                                 self.sampwidth, self.channels)
+                # trust the data over the header if the file was truncated
+                self.length = wav.shape[1]
                 return wav
         except IOError:
             raise complain.ComplainToUser(
@@ -96,32 +246,104 @@ class Sample:
             raise complain.ComplainToUser(
                 "This WAV type is not supported. Try opening the file in Audacity and exporting it as a standard WAV.")
 
+    @timed("import sample")
     def parse_raw(self, buf, sampwidth=4, framerate=44100, channels=2):
         """Load raw PCM data into a NumPy array."""
         self.sampwidth = sampwidth
         self.framerate = framerate
         self.channels = channels
 
-        framesize = channels * sampwidth
-        self.length = len(buf) // framesize
-
-        if self.sampwidth == 1:
-            self.size = np.int8
-        elif self.sampwidth == 2:
-            self.size = np.int16
-        elif self.sampwidth == 3 or self.sampwidth == 4:
-            self.size = np.int32
-        else:
+        try:
+            self.size = pcm_dtype(sampwidth)
+        except wave.Error:
             raise ValueError("Sample width too high (max 4)")
 
-        wav = np.zeros((self.channels, self.length), dtype=self.size)
-        for i in range(self.length):
-            frame = buf[framesize * i:framesize * (i + 1)]
-            for chan in range(self.channels):
-                wav[chan][i] = int.from_bytes(
-                    frame[self.sampwidth * chan:self.sampwidth * (chan + 1)], byteorder="little", signed=True)
+        wav = decode_pcm(buf, sampwidth, channels)
+        self.length = wav.shape[1]
         return wav
 
+    def map_wav(self, wavfile, filename):
+        """Memory-map the data chunk of an open WAV file instead of reading it into memory."""
+        if isinstance(filename, str) and self.sampwidth in (2, 4):
+            offset = data_offset(filename)
+            framesize = self.sampwidth * self.channels
+            self.length = min(self.length,
+                              (os.path.getsize(filename) - offset) // framesize)
+            return np.memmap(filename, dtype="<i{}".format(self.sampwidth), mode="r",
+                             offset=offset, shape=(self.length, self.channels)).T
+
+        # 8 and 24-bit samples (and anything that isn't a real file on disk)
+        # have to be decoded, so do it a block at a time into a spill file
+        self._spill = tempfile.TemporaryFile()
+        wav = np.memmap(self._spill, dtype=self.size, mode="w+",
+                        shape=(self.channels, self.length))
+        pos = 0
+        while pos < self.length:
+            block = decode_pcm(wavfile.readframes(SPILL_BLOCKSIZE),
+                               self.sampwidth, self.channels)
+            if block.shape[1] == 0:
+                break
+            wav[:, pos:pos + block.shape[1]] = block
+            pos += block.shape[1]
+        self.length = pos
+        return wav[:, :pos]
+
+    def map_raw(self, fobj, sampwidth=4, framerate=44100, channels=2):
+        """Memory-map a file of raw PCM data instead of reading it into memory."""
+        if sampwidth not in (2, 4):
+            raise ValueError("Only 16 and 32-bit raw data can be memory-mapped")
+        self.sampwidth = sampwidth
+        self.framerate = framerate
+        self.channels = channels
+        self.size = pcm_dtype(sampwidth)
+
+        fobj.flush()
+        self.length = os.fstat(fobj.fileno()).st_size // (sampwidth * channels)
+        if self.length == 0:
+            return decode_pcm(b"", sampwidth, channels)
+        return np.memmap(fobj, dtype="<i{}".format(sampwidth), mode="r",
+                         shape=(self.length, channels)).T
+
+    @property
+    def scaled(self):
+        """The samples multiplied by the volume as 32-bit integers.
+
+        This is computed without a floating-point copy of the whole sample. If the
+        sample is memory-mapped, the result is backed by a spill file as well.
+        """
+        if self._scaled is None:
+            if self.memmap and self.length > 0:
+                scaled = np.memmap(tempfile.TemporaryFile(), dtype=np.int32, mode="w+",
+                                   shape=(self.channels, self.length))
+            else:
+                scaled = np.empty((self.channels, self.length), dtype=np.int32)
+            np.multiply(self.wav, self.volume, out=scaled, casting="unsafe")
+            self._scaled = scaled
+        return self._scaled
+
+    @timed("fft")
+    def average_spectrum(self, binsize):
+        """Sum the magnitude spectra of every full window of every channel.
+
+        The windows are views made with stride tricks (no copying), and are
+        sent through FFTW as a few large batches of real-input FFTs.
+        """
+        windows = self.length // binsize
+        avgdata = np.zeros(binsize // 2, dtype=np.float64)
+        if windows == 0:
+            return avgdata
+        chan_stride, frame_stride = self.wav.strides
+        frames = np.lib.stride_tricks.as_strided(
+            self.wav, shape=(self.channels, windows, binsize),
+            strides=(chan_stride, frame_stride * binsize, frame_stride),
+            writeable=False)
+        batch = max(1, FFT_BATCHSIZE // (binsize * self.channels))
+        for i in range(0, windows, batch):
+            spectrum = pyfftw.interfaces.numpy_fft.rfft(
+                frames[:, i:i + batch], threads=FFT_THREADS)
+            avgdata += np.abs(spectrum[..., :binsize // 2]).sum(axis=(0, 1))
+        return avgdata
+
     @property
     def fft(self):
         """Run a Fast Fourier Transform on the WAV file to create a histogram of frequencies and amplitudes."""
@@ -129,47 +351,74 @@ class Sample:
             if self.binsize % 2 != 0:
                 # bin size must be even
                 self.binsize += 1
-            spacing = float(self.framerate) / self.binsize
-            avgdata = np.zeros(self.binsize // 2, dtype=np.float64)
-            for chan in range(self.channels):
-                for i in range(0, self.wav.shape[1], self.binsize):
-                    data = np.array(
-                        self.wav[chan][i:i + self.binsize], dtype=self.size)
-                    if len(data) != self.binsize:
-                        continue
-                    fft = pyfftw.interfaces.numpy_fft.fft(data)
-                    fft = np.abs(fft[:self.binsize // 2])
-                    avgdata += fft
-                    del data
-                    del fft
-            if max(avgdata) == 0:
+            # if the sample is shorter than one bin, skip straight to the
+            # first bin size that would fit instead of trying each one
+            while self.binsize > 2 and self.binsize > self.length:
+                self.binsize = self.binsize // 2
+                self.binsize += self.binsize % 2
+            avgdata = self.average_spectrum(self.binsize)
+            while avgdata.max() == 0 and self.binsize > 2:
                 # these warnings aren't as useful to the user
                 # print("Warning: Bin size is too large to analyze sample; dividing by 2 and trying again", file=sys.stderr)
                 self.binsize = self.binsize // 2
-                self._fft = self.fft
-            else:
-                self._fft = CalculatedFFT(avgdata, spacing)
+                self.binsize += self.binsize % 2
+                avgdata = self.average_spectrum(self.binsize)
+            self._fft = CalculatedFFT(
+                avgdata, float(self.framerate) / self.binsize)
         return self._fft
 
-    @property
-    def img(self):
-        """Generate a PIL image from the WAV file."""
-        if not self._img:
-            self._img = Image.frombytes("I",
-                                        (self.length, self.channels),
-                                        (self.wav * self.volume).astype(np.int32).tobytes(),
-                                        "raw", "I", 0, 1)
-            # Pillow recommends those last args because of a bug in the raw parser
-            # See
-            # http://pillow.readthedocs.io/en/3.2.x/reference/Image.html?highlight=%22raw%22#PIL.Image.frombuffer
-        return self._img
+    def detect_pitch(self):
+        """Find the fundamental frequency in the time domain with YIN.
+
+        Only the loudest stable part of the sample is analyzed, one window at a
+        time, stopping as soon as two windows agree to within a fraction of a cent.
+        """
+        max_lag = min(int(self.framerate / YIN_MIN_FREQ), self.length // 2)
+        window = min(max_lag, self.length - max_lag)
+        if window < 3:
+            raise complain.ComplainToUser(
+                "The sample is too short to detect its pitch.")
+
+        # find the loudest pair of neighboring windows (so a single transient
+        # spike doesn't count) by their peak-to-peak amplitude
+        windows = self.length // window
+        chan_stride, frame_stride = self.wav.strides
+        frames = np.lib.stride_tricks.as_strided(
+            self.wav, shape=(self.channels, windows, window),
+            strides=(chan_stride, frame_stride * window, frame_stride),
+            writeable=False)
+        loudness = frames.max(axis=(0, 2)).astype(np.int64) - \
+            frames.min(axis=(0, 2)).astype(np.int64)
+        if windows > 1:
+            loudness = np.minimum(loudness[:-1], loudness[1:])
+        start = int(np.argmax(loudness)) * window
+
+        estimates = []
+        while len(estimates) < YIN_MAX_WINDOWS and start + window + max_lag <= self.length:
+            mono = self.wav[:, start:start + window + max_lag].mean(axis=0)
+            estimates.append(self.framerate / yin_period(mono, window, max_lag))
+            if len(estimates) > 1 and \
+                    abs(1200 * np.log2(estimates[-1] / estimates[-2])) < YIN_TOLERANCE_CENTS:
+                return (estimates[-1] + estimates[-2]) / 2
+            start += window
+        if len(estimates) == 0:
+            mono = self.wav[:, :window + max_lag].mean(axis=0)
+            return self.framerate / yin_period(mono, window, max_lag)
+        return float(np.median(estimates))
 
     @property
     def fundamental_freq(self):
-        """Find the most prominent frequency from the FFT."""
+        """Find the most prominent frequency from the FFT (or with YIN)."""
         if not self._fundamental_freq:
+            if self.pitch_method == "yin":
+                self._fundamental_freq = self.detect_pitch()
+                return self._fundamental_freq
             self._fundamental_freq = (
                 np.argmax(self.fft.avgdata[1:]) * self.fft.spacing) + (self.fft.spacing / 2)
+            if self._cache_key is not None:
+                self.cache.store_analysis(self._cache_key, self._cache_binsize, self.fft.avgdata,
+                                          fft_binsize=self.binsize, spacing=self.fft.spacing,
+                                          fundamental_freq=float(self._fundamental_freq))
         return self._fundamental_freq
 
     def __len__(self):
@@ -0,0 +1,141 @@
+"""Keeps decoded samples and their analysis on disk so they can be reused between runs."""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# bump this whenever the decoding or analysis changes so old entries are ignored
+CACHE_VERSION = 1
+
+
+def default_directory():
+    """Get the sample cache directory inside the swood app data folder."""
+    if os.name == "nt":
+        return os.path.expanduser("~/AppData/Local/swood/samples")
+    else:
+        return os.path.expanduser("~/.swood/samples")
+
+
+class SampleCache:
+    """A size-bounded, content-addressed store of decoded samples.
+
+    Entries are keyed by a hash of the sample file's contents, so renamed or
+    copied files still hit the cache. The decoded PCM is stored as a .npy file
+    that gets memory-mapped on a hit, and the FFT analysis is stored next to it
+    for each bin size it was computed with. When the cache grows past max_size
+    bytes, the least recently used entries are deleted.
+    """
+
+    def __init__(self, directory=None, max_size=2 ** 30):
+        self.directory = default_directory() if directory is None else directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, f):
+        """Hash the contents of a file (or file path), or return None if it can't be read twice."""
+        digest = hashlib.sha256(str(CACHE_VERSION).encode("utf-8"))
+        if isinstance(f, str):
+            with open(f, "rb") as fobj:
+                for block in iter(lambda: fobj.read(1 << 20), b""):
+                    digest.update(block)
+        else:
+            try:
+                pos = f.tell()
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+                f.seek(pos)
+            except (AttributeError, OSError, ValueError):
+                # stdin and other pipes can only be read once
+                return None
+        return digest.hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _discard(self, *paths):
+        # an entry missing one of its files is useless, but its other file still takes up room
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _touch(self, *paths):
+        for path in paths:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+    def _write(self, name, write):
+        # write to a temporary file first so other processes never see half an entry
+        tmp_path = self._path("{}.{}.tmp".format(name, os.getpid()))
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, self._path(name))
+
+    def load(self, key):
+        """Memory-map a cached sample, returning (wav, metadata) or None on a miss."""
+        pcm_path, meta_path = self._path(key + ".npy"), self._path(key + ".json")
+        try:
+            with open(meta_path) as f:
+                metadata = json.load(f)
+            wav = np.load(pcm_path, mmap_mode="r")
+        except (OSError, ValueError):
+            self._discard(pcm_path, meta_path)
+            return None
+        self._touch(pcm_path, meta_path)
+        return wav, metadata
+
+    def store(self, key, wav, **metadata):
+        """Save a decoded (channels, length) sample along with its metadata."""
+        self._write(key + ".npy", lambda f: np.save(f, wav))
+        self._write(key + ".json",
+                    lambda f: f.write(json.dumps(metadata).encode("utf-8")))
+        self.evict()
+
+    def load_analysis(self, key, binsize):
+        """Load a cached spectrum, returning (avgdata, metadata) or None on a miss."""
+        name = "{}-{}".format(key, binsize)
+        fft_path, meta_path = self._path(name + ".fft.npy"), self._path(name + ".json")
+        try:
+            with open(meta_path) as f:
+                metadata = json.load(f)
+            avgdata = np.load(fft_path)
+        except (OSError, ValueError):
+            self._discard(fft_path, meta_path)
+            return None
+        self._touch(fft_path, meta_path)
+        return avgdata, metadata
+
+    def store_analysis(self, key, binsize, avgdata, **metadata):
+        """Save the averaged spectrum (and things derived from it) for a bin size."""
+        name = "{}-{}".format(key, binsize)
+        self._write(name + ".fft.npy", lambda f: np.save(f, avgdata))
+        self._write(name + ".json",
+                    lambda f: f.write(json.dumps(metadata).encode("utf-8")))
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in max_size.
+
+        An entry's files (like KEY.npy and KEY.json) are always deleted together,
+        so no entry is left with only some of them.
+        """
+        entries = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                # KEY.npy and KEY.json, or KEY-BINSIZE.fft.npy and KEY-BINSIZE.json
+                name = entry.name.partition(".")[0]
+                last_used, size, paths = entries.get(name, (0.0, 0, []))
+                paths.append(entry.path)
+                entries[name] = (max(last_used, stat.st_mtime), size + stat.st_size, paths)
+        total = sum(size for _, size, _ in entries.values())
+        for _, size, paths in sorted(entries.values(), key=lambda entry: entry[0]):
+            if total <= self.max_size:
+                break
+            self._discard(*paths)
+            total -= size
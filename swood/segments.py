@@ -0,0 +1,159 @@
+"""Renders the output in segments of time on separate processes (or computers) and stitches them back together.
+
+Each segment is saved to a directory as the raw float32 mix of its part of
+the output, plus a small JSON file saying where it goes and how loud it got.
+The stitcher works out the gain from the loudest segment, so the result is
+exactly the same as rendering everything in one go.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import tempfile
+import wave
+import json
+import os
+
+from numpy import fromfile, float32, int32
+from numpy import dtype as dtype_info
+
+from . import complain, ffmpeg, midiparse, render, samplecache, soundfont
+from .server import JOB_OPTIONS
+from .wavout import peak, output_gain, quantize, write_array, QUANTIZE_BLOCKSIZE
+
+
+def split(length, count):
+    """Split length frames into count segments as evenly as possible, as (start, stop) pairs."""
+    return [(length * idx // count, length * (idx + 1) // count) for idx in range(count)]
+
+
+def segment_path(directory, index):
+    """Get the path of a segment's audio, without an extension."""
+    return os.path.join(directory, "segment-{:05d}".format(index))
+
+
+def render_to(renderer, midi, directory, index, count):
+    """Render one of count segments of a MIDI's output into a directory."""
+    start, stop = split(renderer.output_length(midi), count)[index]
+    bus = renderer.render_segment(midi, start, stop)
+    path = segment_path(directory, index)
+    with open(path + ".f32", "wb") as f:
+        write_array(f, bus, "segment bytes written")
+    info = {
+        "index": index,
+        "count": count,
+        "start": start,
+        "frames": stop - start,
+        "channels": bus.shape[0],
+        "framerate": renderer.sample.framerate,
+        "peak": peak(bus),
+        # so the stitcher can use --gain velocity
+        "velocity_gain": render.velocity_gain(midi),
+    }
+    # the JSON is written last (and all at once) so a half-written segment is never stitched
+    with open(path + ".json.tmp", "w") as f:
+        json.dump(info, f)
+    os.replace(path + ".json.tmp", path + ".json")
+
+
+def _render_worker(options, directory, index, count):
+    """Load everything from scratch and render a segment, like another computer would."""
+    if options.get("sample_cache"):
+        cache = samplecache.SampleCache(max_size=int(options["sample_cache"] * 2 ** 30))
+    else:
+        cache = None
+    config_options = {}
+    font = soundfont.load(options["infile"], config_options, binsize=options["binsize"], pbar=False,
+                          memmap=options.get("memmap", False), cache=cache, pitch_method=options["pitch_method"])
+    # like on the command line, the job's options win unless they're the default
+    options = dict(options)
+    for name, value in config_options.items():
+        if name in JOB_OPTIONS and options.get(name) == JOB_OPTIONS[name]:
+            options[name] = value
+    midi = midiparse.MIDIParser(options["midi"], font, options["transpose"], options["speed"])
+    renderer = render.NoteRenderer(font, options["fullclip"], options["cachesize"],
+                                   resampler=options["resampler"], cache_mem=options.get("cache_mem"))
+    render_to(renderer, midi, directory, index, count)
+
+
+def stitch(directory, filename, dtype=int32, gain=None):
+    """Join every segment in a directory into one WAV file.
+
+    Args:
+        directory: Where the segments were rendered to.
+        filename: A file or file path to save the WAV file to.
+        gain: What to multiply the mix by, or "velocity" for the MIDI's
+        render.velocity_gain. By default, the loudest sample in any segment is
+        brought to wavout.PEAK_LEVEL.
+    """
+    infos = []
+    for name in sorted(os.listdir(directory)):
+        if name.startswith("segment-") and name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                infos.append(json.load(f))
+    if not infos:
+        raise complain.ComplainToUser("There are no segments in '{}' to stitch.".format(directory))
+    count = infos[0]["count"]
+    missing = sorted(set(range(count)) - {info["index"] for info in infos})
+    if missing:
+        raise complain.ComplainToUser("Segments {} of {} haven't been rendered yet.".format(
+            ", ".join(str(idx) for idx in missing), count))
+    end = 0
+    for info in infos:
+        if info["count"] != count or info["start"] != end:
+            raise complain.ComplainToUser(
+                "The segments in '{}' are from different renders.".format(directory))
+        end += info["frames"]
+    channels = infos[0]["channels"]
+    if gain == "velocity":
+        gain = infos[0]["velocity_gain"]
+    gain = output_gain(max(info["peak"] for info in infos), dtype, gain)
+
+    if not isinstance(filename, str) or filename.endswith(".wav"):
+        wav_filename = filename
+    else:
+        wav_filename = ffmpeg.AudioFile(filename, "w", in_format="wav")
+    try:
+        with (open(wav_filename, "wb") if isinstance(wav_filename, str) else wav_filename) as wavfile:
+            with wave.open(wavfile, "w") as wav:
+                wav.setparams((channels, dtype_info(dtype).itemsize, infos[0]["framerate"],
+                               end, "NONE", "not compressed"))
+                for info in infos:
+                    with open(segment_path(directory, info["index"]) + ".f32", "rb") as f:
+                        for done in range(0, info["frames"], QUANTIZE_BLOCKSIZE):
+                            frames = min(QUANTIZE_BLOCKSIZE, info["frames"] - done)
+                            block = fromfile(f, dtype=float32, count=frames * channels)
+                            block = block.reshape((channels, frames), order="F")
+                            wav.writeframesraw(quantize(block, gain, dtype).flatten(order="F"))
+    except IOError:
+        raise complain.ComplainToUser(
+            "Can't save output file '{}'.".format(filename))
+
+
+def render_segmented(options, filename, count, workers=None, directory=None):
+    """Render a MIDI in count segments on a pool of processes, then stitch them into a WAV file.
+
+    Each process loads the samples and the MIDI itself, just like separate
+    computers would.
+
+    Args:
+        options: The job to render, like a swood.server job (infile, midi,
+        transpose, speed, binsize, pitch_method, fullclip, cachesize and
+        resampler), plus the gain to stitch the segments with and optionally
+        how to load samples (memmap, and sample_cache in GB) and a cache_mem
+        budget, which is split evenly between the processes.
+        filename: A file or file path to save the WAV file to.
+        count: How many segments to split the output into.
+        workers: How many processes to use (one per core by default).
+        directory: Where to keep the segments. By default, they go in a
+        temporary directory that's deleted afterwards.
+    """
+    if directory is None:
+        with tempfile.TemporaryDirectory(prefix="swood-") as tempdir:
+            return render_segmented(options, filename, count, workers, tempdir)
+    workers = workers or os.cpu_count() or 1
+    if options.get("cache_mem") is not None:
+        options = dict(options, cache_mem=options["cache_mem"] // min(workers, count))
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_render_worker, options, directory, index, count) for index in range(count)]
+        for future in futures:
+            future.result()
+    stitch(directory, filename, gain=options.get("gain"))
@@ -0,0 +1,466 @@
+"""Keeps samples and note caches loaded between renders, taking jobs over localhost HTTP.
+
+The server speaks JSON:
+
+    POST /jobs          submit a job (see JOB_OPTIONS), returns its status
+    GET /jobs           the status of every job
+    GET /jobs/<id>      the status of one job
+    DELETE /jobs/<id>   cancel a job, whether it's queued or running
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from collections import OrderedDict
+import ipaddress
+import itertools
+import threading
+import traceback
+import socket
+import queue
+import json
+import time
+import sys
+import os
+
+from . import complain
+
+DEFAULT_PORT = 7341
+# the most memory all the note caches can use between them unless the server's told otherwise
+DEFAULT_CACHE_MEM = 512 * 2 ** 20
+# how many soundfonts to keep loaded, and how many renderers (sets of settings) each worker keeps
+MAX_FONTS = 8
+MAX_RENDERERS = 4
+
+# what a job can set, and the default for each
+JOB_OPTIONS = {
+    "infile": None,
+    "midi": None,
+    "output": None,
+    "transpose": 0,
+    "speed": 1.0,
+    "binsize": 8192,
+    "pitch_method": "fft",
+    "fullclip": False,
+    "cachesize": 7.5,
+    "resampler": "cubic",
+    "gain": None,
+    "mix_threads": 1,
+}
+# the values options that are a choice can take
+OPTION_CHOICES = {
+    "pitch_method": ("fft", "yin"),
+    "resampler": ("linear", "cubic", "sinc"),
+}
+# how many finished jobs to remember the status of
+FINISHED_JOBS = 1000
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class RenderJob:
+    """A render waiting in the queue, running, or finished."""
+
+    def __init__(self, job_id, options):
+        self.id = job_id
+        self.options = options
+        self.state = "queued"
+        self.done = 0
+        self.total = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+
+    def update(self, done):
+        """Keep track of how many notes are done, stopping the render if the job's been cancelled."""
+        self.done = done
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+    @property
+    def status(self):
+        status = {
+            "id": self.id,
+            "state": self.state,
+            "done": self.done,
+            "total": self.total,
+            "error": self.error,
+        }
+        status.update(self.options)
+        if self.started is not None:
+            status["waited"] = self.started - self.submitted
+            status["seconds"] = (self.finished or time.time()) - self.started
+        return status
+
+
+class RenderServer:
+    """Runs render jobs on a pool of worker threads, keeping what they load around for the next job.
+
+    Each soundfont is loaded the first time a job uses it, and the MAX_FONTS
+    most recently used ones are kept loaded. Each worker has its own
+    NoteRenderer for each of the MAX_RENDERERS sets of settings it's used most
+    recently, and keeps its note cache between jobs, so pitches shifted for
+    one job are ready for the next.
+
+    The cache_mem budget is split evenly between the workers. A worker gives
+    most of its share to the renderer it's about to use, and lets the others
+    keep what they've cached in the rest.
+
+    Args:
+        workers: How many jobs to render at once.
+        queue_size: How many jobs can wait for a worker before new ones are turned away.
+        cache_mem: The most memory all the note caches can use together, or None for
+            no limit (then the note caches are cleared after every job instead of kept).
+    """
+
+    def __init__(self, workers=1, queue_size=16, cache_mem=DEFAULT_CACHE_MEM):
+        self.cache_mem = cache_mem
+        self.queue = queue.Queue(queue_size)
+        self.jobs = OrderedDict()
+        self.fonts = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._font_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, options):
+        """Queue up a job, raising queue.Full if there's no room and ValueError if the options are wrong."""
+        unknown = set(options) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError("unknown options: {}".format(", ".join(sorted(unknown))))
+        for name in ("infile", "midi", "output"):
+            if not isinstance(options.get(name), str):
+                raise ValueError("'{}' must be a path".format(name))
+        for name, value in options.items():
+            check_option(name, value)
+        job_options = dict(JOB_OPTIONS)
+        job_options.update(options)
+        with self._lock:
+            job = RenderJob(next(self._ids), job_options)
+            self.queue.put_nowait(job)
+            self.jobs[job.id] = job
+            self._forget_finished()
+        return job
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def status(self, job_id=None):
+        """Get the status of a job (or None if there isn't one with that ID), or a list of every job's if job_id is None."""
+        # submit() can forget finished jobs while this is going through them
+        with self._lock:
+            if job_id is None:
+                return [job.status for job in self.jobs.values()]
+            job = self.jobs.get(job_id)
+            return None if job is None else job.status
+
+    def cancel(self, job_id):
+        """Cancel a job, returning it (or None if there isn't one with that ID)."""
+        # the worker checks and sets the state under the lock too, so a job
+        # can't start running between here seeing it queued and cancelling it
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.finished is None:
+                job.cancelled.set()
+                if job.state == "queued":
+                    # the worker that picks it up will skip it
+                    job.state = "cancelled"
+                    job.finished = time.time()
+        return job
+
+    def font(self, options):
+        """Load a soundfont, or get it if it's been loaded already.
+
+        Returns the soundfont and the options its config file sets.
+        """
+        from . import soundfont
+        from .batch import warm_up
+
+        key = font_key(options)
+        with self._font_lock:
+            if key in self.fonts:
+                self.fonts.move_to_end(key)
+                return self.fonts[key]
+            infile, binsize, pitch_method = key
+            config_options = {}
+            font = soundfont.load(infile, config_options, binsize=binsize, pbar=False,
+                                  pitch_method=pitch_method)
+            warm_up(font)
+            self.fonts[key] = (font, config_options)
+            # workers still rendering with a font that's dropped keep it until they're done
+            while len(self.fonts) > MAX_FONTS:
+                self.fonts.popitem(last=False)
+            return font, config_options
+
+    def _share_budget(self, renderers, key):
+        """Split this worker's share of cache_mem between its renderers before renderers[key] is used.
+
+        The other renderers can keep up to half of the share between them (the
+        most recently used first), and renderers[key] gets the rest.
+        """
+        share = self.cache_mem // len(self.threads)
+        spare = share // 2
+        for other in reversed(renderers):
+            if other != key:
+                notecache = renderers[other].notecache
+                notecache.max_bytes = min(notecache.bytes, spare)
+                notecache.evict()
+                spare -= notecache.bytes
+        renderers[key].notecache.max_bytes = share // 2 + spare
+        renderers[key].notecache.evict()
+
+    def _worker(self):
+        from . import midiparse, render
+
+        renderers = OrderedDict()
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self._lock:
+                if job.state != "queued":
+                    # it was cancelled while it waited
+                    continue
+                job.state = "running"
+                job.started = time.time()
+            options = dict(job.options)
+            try:
+                font, config_options = self.font(options)
+                # like on the command line, the job's options win unless they're the default
+                for name, value in config_options.items():
+                    if name in JOB_OPTIONS and options[name] == JOB_OPTIONS[name]:
+                        options[name] = value
+                key = font_key(options) + (options["fullclip"], options["cachesize"], options["resampler"])
+                # the font could have been dropped and loaded again since the renderer was made
+                if key not in renderers or renderers[key].sample is not font:
+                    renderers[key] = render.NoteRenderer(font, options["fullclip"], options["cachesize"],
+                                                         resampler=options["resampler"])
+                renderers.move_to_end(key)
+                while len(renderers) > MAX_RENDERERS:
+                    renderers.popitem(last=False)
+                if self.cache_mem is not None:
+                    self._share_budget(renderers, key)
+                midi = midiparse.MIDIParser(options["midi"], font, options["transpose"], options["speed"])
+                job.total = midi.notecount
+                # without a budget, keeping every pitch of every job would never stop growing
+                renderers[key].render(midi, options["output"], clear_cache=self.cache_mem is None,
+                                      mix_threads=options["mix_threads"], gain=options["gain"],
+                                      progress=job.update)
+                state, error = "done", None
+            except JobCancelled:
+                state, error = "cancelled", None
+                try:
+                    os.remove(options["output"])
+                except OSError:
+                    pass
+            except complain.ComplainToUser as e:
+                state, error = "failed", str(e)
+            except Exception as e:
+                # keep serving, but it's a bug so show where it happened
+                traceback.print_exc()
+                state, error = "failed", "{}: {}".format(type(e).__name__, e)
+            with self._lock:
+                job.state = state
+                job.error = error
+                job.finished = time.time()
+
+    def close(self):
+        """Cancel every job and stop the workers."""
+        with self._lock:
+            job_ids = list(self.jobs)
+        for job_id in job_ids:
+            self.cancel(job_id)
+        for _ in self.threads:
+            # there's no room if the queue is full, but then the workers are skipping cancelled jobs
+            try:
+                self.queue.put(None, timeout=1)
+            except queue.Full:
+                pass
+
+
+def font_key(options):
+    """Get what a job's soundfont is loaded with, which decides whether it can share one with other jobs."""
+    return (options["infile"], options["binsize"], options["pitch_method"])
+
+
+def check_option(name, value):
+    """Raise ValueError if a job option's value is the wrong type (paths are checked by RenderServer.submit)."""
+    default = JOB_OPTIONS[name]
+    if name == "gain":
+        if value is None or value == "velocity":
+            return
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 < value < float("inf"):
+            raise ValueError("'gain' must be a positive number or \"velocity\"")
+    elif name in OPTION_CHOICES:
+        if value not in OPTION_CHOICES[name]:
+            raise ValueError("'{}' must be one of {}".format(name, ", ".join(OPTION_CHOICES[name])))
+    elif isinstance(default, bool):
+        if not isinstance(value, bool):
+            raise ValueError("'{}' must be true or false".format(name))
+    elif isinstance(default, int):
+        # JSON true and false are ints to Python
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError("'{}' must be a whole number".format(name))
+        if name in ("binsize", "mix_threads") and value <= 0:
+            raise ValueError("'{}' must be positive".format(name))
+    elif isinstance(default, float):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("'{}' must be a number".format(name))
+        if name == "speed" and value <= 0:
+            raise ValueError("'speed' must be positive")
+        if name == "cachesize" and value < 0:
+            raise ValueError("'cachesize' can't be negative")
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Handles the JSON API for a RenderServer (self.server.renderserver)."""
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def job_id(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            return int(parts[1])
+        return None
+
+    def do_GET(self):
+        renderserver = self.server.renderserver
+        if self.path.rstrip("/") == "/jobs":
+            self.send_json(200, renderserver.status())
+            return
+        job_id = self.job_id()
+        status = None if job_id is None else renderserver.status(job_id)
+        if status is None:
+            self.send_json(404, {"error": "no such job"})
+        else:
+            self.send_json(200, status)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "jobs are submitted to /jobs"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            options = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(options, dict):
+                raise ValueError("a job must be a JSON object")
+            job = self.server.renderserver.submit(options)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+        except queue.Full:
+            self.send_json(503, {"error": "the job queue is full"})
+        else:
+            self.send_json(202, job.status)
+
+    def do_DELETE(self):
+        job_id = self.job_id()
+        job = None if job_id is None else self.server.renderserver.cancel(job_id)
+        if job is None:
+            self.send_json(404, {"error": "no such job"})
+        else:
+            self.send_json(200, job.status)
+
+    def log_message(self, format, *args):
+        # polling for progress would fill up the terminal
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def is_loopback(host):
+    """Check whether every address a host name stands for is only reachable from this computer."""
+    try:
+        addresses = socket.getaddrinfo(host or None, None, proto=socket.IPPROTO_TCP, flags=socket.AI_PASSIVE)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(address[4][0].split("%")[0]).is_loopback for address in addresses)
+
+
+def serve(renderserver, host="127.0.0.1", port=DEFAULT_PORT, allow_remote=False):
+    """Serve the JSON API for a RenderServer until interrupted.
+
+    Anyone who can reach the server can read and write any file the server can,
+    so it only listens on loopback addresses unless allow_remote is set.
+    """
+    if not is_loopback(host):
+        if not allow_remote:
+            renderserver.close()
+            raise complain.ComplainToUser("'{}' can be reached from other computers, and the server has no "
+                                          "authentication: anyone who can reach it can read and write any file "
+                                          "you can. Use --allow-remote if you really want that.".format(host))
+        print("Warning: the server is listening on '{}' with no authentication, so anyone who can reach it "
+              "can read and write any file you can.".format(host), file=sys.stderr)
+    httpd = ThreadingHTTPServer((host, port), RequestHandler)
+    httpd.renderserver = renderserver
+    print("swood is listening on http://{}:{}/".format(*httpd.server_address[:2]), file=sys.stderr)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        renderserver.close()
+
+
+def request(url, method="GET", body=None):
+    """Make a request to a swood server and return the decoded JSON (raising ComplainToUser if it fails)."""
+    import urllib.request
+    import urllib.error
+
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read().decode("utf-8"))["error"]
+        except (ValueError, KeyError):
+            message = str(e)
+        raise complain.ComplainToUser("The swood server turned down the job: {}".format(message))
+    except urllib.error.URLError as e:
+        raise complain.ComplainToUser("Can't reach the swood server at '{}': {}".format(url, e.reason))
+
+
+def submit(server, options, pbar=True, poll=0.25):
+    """Submit a job to a swood server and wait for it to finish, cancelling it if interrupted.
+
+    Returns the job's final status.
+    """
+    server = server.rstrip("/")
+    status = request(server + "/jobs", "POST", options)
+    url = "{}/jobs/{}".format(server, status["id"])
+    bar = None
+    try:
+        while status["state"] in ("queued", "running"):
+            time.sleep(poll)
+            status = request(url)
+            if pbar and status["total"] is not None:
+                if bar is None:
+                    from tqdm import tqdm
+                    from . import patch_tqdm
+                    patch_tqdm(tqdm)
+                    bar = tqdm(total=status["total"], dynamic_ncols=True, desc="Rendering",
+                               bar_format="{l_bar}{bar}| ETA: {remaining}")
+                bar.update(status["done"] - bar.n)
+    except KeyboardInterrupt:
+        status = request(url, "DELETE")
+    finally:
+        if bar is not None:
+            bar.close()
+    return status
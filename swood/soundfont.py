@@ -6,8 +6,8 @@ from os.path import normpath, abspath, dirname, join
 from collections import defaultdict
 from enum import Enum
 
-from PIL.Image import BILINEAR
-from .sample import Sample
+from .resample import resample
+from .sample import Sample, is_wav
 from .instruments import *
 from . import complain
 import zipfile
@@ -58,10 +58,13 @@ class Instrument:
 class SoundFont:
     """Parses and holds information about .swood files."""
 
-    def __init__(self, filename, arguments, binsize=8192, pbar=True):
+    def __init__(self, filename, arguments, binsize=8192, pbar=True, memmap=False, cache=None, pitch_method="fft"):
         self.arguments = arguments
         self._binsize = binsize
         self.pbar = pbar
+        self.memmap = memmap
+        self.cache = cache
+        self.pitch_method = pitch_method
         self.load_instruments()
         self.samples = set()
         self.channels = {}
@@ -260,7 +263,10 @@ class SoundFont:
             loaded_samples[fn] = Sample(
                 self.wavpath(fn),
                 self._binsize,
-                pbar=self.pbar
+                pbar=self.pbar,
+                memmap=self.memmap,
+                cache=self.cache,
+                pitch_method=self.pitch_method
             )
         self.add_samples(loaded_samples)
 
@@ -270,7 +276,8 @@ class SoundFont:
             try:
                 with self.file.open(fn) as zipped_wav:
                     loaded_samples[fn] = Sample(
-                        zipped_wav, self._binsize, pbar=self.pbar)
+                        zipped_wav, self._binsize, pbar=self.pbar, memmap=self.memmap, cache=self.cache,
+                        pitch_method=self.pitch_method)
             except KeyError:  # file not found in zip
                 raise complain.ComplainToUser(
                     "Sample '{}' not found in config ZIP")
@@ -281,16 +288,20 @@ class SoundFont:
             for instrument in instruments:
                 if isinstance(instrument.sample, str):
                     real_instrument = loaded_samples[instrument.sample]
-                    real_instrument.fundamental_freq = instrument.pitch
+                    if instrument.pitch is not None:
+                        real_instrument._fundamental_freq = instrument.pitch
                     instrument.sample = real_instrument
         self.framerate = max(s.framerate for s in loaded_samples.values())
         self.channels = max(s.channels for s in loaded_samples.values())
         self.length = max(len(s) for s in loaded_samples.values())
         for samp in loaded_samples.values():
             multiplier = self.framerate / samp.framerate
-            samp._img = samp.img.resize(
-                (int(round(samp.img.size[0] * multiplier)), samp.channels),
-                resample=BILINEAR)
+            if multiplier != 1.0:
+                # find the pitch at the sample's own rate before it changes
+                samp.fundamental_freq
+                samp._scaled = resample(samp.scaled,
+                                        int(round(samp.scaled.shape[1] * multiplier)),
+                                        "linear")
             samp.framerate = self.framerate
         for instruments in self.instruments.values():
             for instrument in instruments:
@@ -320,3 +331,22 @@ def DefaultFont(samp):
         for instrument in instruments:
             instrument.sample = samp
     return sf
+
+
+def load(infile, arguments, binsize=8192, pbar=True, memmap=False, cache=None, pitch_method="fft"):
+    """Load a .swood file, or a sample on its own as a DefaultFont.
+
+    Any options a .swood file sets are put in arguments.
+    """
+    if is_wav(infile):
+        # load wav file natively
+        return DefaultFont(Sample(infile, binsize, pbar=pbar, memmap=memmap, cache=cache,
+                                  pitch_method=pitch_method))
+    elif isinstance(infile, str) and "." in infile and infile.split(".")[-1] in ("swood", "ini", "txt", ".soundfont"):
+        # it's a known soundfont extension, so load it as such
+        return SoundFont(infile, arguments, binsize=binsize, pbar=pbar, memmap=memmap, cache=cache,
+                         pitch_method=pitch_method)
+    else:
+        # use ffmpeg to convert to a supported format
+        return DefaultFont(Sample(infile, binsize, pbar=pbar, memmap=memmap, cache=cache,
+                                  pitch_method=pitch_method))
@@ -1,21 +1,141 @@
-from numpy import zeros, int32, fromfile, full, ndarray
+from concurrent.futures import ThreadPoolExecutor
+from numpy import zeros, int32, float32, float64, fromfile, full, ndarray, empty, abs as np_abs, rint, clip, iinfo
+from numpy import add, multiply
 from numpy import dtype as dtype_info
-from collections import defaultdict
+from collections import defaultdict, deque
 from . import complain
+from .profiling import timed, count
+import tempfile
 import mmap
 import wave
+import stat
 import sys
 import io
 import os
 
+# how many frames of the output each thread mixes at a time
+SLAB_SIZE = 32768
+# how much sound data to queue up before mixing it on multiple threads
+MIX_BATCH_BYTES = 2 ** 27
+# how many frames of a note to scale at a time before adding them to the output
+SCRATCH_SIZE = 65536
+# how many frames to convert from the float mix bus to the output at a time
+QUANTIZE_BLOCKSIZE = 2 ** 20
+# how loud the loudest sample in the output is, as a fraction of full scale
+PEAK_LEVEL = 0.9
+
+
+def peak(bus, blocksize=QUANTIZE_BLOCKSIZE):
+    """Find the loudest sample in a (channels, n) mix bus."""
+    loudest = 0.0
+    for start in range(0, bus.shape[-1], blocksize):
+        block = bus[..., start:start + blocksize]
+        if block.size:
+            loudest = max(loudest, float(np_abs(block).max()))
+    return loudest
+
+
+def output_gain(loudest, dtype, gain=None):
+    """Get the gain that brings the loudest sample to PEAK_LEVEL, unless a gain was given."""
+    if gain is not None:
+        return gain
+    if loudest == 0:
+        return 1.0
+    return PEAK_LEVEL * iinfo(dtype).max / loudest
+
+
+def quantize(bus, gain, dtype, out=None, blocksize=QUANTIZE_BLOCKSIZE):
+    """Multiply a float mix bus by gain, then round it and clip it to fit in dtype.
+
+    This is the only place the mix gets converted to integers, so notes are
+    only rounded once no matter how many are stacked on top of each other.
+    The conversion happens a block at a time, so out can be the same memory
+    as bus as long as their items are the same size.
+    """
+    limits = iinfo(dtype)
+    if out is None:
+        out = empty(bus.shape, dtype=dtype)
+    for start in range(0, bus.shape[-1], blocksize):
+        block = bus[..., start:start + blocksize].astype(float64)
+        block *= gain
+        rint(block, out=block)
+        clip(block, limits.min, limits.max, out=block)
+        out[..., start:start + blocksize] = block
+    return out
+
+
+def write_array(f, arr, counter="bytes written"):
+    """Write an array to a file in interleaved (frame-major) order, adding its size to a profiling counter."""
+    count(counter, arr.nbytes)
+    if "fileno" in vars(f):
+        arr.flatten(order="F").tofile(f)
+    else:
+        f.write(arr.flatten(order="F").tobytes())
+
+
+def split_slabs(start, length, slabsize):
+    """Split the output frames from start to start + length where slabs of slabsize frames begin.
+
+    Yields (slab index, offset into the data, offset into the slab, frames) for each piece.
+    """
+    offset = 0
+    while offset < length:
+        slab, slab_offset = divmod(start + offset, slabsize)
+        frames = min(length - offset, slabsize - slab_offset)
+        yield slab, offset, slab_offset, frames
+        offset += frames
+
+
+def mix_into(out, voice, gain, volume, scratch):
+    """Add voice * gain * volume to out in place, using scratch instead of allocating.
+
+    Args:
+        out: A slice of a float mix bus to add to.
+        voice: The same length of one channel of a (cached) note.
+        gain: How loud to play the note.
+        volume: How loud to play this channel of the note (for panning), or None.
+        scratch: A float64 buffer at least as long as out.
+    """
+    buf = scratch[:out.shape[0]]
+    multiply(voice, gain, out=buf)
+    if volume is not None:
+        buf *= volume
+    add(out, buf, out=out)
+
+
+def mix_slabs(threads, work, mix):
+    """Run mix() on each slab's list of work on its own thread.
+
+    Each slab only gets mixed by one thread, in the order its work was
+    queued, so the output is exactly the same as mixing the notes one at a
+    time. NumPy lets go of the GIL while adding, so this scales with cores.
+    """
+    with ThreadPoolExecutor(min(threads, len(work)) or 1) as pool:
+        # list() makes any exceptions from the threads get raised here
+        list(pool.map(mix, work.items()))
+
 
 class UncachedWavFile:
-    """Creates a single large array for the output and writes it to disk at the end."""
+    """Creates a single large array for the output and writes it to disk at the end.
+
+    Notes are mixed into a float32 bus, which gets multiplied by one gain,
+    clipped and rounded to dtype when it's saved. By default, the gain brings
+    the loudest sample up (or down) to PEAK_LEVEL of full scale.
+
+    With threads above 1, add_data queues notes up and mix_pending() mixes
+    them with each thread taking a different slab of time.
+    """
 
-    def __init__(self, length, filename, framerate, channels=1, dtype=int32):
-        self.channels = zeros((channels, length), dtype=dtype)
+    def __init__(self, length, filename, framerate, channels=1, dtype=int32, threads=1, gain=None):
+        self.bus = zeros((channels, length), dtype=float32)
+        self.dtype = dtype
+        self.gain = gain
         self.framerate = framerate
         self.filename = filename
+        self.threads = threads
+        self._queue = []
+        self._queued_bytes = 0
+        self._scratch = empty(SCRATCH_SIZE, dtype=float64)
 
     def add_data(self, start, data, cutoffs=None, volumes=None):
         """Add sound data at a specified position.
@@ -26,35 +146,109 @@ class UncachedWavFile:
             cutoffs: An array of integers that specifies where to cut off each channel. (optional)
             volumes: An array of floats to multiply each channel's data by. (optional)
         """
+        self.add_voice(start, data, cutoffs, 1.0, volumes)
+
+    @timed("add_voice")
+    def add_voice(self, start, voice, cutoffs=None, gain=1.0, volumes=None):
+        """Add a note at a specified position, scaling it on the way in.
+
+        This never changes or copies voice, so it can be a note straight from
+        the note cache. It's scaled a piece at a time in a reused buffer and
+        added to the output in place, so nothing gets allocated per note.
+
+        Args:
+            start: How many samples into the output the note should start.
+            voice: A (channels, n) array of the note to add to the output.
+            cutoffs: An array of integers that specifies where to cut off each channel. (optional)
+            gain: How much to multiply the whole note by.
+            volumes: An array of floats to multiply each channel by, for panning. (optional)
+        """
         if cutoffs is None:
-            cutoffs = full(self.channels.shape[0],
-                           data.shape[1], dtype=int32)
-        for chan in range(self.channels.shape[0]):
+            cutoffs = full(self.bus.shape[0],
+                           voice.shape[1], dtype=int32)
+        if self.threads > 1:
+            self._queue.append((start, voice, cutoffs, gain, volumes))
+            self._queued_bytes += voice.nbytes
+            if self._queued_bytes >= MIX_BATCH_BYTES:
+                self.mix_pending()
+            return
+        for chan, selectChan, length in self._lengths(start, voice, cutoffs):
+            self._add(chan, start, voice, selectChan, 0, length, gain, volumes, self._scratch)
+
+    def _lengths(self, start, data, cutoffs):
+        """Get which data channel goes to each output channel and how much of it to add."""
+        for chan in range(self.bus.shape[0]):
             selectChan = min(chan, data.shape[0])
-            length = min(self.channels.shape[1] - start,
+            length = min(self.bus.shape[1] - start,
                          cutoffs[selectChan],
                          data.shape[1])
-            if volumes is None:
-                self.channels[chan][start:start + length] += \
-                    data[selectChan][:length].astype(self.channels.dtype)
-            else:
-                self.channels[chan][start:start + length] += \
-                    data[selectChan][:length].astype(self.channels.dtype) * \
-                    volumes[selectChan]
-
+            if length > 0:
+                yield chan, selectChan, length
+
+    def _add(self, chan, start, voice, selectChan, offset, length, gain, volumes, scratch):
+        """Add length frames of one channel of a note (from offset) to the output at start."""
+        volume = None if volumes is None else volumes[selectChan]
+        out = self.bus[chan]
+        row = voice[selectChan]
+        for done in range(0, length, len(scratch)):
+            frames = min(len(scratch), length - done)
+            mix_into(out[start + done:start + done + frames],
+                     row[offset + done:offset + done + frames], gain, volume, scratch)
+
+    @timed("mix")
+    def mix_pending(self):
+        """Mix every queued note into the output on multiple threads."""
+        if not self._queue:
+            return
+        work = defaultdict(list)
+        for start, voice, cutoffs, gain, volumes in self._queue:
+            for chan, selectChan, length in self._lengths(start, voice, cutoffs):
+                for slab, offset, _, frames in split_slabs(start, length, SLAB_SIZE):
+                    work[slab].append((chan, start + offset, voice, selectChan, offset, frames, gain, volumes))
+        self._queue = []
+        self._queued_bytes = 0
+
+        def mix(item):
+            # each thread gets its own buffer
+            scratch = empty(SLAB_SIZE, dtype=float64)
+            for args in item[1]:
+                self._add(*args, scratch)
+        mix_slabs(self.threads, work, mix)
+
+    @property
+    def peak(self):
+        """The loudest sample mixed so far, before the output gain."""
+        return peak(self.bus)
+
+    def output_gain(self):
+        """Get the gain the mix bus will be multiplied by when it's saved."""
+        return output_gain(self.peak, self.dtype, self.gain)
+
+    def result(self):
+        """Mix any queued notes and return the output as an array of dtype."""
+        self.mix_pending()
+        return quantize(self.bus, self.output_gain(), self.dtype)
+
+    @timed("save")
     def save(self):
         """Write the output array to the file."""
+        self.mix_pending()
+        gain = self.output_gain()
         try:
             # open the file manually to catch I/O exceptions
             # as IOError instead of wave.Error
             with (open(self.filename, "wb") if isinstance(self.filename, str) else self.filename) as wavfile:
                 with wave.open(wavfile, "w") as wav:
-                    wav.setparams((self.channels.shape[0],  # channels
-                                   self.channels.dtype.itemsize,  # sample width
+                    wav.setparams((self.bus.shape[0],  # channels
+                                   dtype_info(self.dtype).itemsize,  # sample width
                                    self.framerate,  # sample rate
-                                   self.channels.shape[1],  # number of frames
+                                   self.bus.shape[1],  # number of frames
                                    "NONE", "not compressed"))  # compression type (none are supported)
-                    wav.writeframesraw(self.channels.flatten(order="F"))
+                    for start in range(0, self.bus.shape[1], QUANTIZE_BLOCKSIZE):
+                        block = self.bus[:, start:start + QUANTIZE_BLOCKSIZE]
+                        data = quantize(block, gain, self.dtype)
+                        count("bytes written", data.nbytes)
+                        wav.writeframesraw(data.flatten(order="F"))
         except IOError:
             raise complain.ComplainToUser(
                 "Can't save output file '{}'.".format(self.filename))
@@ -70,7 +264,33 @@ class UncachedWavFile:
         return False
 
 
-def CachedWavFile(length, filename, framerate, channels=1, dtype=int32):
+class SegmentWavFile(UncachedWavFile):
+    """Mixes only the frames from offset to offset + length of the output, for rendering it in segments.
+
+    Notes are still added at their place in the whole output, and only the
+    part of each one inside the segment gets mixed in. Every frame gets the
+    same notes added in the same order as it would in the whole output, so
+    the segments of an output joined back together are exactly the same mix.
+    """
+
+    def __init__(self, offset, length, framerate, channels=1, dtype=int32, gain=None):
+        super().__init__(length, None, framerate, channels, dtype, gain=gain)
+        self.offset = offset
+
+    @timed("add_voice")
+    def add_voice(self, start, voice, cutoffs=None, gain=1.0, volumes=None):
+        if cutoffs is None:
+            cutoffs = full(self.bus.shape[0],
+                           voice.shape[1], dtype=int32)
+        start -= self.offset
+        # skip whatever part of the note comes before the segment
+        skip = max(0, -start)
+        for chan, selectChan, length in self._lengths(start, voice, cutoffs):
+            if length > skip:
+                self._add(chan, start + skip, voice, selectChan, skip, length - skip, gain, volumes, self._scratch)
+
+
+def CachedWavFile(length, filename, framerate, channels=1, dtype=int32, threads=1, gain=None):
     """Automatically creates the best of MemMapWavFile, ChunkedWavFile, and StreamingWavFile for the specified input."""
 
     if isinstance(filename, str) or "seek" in vars(filename):
@@ -83,24 +303,30 @@ def CachedWavFile(length, filename, framerate, channels=1, dtype=int32):
         try:
             import ctypes
             if ctypes.windll.shell32.IsUserAnAdmin() == 0:
-                return chunked(length, filename, framerate, channels=channels, dtype=dtype)
+                return chunked(length, filename, framerate, channels=channels, dtype=dtype, threads=threads, gain=gain)
         except:
             pass
     try:
-        return MemMapWavFile(length, filename, framerate, channels=channels, dtype=dtype)
+        return MemMapWavFile(length, filename, framerate, channels=channels, dtype=dtype, threads=threads, gain=gain)
     except PermissionError:
-        return chunked(length, filename, framerate, channels=channels, dtype=dtype)
+        return chunked(length, filename, framerate, channels=channels, dtype=dtype, threads=threads, gain=gain)
     except Exception as e:
         # Probably has more obscure errors here so just ignore them
-        return chunked(length, filename, framerate, channels=channels, dtype=dtype)
+        return chunked(length, filename, framerate, channels=channels, dtype=dtype, threads=threads, gain=gain)
 
 
 class MemMapWavFile(UncachedWavFile):
     """Uses memory mapped arrays to easily cache WAV files."""
 
-    def __init__(self, length, filename, framerate, channels=1, dtype=int32):
+    def __init__(self, length, filename, framerate, channels=1, dtype=int32, threads=1, gain=None):
         # this was so much simpler to write than ChunkedWavFile
         # really wish i learned about memmap before writing it
+        if dtype_info(dtype).itemsize != dtype_info(float32).itemsize:
+            # the float mix bus gets converted in place, so it has to be the same size
+            raise ValueError("MemMapWavFile only supports 32-bit output.")
+        if not isinstance(filename, str) and not stat.S_ISREG(os.fstat(filename.fileno()).st_mode):
+            # check before writing anything, so another writer can start from scratch
+            raise ValueError("Only files on disk can be memory-mapped.")
         if isinstance(filename, str):
             self.wavfile = open(filename, "wb+")
             self._auto_close = True
@@ -108,24 +334,45 @@ class MemMapWavFile(UncachedWavFile):
             self.wavfile = filename
             self._auto_close = False
 
-        wav = wave.Wave_write(None)
-        wav.close = lambda: None
-        wav.initfp(self.wavfile)
-        wav.setparams((channels, dtype_info(dtype).itemsize,
-                       framerate, length, "NONE", "not compressed"))
-        wav._write_header(length)
-        del wav
-        self.wavfile.flush()
-        self.wav_memmap = mmap.mmap(self.wavfile.fileno(),
-                                    length * dtype_info(dtype).itemsize,
-                                    access=mmap.ACCESS_WRITE)
-        self.channels = ndarray((channels, length), dtype,
-                                self.wav_memmap, self.wavfile.tell(), order="F")
+        try:
+            wav = wave.Wave_write(None)
+            wav.close = lambda: None
+            wav.initfp(self.wavfile)
+            wav.setparams((channels, dtype_info(dtype).itemsize,
+                           framerate, length, "NONE", "not compressed"))
+            wav._write_header(length)
+            del wav
+            self.wavfile.flush()
+            self._data_offset = self.wavfile.tell()
+            # make the file as big as the whole output so all of it can be mapped
+            size = self._data_offset + channels * length * dtype_info(dtype).itemsize
+            self.wavfile.truncate(size)
+            # mmap offsets have to be page-aligned, so map from the start and skip the header in the array
+            self.wav_memmap = mmap.mmap(self.wavfile.fileno(), size, access=mmap.ACCESS_WRITE)
+        except Exception:
+            if self._auto_close:
+                self.wavfile.close()
+            raise
+        self.bus = ndarray((channels, length), float32,
+                           self.wav_memmap, self._data_offset, order="F")
+        self.dtype = dtype
+        self.gain = gain
         self.framerate = framerate
         self.filename = filename
+        self.threads = threads
+        self._queue = []
+        self._queued_bytes = 0
+        self._scratch = empty(SCRATCH_SIZE, dtype=float64)
 
+    @timed("save")
     def save(self):
-        del self.wav_mmap  # the way to close a memmap is to delete it
+        self.mix_pending()
+        output = ndarray(self.bus.shape, self.dtype, self.wav_memmap,
+                         self._data_offset, order="F")
+        quantize(self.bus, self.output_gain(), self.dtype, out=output)
+        count("bytes written", output.nbytes)
+        del output, self.bus
+        self.wav_memmap.close()
         if self._auto_close:
             self.wavfile.close()
 
@@ -149,22 +396,47 @@ class defaultdictkey(defaultdict):
 
 
 class ChunkedWavFile:
-    """Uses chunks of data to efficiently write a WAV file to disk without storing a large array."""
+    """Uses chunks of data to efficiently write a WAV file to disk without storing a large array.
+
+    Notes are mixed into float32 chunks. If a gain is given, each finished
+    chunk is converted to dtype and written right away. Otherwise the loudest
+    sample isn't known until the end, so finished chunks go to a temporary
+    file and are converted and written out all at once when the file is saved.
+    """
 
-    def __init__(self, length, filename, framerate, channels=1, dtype=int32, chunksize=32768):
+    def __init__(self, length, filename, framerate, channels=1, dtype=int32, chunksize=32768, threads=1,
+                 gain=None):
         # 32768 chunk size holds ~1/6 second at 192khz
         # and ~0.75 seconds at 44.1khz (cd quality)
+        self.length = length
         self.framerate = framerate
         self.channels = channels
         self.chunksize = chunksize
 
+        # with more than one thread, notes are queued and each chunk is mixed on its own thread
+        self.threads = threads
+        self._queue = []
+        self._queued_bytes = 0
+
         self.dtype = dtype
         self.itemsize = dtype_info(self.dtype).itemsize
         self.chunkspacing = self.channels * self.chunksize * self.itemsize
 
+        self.gain = gain
+        self.peak = 0.0
+        self._scratch = empty(chunksize, dtype=float64)
+        if gain is None:
+            self.spill = tempfile.TemporaryFile()
+            self.spillspacing = self.channels * self.chunksize * dtype_info(float32).itemsize
+        else:
+            self.spill = None
+
         self.saved_to_disk = set()
         self.chunks = defaultdictkey(self._create_chunk)
 
+        if filename is None:
+            # a subclass does something else with the finished chunks
+            return
         if isinstance(filename, str):
             self.wavfile = open(filename, "wb+")
             self._auto_close = True
@@ -190,29 +462,51 @@ class ChunkedWavFile:
         if key in self.saved_to_disk:
             return self._load_chunk(key)
         else:
-            return zeros((self.channels, self.chunksize), dtype=self.dtype)
+            return zeros((self.channels, self.chunksize), dtype=float32)
 
     def _load_chunk(self, idx):
         """Load a chunk from disk into the cache."""
-        raise NotImplementedError()  # not needed for linear writes and it's broken
+        if self.spill is None:
+            # not needed for linear writes, and the chunk has already been rounded
+            raise NotImplementedError()
         self.saved_to_disk.discard(idx)
-        self.wavfile.seek(self._header_length + (self.chunkspacing * idx))
-        raw_data = fromfile(self.wavfile, dtype=self.dtype,
+        self.spill.seek(self.spillspacing * idx)
+        raw_data = fromfile(self.spill, dtype=float32,
                             count=self.channels * self.chunksize)
+        count("spill bytes read", raw_data.nbytes)
         return raw_data.reshape((self.channels, self.chunksize), order="F")
 
+    def _read_spilled(self, idx):
+        """Read a chunk that was saved to the temporary file (or zeros if it never was)."""
+        if idx not in self.saved_to_disk:
+            return zeros((self.channels, self.chunksize), dtype=float32)
+        self.spill.seek(self.spillspacing * idx)
+        raw_data = fromfile(self.spill, dtype=float32,
+                            count=self.channels * self.chunksize)
+        count("spill bytes read", raw_data.nbytes)
+        return raw_data.reshape((self.channels, self.chunksize), order="F")
+
+    def _finish_chunk(self, chunk):
+        """Keep track of the loudest sample in a finished chunk, then convert it if the gain is known."""
+        self.peak = max(self.peak, peak(chunk))
+        if self.spill is None:
+            return quantize(chunk, self.gain, self.dtype)
+        return chunk
+
     def _save_chunk(self, idx):
         """Write a chunk to disk and remove it from the cache."""
-        self.wavfile.seek(self._header_length + (self.chunkspacing * idx))
-
-        if "fileno" in vars(self.wavfile):
-            self.chunks[idx].flatten(order="F").tofile(self.wavfile)
+        chunk = self._finish_chunk(self.chunks[idx])
+        if self.spill is None:
+            self.wavfile.seek(self._header_length + (self.chunkspacing * idx))
+            write_array(self.wavfile, chunk)
         else:
-            self.wavfile.write(self.chunks[idx].flatten(order="F").tobytes())
+            self.spill.seek(self.spillspacing * idx)
+            write_array(self.spill, chunk, "spill bytes written")
 
         self.saved_to_disk.add(idx)
         del self.chunks[idx]
 
+    @timed("flush chunks")
     def flush_cache(self, to_idx=None):
         """Save all (or all up to a certain index) chunks in memory to disk and remove them fron the cache."""
         # we should still sort the keys even though it's theoretically not needed
@@ -247,50 +541,128 @@ class ChunkedWavFile:
             cutoffs: An array of integers that specifies where to cut off each channel. (optional)
             volumes: An array of floats to multiply each channel's data by. (optional)
         """
-        if cutoffs is None:
-            cutoffs = full(self.channels, data.shape[1], dtype=int32)
+        self.add_voice(start, data, cutoffs, 1.0, volumes)
 
-        if volumes is not None:
-            for chan in range(data.shape[0]):
-                data[chan] *= volumes[chan]
+    @timed("add_voice")
+    def add_voice(self, start, voice, cutoffs=None, gain=1.0, volumes=None):
+        """Add a note at a specified position, scaling it on the way in.
 
-        data = data.astype(self.dtype)
+        This never changes or copies voice, so it can be a note straight from
+        the note cache. Each piece of it is scaled in a reused buffer and added
+        to its chunk in place, so nothing gets allocated per note.
 
+        Args:
+            start: How many samples into the output the note should start.
+            voice: A (channels, n) array of the note to add to the output.
+            cutoffs: An array of integers that specifies where to cut off each channel. (optional)
+            gain: How much to multiply the whole note by.
+            volumes: An array of floats to multiply each channel by, for panning. (optional)
+        """
+        if cutoffs is None:
+            cutoffs = full(self.channels, voice.shape[1], dtype=int32)
+
+        if self.threads > 1:
+            self._queue.append((start, voice, cutoffs, gain, volumes))
+            self._queued_bytes += voice.nbytes
+            if self._queued_bytes >= MIX_BATCH_BYTES:
+                self.mix_pending()
+            return
+
+        chunks = self.chunks
+        scratch = self._scratch
+        for idx, chan, chunk_offset, selectChan, offset, frames in self._pieces(start, voice, cutoffs):
+            mix_into(chunks[idx][chan][chunk_offset:chunk_offset + frames],
+                     voice[selectChan][offset:offset + frames], gain,
+                     None if volumes is None else volumes[selectChan], scratch)
+        self.flush_cache(start // self.chunksize)
+
+    def _pieces(self, start, voice, cutoffs):
+        """Split a note into the pieces that go in each chunk, making any chunks it needs.
+
+        Yields (chunk index, output channel, offset into the chunk, voice
+        channel, offset into the voice, frames) for each piece.
+        """
         chunksize = self.chunksize
-        chunk_start = start // chunksize
-        chunk_offset = start - (chunk_start * chunksize)
+        chunks = self.chunks
+        chunk_start, chunk_offset = divmod(start, chunksize)
         for chan in range(self.channels):
-            selectChan = min(chan, data.shape[0])
-            current_chunk = chunk_start
-            cutoff = min(cutoffs[selectChan], len(data[selectChan]))
+            selectChan = min(chan, voice.shape[0])
+            cutoff = min(cutoffs[selectChan], len(voice[selectChan]))
+            # make the chunks here so threads don't have to (and make the same
+            # ones as always, since they all get written out)
             if cutoff + chunk_offset <= chunksize:
-                self.chunks[current_chunk][chan][chunk_offset:chunk_offset + cutoff] += \
-                    data[selectChan][:cutoff]
+                last_chunk = chunk_start
             else:
-                self.chunks[current_chunk][chan][chunk_offset:] += \
-                    data[selectChan][:chunksize -
-                                     chunk_offset]
-                bytes_remaining = cutoff - chunksize + chunk_offset
-                current_chunk += 1
-                while bytes_remaining >= chunksize:
-                    self.chunks[current_chunk][chan] += \
-                        data[selectChan][
-                            cutoff - bytes_remaining:cutoff - bytes_remaining + chunksize]
-                    current_chunk += 1
-                    bytes_remaining -= chunksize
-                self.chunks[current_chunk][chan][:bytes_remaining] += \
-                    data[selectChan][cutoff - bytes_remaining:cutoff]
-        self.flush_cache(chunk_start)
-
+                last_chunk = chunk_start + (cutoff + chunk_offset) // chunksize
+            for idx in range(chunk_start, last_chunk + 1):
+                chunks[idx]
+            for idx, offset, slab_offset, frames in split_slabs(start, cutoff, chunksize):
+                yield idx, chan, slab_offset, selectChan, offset, frames
+
+    @timed("mix")
+    def mix_pending(self):
+        """Mix every queued note into the chunks with a thread per chunk, then flush the finished ones."""
+        if not self._queue:
+            return
+        work = defaultdict(list)
+        for start, voice, cutoffs, gain, volumes in self._queue:
+            for idx, chan, chunk_offset, selectChan, offset, frames in self._pieces(start, voice, cutoffs):
+                volume = None if volumes is None else volumes[selectChan]
+                work[idx].append((chan, chunk_offset, voice[selectChan], offset, frames, gain, volume))
+        last_start = self._queue[-1][0]
+        self._queue = []
+        self._queued_bytes = 0
+        chunks = self.chunks
+
+        def mix(item):
+            chunk = chunks[item[0]]
+            # each thread gets its own buffer
+            scratch = empty(self.chunksize, dtype=float64)
+            for chan, chunk_offset, row, offset, frames, gain, volume in item[1]:
+                mix_into(chunk[chan][chunk_offset:chunk_offset + frames],
+                         row[offset:offset + frames], gain, volume, scratch)
+        mix_slabs(self.threads, work, mix)
+        # notes come in order, so nothing will be added before the last one
+        self.flush_cache(last_start // self.chunksize)
+
+    def output_gain(self):
+        """Get the gain the mix bus gets multiplied by (only known for sure once everything's mixed)."""
+        return output_gain(self.peak, self.dtype, self.gain)
+
+    @property
+    def chunkcount(self):
+        """How many chunks it takes to hold the whole output."""
+        return -(-self.length // self.chunksize)
+
+    def _trim(self, idx, chunk):
+        """Cut off the part of a chunk past the end of the output."""
+        return chunk[:, :max(0, self.length - idx * self.chunksize)]
+
+    def write_spilled(self):
+        """Convert every chunk in the temporary file with the final gain and write them to the WAV file."""
+        gain = self.output_gain()
+        self.wavfile.seek(self._header_length)
+        for idx in range(self.chunkcount):
+            write_array(self.wavfile, quantize(self._trim(idx, self._read_spilled(idx)), gain, self.dtype))
+        self.spill.close()
+
+    @timed("save")
     def save(self):
         """Flush the cache of chunks to disk, patch the WAV header with the new length, and close the file."""
+        self.mix_pending()
         self.flush_cache()
-        self.fill_empty_chunks()
-        try:
-            self.wav._datawritten = (
-                max(self.saved_to_disk) + 1) * self.chunkspacing
-        except ValueError:
-            self.wav._datawritten = 0
+        if self.spill is None:
+            if self.length > 0 and self.chunkcount - 1 not in self.saved_to_disk:
+                # make sure the silence at the end gets written too
+                self._save_chunk(self.chunkcount - 1)
+            self.fill_empty_chunks()
+        else:
+            self.write_spilled()
+        # the last chunk can run past the end of the output
+        datasize = self.length * self.channels * self.itemsize
+        if hasattr(self.wavfile, "truncate"):
+            self.wavfile.truncate(self._header_length + datasize)
+        self.wav._datawritten = datasize
         self.wav._patchheader()
         if self._auto_close:
             self.wavfile.close()
@@ -307,28 +679,98 @@ class ChunkedWavFile:
 
 
 class StreamingWavFile(ChunkedWavFile):
+    """Writes a WAV file to something that can't seek, like stdout.
+
+    Without a gain, nothing can be written until the loudest sample is known,
+    so chunks are kept in the temporary file until the end.
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.last_written_chunk = 0
         del self.wav
 
+    @timed("save")
     def save(self):
-        self.flush_cache()
+        self.mix_pending()
+        self.flush_cache(self.chunkcount)
+        if self.spill is not None:
+            gain = self.output_gain()
+            self.spill.seek(0)
+            for idx in range(min(self.last_written_chunk, self.chunkcount)):
+                raw_data = fromfile(self.spill, dtype=float32,
+                                    count=self.channels * self.chunksize)
+                count("spill bytes read", raw_data.nbytes)
+                chunk = raw_data.reshape((self.channels, self.chunksize), order="F")
+                write_array(self.wavfile, quantize(self._trim(idx, chunk), gain, self.dtype))
+            self.spill.close()
         if self._auto_close:
             self.wavfile.close()
 
+    @timed("flush chunks")
     def flush_cache(self, to_idx=None):
         if to_idx is None:
-            to_idx = max(self.chunks.keys()) + 1
+            to_idx = max(self.chunks.keys(), default=self.last_written_chunk - 1) + 1
         for idx in range(self.last_written_chunk, to_idx):
             # because self.chunks is a defaultdict (technically defaultdictkey)
             # it automatically creates chunks full of zeros when one is missing
             # print("writing chunk {}".format(idx), file=sys.stderr)
-            if "fileno" in vars(self.wavfile):
-                self.chunks[idx].flatten(order="F").tofile(self.wavfile)
+            chunk = self._finish_chunk(self.chunks[idx])
+            if self.spill is None:
+                # the header promised exactly self.length frames
+                write_array(self.wavfile, self._trim(idx, chunk))
             else:
-                self.wavfile.write(
-                    self.chunks[idx].flatten(order="F").tobytes())
+                write_array(self.spill, chunk, "spill bytes written")
+            del self.chunks[idx]
+        self.last_written_chunk = max(to_idx, self.last_written_chunk)
+
+
+class BlockStream(ChunkedWavFile):
+    """Hands out each chunk of the output as soon as no later note can touch it, instead of writing a file.
+
+    Notes have to be added in order of when they start, just like with
+    StreamingWavFile, and only the chunks that are still being mixed are kept
+    in memory. The loudest sample can't be known before handing chunks out,
+    so the gain has to be given up front.
+
+    Args:
+        length: How many frames long the output is. The last block is cut short
+        to fit, and anything past the end is dropped.
+        gain: What to multiply the mix bus by before converting it to dtype.
+    """
+
+    def __init__(self, length, framerate, channels=1, dtype=int32, chunksize=32768, threads=1, gain=1.0):
+        if gain is None:
+            raise ValueError("BlockStream needs a gain, since it can't wait for the loudest sample.")
+        super().__init__(length, None, framerate, channels, dtype, chunksize, threads, gain)
+        self.next_chunk = 0
+        self.finished = deque()
+
+    @timed("flush chunks")
+    def flush_cache(self, to_idx=None):
+        """Finish every chunk before to_idx (or every chunk) and queue them up to be handed out."""
+        if to_idx is None:
+            to_idx = max(self.chunks.keys(), default=self.next_chunk - 1) + 1
+        to_idx = min(to_idx, self.chunkcount)
+        for idx in range(self.next_chunk, to_idx):
+            # chunks that were never touched are made here full of zeros
+            chunk = self._finish_chunk(self.chunks[idx])
             del self.chunks[idx]
-        self.last_written_chunk = to_idx
+            self.finished.append(self._trim(idx, chunk))
+        self.next_chunk = max(to_idx, self.next_chunk)
+
+    def blocks(self):
+        """Yield the finished chunks that haven't been handed out yet, in order."""
+        finished = self.finished
+        while finished:
+            yield finished.popleft()
+
+    @timed("save")
+    def save(self):
+        """Mix any queued notes and finish every chunk up to the end of the output."""
+        self.mix_pending()
+        self.flush_cache(self.chunkcount)
+        self.chunks.clear()
+
+    def close(self):
+        self.save()
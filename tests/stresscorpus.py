@@ -0,0 +1,245 @@
+#!/usr/local/bin/python
+"""Generates MIDIs and samples far bigger than the test fixtures, for stress-testing and benchmarking swood.
+
+Everything is made from a seeded random generator, so the same options
+always make byte-for-byte the same files and nothing big has to be checked in.
+
+    python stresscorpus.py midi black.mid --density 2000 --duration 600
+    python stresscorpus.py wav hires.wav --framerate 96000 --channels 6
+    python stresscorpus.py corpus corpus/ --preset black --preset hires
+"""
+import argparse
+import wave
+import sys
+import os
+
+import numpy
+import mido
+
+TICKS_PER_BEAT = 480
+# mido's default tempo of 120 BPM
+TEMPO = 500000
+TICKS_PER_SECOND = TICKS_PER_BEAT * 1000000 // TEMPO
+# swood plays notes on this channel as percussion (see MIDIParser)
+PERCUSSION_CHANNEL = 10
+# how many frames of a sample to make at once
+BLOCKSIZE = 1 << 18
+
+
+def note_times(random, count, duration, polyphony, min_length, max_length):
+    """Make count (start, end) times in seconds with no more than polyphony notes playing at once.
+
+    The notes are dealt out to polyphony voices in order of when they start,
+    and each voice cuts its note short when its next one starts.
+    """
+    starts = numpy.sort(random.uniform(0, duration, count))
+    ends = starts + random.uniform(min_length, max_length, count)
+    # a voice's next note is polyphony notes later
+    if count > polyphony:
+        numpy.minimum(ends[:-polyphony], starts[polyphony:], out=ends[:-polyphony])
+    return starts, numpy.minimum(ends, duration)
+
+
+def channel_track(random, channel, count, duration, polyphony, pitch, spread, velocity,
+                  min_length, max_length, program_changes):
+    """Make a MIDI track of count notes (and program changes) on one channel."""
+    starts, ends = note_times(random, count, duration, polyphony, min_length, max_length)
+    start_ticks = numpy.round(starts * TICKS_PER_SECOND).astype(numpy.int64)
+    # every note lasts at least a tick, so its note_off comes after its note_on
+    end_ticks = numpy.maximum(numpy.round(ends * TICKS_PER_SECOND).astype(numpy.int64), start_ticks + 1)
+    pitches = numpy.clip(random.randint(pitch - spread, pitch + spread + 1, count), 0, 127)
+    velocities = random.randint(velocity[0], velocity[1] + 1, count)
+
+    # (tick, kind, note, velocity) for every event, with kind 0 for program changes,
+    # 1 for note_off and 2 for note_on so a note ends before another starts on the same tick
+    change_ticks = numpy.linspace(0, duration * TICKS_PER_SECOND, program_changes, endpoint=False).astype(numpy.int64)
+    programs = random.randint(0, 128, program_changes)
+    ticks = numpy.concatenate((change_ticks, end_ticks, start_ticks))
+    kinds = numpy.concatenate((numpy.zeros(program_changes, numpy.int64), numpy.ones(count, numpy.int64),
+                               numpy.full(count, 2, numpy.int64)))
+    values = numpy.concatenate((programs, pitches, pitches))
+    velocities = numpy.concatenate((numpy.zeros(program_changes, numpy.int64), numpy.zeros(count, numpy.int64),
+                                    velocities))
+    order = numpy.lexsort((kinds, ticks))
+    deltas = numpy.diff(ticks[order], prepend=0)
+
+    track = mido.MidiTrack()
+    for delta, kind, value, vel in zip(deltas.tolist(), kinds[order].tolist(), values[order].tolist(),
+                                       velocities[order].tolist()):
+        if kind == 0:
+            track.append(mido.Message("program_change", channel=channel, program=value, time=delta))
+        elif kind == 1:
+            track.append(mido.Message("note_off", channel=channel, note=value, velocity=0, time=delta))
+        else:
+            track.append(mido.Message("note_on", channel=channel, note=value, velocity=vel, time=delta))
+    return track
+
+
+def write_midi(filename, duration=60.0, density=100.0, polyphony=8, channels=16, pitch=60, spread=24,
+               velocity=(32, 127), min_length=0.05, max_length=1.0, program_changes=0, percussion=False,
+               seed=0):
+    """Write a random MIDI file, returning how many notes it has.
+
+    Args:
+        filename: Where to save the MIDI.
+        duration: How many seconds long it is.
+        density: How many notes start each second, over every channel.
+        polyphony: The most notes that play at once on each channel.
+        channels: How many channels (each on its own track) to spread the notes over.
+        pitch: The MIDI note number notes are centered on.
+        spread: How many semitones above or below pitch notes can be.
+        velocity: The quietest and loudest velocity notes can have.
+        min_length: The shortest a note can be, in seconds (unless the next note on its voice cuts it short).
+        max_length: The longest a note can be, in seconds.
+        program_changes: How many times each channel picks a random instrument, starting at 0 seconds.
+        percussion: Play notes on the percussion channel too (only for soundfonts with percussion).
+        seed: What to seed the random generator with.
+    """
+    if not 1 <= channels <= 16:
+        raise ValueError("A MIDI file has between 1 and 16 channels.")
+    random = numpy.random.RandomState(seed)
+    usable = [channel for channel in range(16) if percussion or channel != PERCUSSION_CHANNEL][:channels]
+    total = int(round(duration * density))
+    counts = [len(part) for part in numpy.array_split(numpy.arange(total), len(usable))]
+
+    mid = mido.MidiFile(type=1, ticks_per_beat=TICKS_PER_BEAT)
+    tempo = mido.MidiTrack()
+    tempo.append(mido.MetaMessage("set_tempo", tempo=TEMPO, time=0))
+    mid.tracks.append(tempo)
+    for channel, count in zip(usable, counts):
+        mid.tracks.append(channel_track(random, channel, count, duration, polyphony, pitch, spread, velocity,
+                                        min_length, max_length, program_changes))
+    mid.save(filename)
+    return total
+
+
+def write_sample(filename, duration=1.0, framerate=44100, channels=2, sampwidth=2, frequency=440.0,
+                 harmonics=6, decay=3.0, noise=0.01, seed=0):
+    """Write a WAV sample of a decaying tone with harmonics, a block at a time.
+
+    Each channel has its harmonics at slightly different phases and its own
+    noise, so channels aren't identical. The fundamental is frequency, so
+    pitch detection has something to find.
+
+    Args:
+        filename: Where to save the WAV file.
+        duration: How many seconds long it is.
+        framerate: How many frames per second (like 96000).
+        channels: How many channels it has.
+        sampwidth: How many bytes each sample is (1, 2, 3 or 4).
+        frequency: The fundamental frequency of the tone, in Hz.
+        harmonics: How many harmonics (including the fundamental) the tone has.
+        decay: How many times over the tone fades by a factor of e in a second.
+        noise: How loud the noise under the tone is, compared to full scale.
+        seed: What to seed the random generator with.
+    """
+    if sampwidth not in (1, 2, 3, 4):
+        raise ValueError("The sample width has to be 1, 2, 3 or 4 bytes.")
+    random = numpy.random.RandomState(seed)
+    length = int(round(duration * framerate))
+    phases = random.uniform(0, 2 * numpy.pi, (channels, harmonics, 1))
+    multiples = numpy.arange(1, harmonics + 1)[:, numpy.newaxis]
+    # the harmonics get quieter as they go up, and add up to at most 1
+    weights = 1.0 / multiples
+    weights *= (1 - noise) / weights.sum()
+    full_scale = 2 ** (8 * sampwidth - 1) - 1
+
+    with wave.open(filename, "wb") as wav:
+        wav.setparams((channels, sampwidth, framerate, length, "NONE", "not compressed"))
+        for start in range(0, length, BLOCKSIZE):
+            times = numpy.arange(start, min(start + BLOCKSIZE, length)) / framerate
+            tone = (numpy.sin(2 * numpy.pi * frequency * multiples * times + phases) * weights).sum(axis=1)
+            tone *= numpy.exp(-decay * times)
+            tone += random.uniform(-noise, noise, tone.shape)
+            pcm = numpy.round(tone * full_scale).astype(numpy.int32)
+            if sampwidth == 1:
+                # 8-bit WAV files are unsigned
+                data = (pcm + 128).astype(numpy.uint8).T.tobytes()
+            elif sampwidth == 3:
+                data = numpy.ascontiguousarray(pcm.T, "<i4").view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+            else:
+                data = pcm.T.astype("<i{}".format(sampwidth)).tobytes()
+            wav.writeframesraw(data)
+
+
+# the kinds of input swood has trouble with, by name
+PRESETS = {
+    # a "black MIDI": a million notes in ten minutes
+    "black": ("midi", {"duration": 600, "density": 1700, "polyphony": 32, "spread": 40}),
+    # every channel changing instruments
+    "programs": ("midi", {"duration": 120, "density": 200, "program_changes": 24}),
+    # an hour of fairly sparse music
+    "long": ("midi", {"duration": 3600, "density": 10, "polyphony": 4, "max_length": 4.0}),
+    # a long 96 kHz surround sample
+    "hires": ("wav", {"duration": 20, "framerate": 96000, "channels": 6, "sampwidth": 3}),
+    # the kind of sample swood is usually given
+    "plain": ("wav", {"duration": 1, "framerate": 44100, "channels": 2, "sampwidth": 2}),
+}
+
+
+def write_corpus(directory, presets=sorted(PRESETS), seed=0):
+    """Write a file for each preset into a directory, returning their paths by preset name."""
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for name in presets:
+        kind, options = PRESETS[name]
+        path = os.path.join(directory, "{}.{}".format(name, "mid" if kind == "midi" else "wav"))
+        if kind == "midi":
+            write_midi(path, seed=seed, **options)
+        else:
+            write_sample(path, seed=seed, **options)
+        paths[name] = path
+    return paths
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="generate MIDIs and samples for stress-testing swood")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    midi = commands.add_parser("midi", help="write a random MIDI")
+    midi.add_argument("output")
+    midi.add_argument("--duration", type=float, default=60.0, help="how many seconds long it is")
+    midi.add_argument("--density", type=float, default=100.0, help="how many notes start each second")
+    midi.add_argument("--polyphony", type=int, default=8, help="the most notes at once on each channel")
+    midi.add_argument("--channels", type=int, default=16, help="how many channels to use")
+    midi.add_argument("--pitch", type=int, default=60, help="the note number notes are centered on")
+    midi.add_argument("--spread", type=int, default=24, help="how many semitones notes can be from --pitch")
+    midi.add_argument("--min-length", type=float, default=0.05, help="the shortest a note can be, in seconds")
+    midi.add_argument("--max-length", type=float, default=1.0, help="the longest a note can be, in seconds")
+    midi.add_argument("--program-changes", type=int, default=0, help="how many instruments each channel plays")
+    midi.add_argument("--percussion", action="store_true", help="use the percussion channel too")
+    midi.add_argument("--seed", type=int, default=0)
+
+    wav = commands.add_parser("wav", help="write a synthetic sample")
+    wav.add_argument("output")
+    wav.add_argument("--duration", type=float, default=1.0, help="how many seconds long it is")
+    wav.add_argument("--framerate", type=int, default=44100, help="the sample rate")
+    wav.add_argument("--channels", type=int, default=2)
+    wav.add_argument("--sampwidth", type=int, default=2, choices=(1, 2, 3, 4), help="bytes per sample")
+    wav.add_argument("--frequency", type=float, default=440.0, help="the fundamental frequency in Hz")
+    wav.add_argument("--seed", type=int, default=0)
+
+    corpus = commands.add_parser("corpus", help="write a file for each preset into a directory")
+    corpus.add_argument("directory")
+    corpus.add_argument("--preset", action="append", choices=sorted(PRESETS),
+                        help="only write this preset (can be given more than once)")
+    corpus.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args(argv)
+    if args.command == "midi":
+        notes = write_midi(args.output, args.duration, args.density, args.polyphony, args.channels, args.pitch,
+                           args.spread, min_length=args.min_length, max_length=args.max_length,
+                           program_changes=args.program_changes, percussion=args.percussion, seed=args.seed)
+        print("Wrote {} notes to '{}'.".format(notes, args.output))
+    elif args.command == "wav":
+        write_sample(args.output, args.duration, args.framerate, args.channels, args.sampwidth,
+                     args.frequency, seed=args.seed)
+        print("Wrote '{}'.".format(args.output))
+    else:
+        for name, path in write_corpus(args.directory, args.preset or sorted(PRESETS), args.seed).items():
+            print("Wrote the {} preset to '{}'.".format(name, path))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,343 @@
 #!/usr/local/bin/python
-import swood.sample, swood.soundfont, swood.render, swood.midiparse
+"""Times each part of swood that matters for speed, and compares the times to a saved baseline.
+
+    python swoodmark.py --save baseline.json       # on the old version
+    python swoodmark.py --compare baseline.json    # on the new version
+
+Each benchmark is run a few times to warm up, then timed in repeat runs of
+enough calls to take at least --min-time seconds. The median of those runs
+is the result, and the quartiles show how noisy it was. A benchmark only
+counts as a regression when its median is more than --threshold slower than
+the baseline and the runs don't overlap (its first quartile is slower than
+the baseline's third), so noise on a busy machine isn't flagged.
+"""
 from time import perf_counter
+import tempfile
+import argparse
+import platform
+import json
+import sys
+import gc
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+import swood.sample, swood.soundfont, swood.render, swood.midiparse, swood.wavout, swood.resample
+import numpy
+
+import stresscorpus
 
 ascii_art = "                                 .___                    __    \n  ________  _  ______   ____   __| _/_____ _____ _______|  | __\n /  ___/\\ \\/ \\/ /  _ \\ /  _ \\ / __ |/     \\\\__  \\\\_  __ \\  |/ /\n \\___ \\  \\     (  <_> |  <_> ) /_/ |  Y Y  \\/ __ \\|  | \\/    < \n/____  >  \\/\\_/ \\____/ \\____/\\____ |__|_|  (____  /__|  |__|_ \\\n     \\/                           \\/     \\/     \\/           \\/\n"
 
-print(ascii_art)
-
-print("Loading sample... ", end="")
-start=perf_counter()
-sample = swood.sample.Sample("samples/doot.wav")
-print("Done in {}s".format(round(perf_counter() - start, 2)))
-
-soundfont = swood.soundfont.DefaultFont(sample)
-renderer = swood.render.NoteRenderer(soundfont, True)
-
-print("Rendering MIDI scale... ", end="")
-elapsed = 0
-for notenum in range(36, 97):
-    note = swood.midiparse.Note(pitch=notenum, instrument=soundfont.instruments[1][0])
-    note.finalize(0)  # since it's in fullclip mode, note length doesn't matter
-    start=perf_counter()
-    renderer.render_note(note)
-    elapsed += (perf_counter() - start)
-print("Done in {}s (avg. {}s/note)".format(round(elapsed, 2), round(elapsed/60, 2)))
+BASELINE_VERSION = 1
+
+
+class Skip(Exception):
+    """Raised by a benchmark that can't run here (like memory-mapping on some systems)."""
+
+
+def percentile(values, fraction):
+    """Interpolate a percentile of a sorted list."""
+    pos = (len(values) - 1) * fraction
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def measure(func, setup=None, teardown=None, repeat=7, min_time=0.1, warmup=1):
+    """Time func, returning the seconds per call of each run (sorted) and how many calls each run made.
+
+    Without a setup, each run calls func as many times as it takes to fill
+    min_time. With one, each run is a single call (with setup's return value,
+    which is passed to teardown afterwards) outside of the timing, and there
+    are more runs until they add up to min_time.
+    """
+    def call_once():
+        state = setup()
+        try:
+            start = perf_counter()
+            func(state)
+            return perf_counter() - start
+        finally:
+            if teardown is not None:
+                teardown(state)
+
+    def call_loops(loops):
+        start = perf_counter()
+        for _ in range(loops):
+            func()
+        return perf_counter() - start
+
+    loops = 1
+    for _ in range(warmup):
+        call_loops(1) if setup is None else call_once()
+    if setup is None:
+        # double the calls per run until a run is long enough to time accurately
+        while call_loops(loops) < min_time and loops < 1 << 20:
+            loops *= 2
+
+    times = []
+    # like timeit, keep the garbage collector from landing in one run but not another
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        while len(times) < repeat or (setup is not None and sum(times) < min_time and len(times) < 1000):
+            if setup is None:
+                times.append(call_loops(loops) / loops)
+            else:
+                times.append(call_once())
+    finally:
+        if collecting:
+            gc.enable()
+    return sorted(times), loops
+
+
+def summarize(times, loops):
+    return {
+        "median": percentile(times, 0.5),
+        "q1": percentile(times, 0.25),
+        "q3": percentile(times, 0.75),
+        "min": times[0],
+        "runs": len(times),
+        "loops": loops,
+    }
+
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds * scale >= 1:
+            return "{:.3g} {}".format(seconds * scale, unit)
+    return "{:.3g} ns".format(seconds * 1e9)
+
+
+class Benchmarks:
+    """Every benchmark, set up around one sample and one MIDI."""
+
+    def __init__(self, sample_path, midi_path, tempdir, huge_notes):
+        self.sample_path = sample_path
+        self.midi_path = midi_path
+        self.tempdir = tempdir
+        self.huge_notes = huge_notes
+
+        self.sample = swood.sample.Sample(sample_path, pbar=False)
+        with open(sample_path, "rb") as f:
+            # the raw PCM after the (usually) 44 byte header
+            f.seek(swood.sample.data_offset(sample_path))
+            self.raw = f.read()
+        self.font = swood.soundfont.DefaultFont(self.sample)
+        self.instrument = self.font.instruments[1][0]
+        self.renderer = swood.render.NoteRenderer(self.font)
+        # an octave down, a fifth up, and an octave and a half up
+        self.multipliers = (2.0, 2 / 3, 0.35)
+        self.scaled = self.sample.scaled
+        self.sample.fundamental_freq
+
+        # notes to mix into each backend: 256 notes of a few pitches a tenth of a second apart
+        notes = []
+        for notenum in (48, 55, 60, 64, 67, 72):
+            note = swood.midiparse.Note(pitch=notenum, instrument=self.instrument)
+            note.finalize(self.sample.framerate // 4)
+            notes.append(self.renderer.render_note(note))
+        step = self.sample.framerate // 10
+        self.voices = [(idx * step, notes[idx % len(notes)]) for idx in range(256)]
+        self.output_length = self.voices[-1][0] + max(data.shape[1] for data, cutoffs in notes)
+
+        # generated inputs that are far bigger than the fixtures
+        self.huge_midi = os.path.join(tempdir, "huge.mid")
+        stresscorpus.write_midi(self.huge_midi, duration=huge_notes / 1000, density=1000, polyphony=16)
+        self.busy_midi = os.path.join(tempdir, "busy.mid")
+        stresscorpus.write_midi(self.busy_midi, duration=80, density=50, polyphony=8)
+        self.programs_midi = os.path.join(tempdir, "programs.mid")
+        stresscorpus.write_midi(self.programs_midi, duration=60, density=200, program_changes=16)
+        self.hires_path = os.path.join(tempdir, "hires.wav")
+        stresscorpus.write_sample(self.hires_path, duration=5, framerate=96000, channels=6, sampwidth=3)
+        self.hires = swood.sample.Sample(self.hires_path, pbar=False)
+
+    def all(self):
+        """Yield (name, kwargs for measure()) for every benchmark."""
+        sample = self.sample
+        yield "parse_wav", {"func": lambda: sample.parse_wav(self.sample_path)}
+        yield "parse_wav (96 kHz, 6 channels, 24-bit)", {"func": lambda: self.hires.parse_wav(self.hires_path)}
+        yield "parse_raw", {"func": lambda: sample.parse_raw(self.raw, sample.sampwidth, sample.framerate,
+                                                             sample.channels)}
+        yield "Sample.fft", {"func": lambda: sample.average_spectrum(sample.binsize)}
+        for resampler in ("linear", "cubic", "sinc"):
+            renderer = swood.render.NoteRenderer(self.font, resampler=resampler)
+            yield "zoom/" + resampler, {
+                "func": lambda renderer=renderer: [renderer.zoom(self.scaled, m) for m in self.multipliers]}
+        # zoom() uses Pillow, and the NumPy resampler is only kept as a fallback; this shows it's worth it
+        for resampler in ("linear", "cubic", "sinc"):
+            for name, func in (("Pillow", swood.resample.pillow_resample), ("NumPy", swood.resample.convolve)):
+                yield "resample/{} ({})".format(resampler, name), {
+                    "func": lambda func=func, resampler=resampler: [
+                        func(self.scaled, int(round(self.scaled.shape[1] * m)), resampler)
+                        for m in self.multipliers]}
+        scaled = self.renderer.zoom(self.scaled, 1.0)
+        renderer = self.renderer
+        yield "cutoff search", {"func": lambda: swood.render.cut(
+            scaled, scaled.shape[1] // 4, sample.channels, renderer.threshold, renderer.distance_multiplier)}
+
+        for name, make in self.backends():
+            yield "add_data/" + name, {"func": self.add_voices, "setup": make, "teardown": self.discard}
+
+        yield "MIDIParser/small", {"func": lambda: swood.midiparse.MIDIParser(self.midi_path, self.font)}
+        yield "MIDIParser/huge ({} notes)".format(self.huge_notes), {
+            "func": lambda: swood.midiparse.MIDIParser(self.huge_midi, self.font)}
+        yield "MIDIParser/program changes", {
+            "func": lambda: swood.midiparse.MIDIParser(self.programs_midi, self.font)}
+
+        midi = swood.midiparse.MIDIParser(self.midi_path, self.font)
+        output = os.path.join(self.tempdir, "render.wav")
+        yield "render (cold cache)", {
+            "func": lambda renderer: renderer.render(midi, output),
+            "setup": lambda: swood.render.NoteRenderer(self.font)}
+        # the workers only pay off on MIDIs with enough notes (see parallel.MIN_PARALLEL_NOTES)
+        busy = swood.midiparse.MIDIParser(self.busy_midi, self.font)
+        yield "render ({} notes)".format(busy.notecount), {
+            "func": lambda renderer: renderer.render(busy, output),
+            "setup": lambda: swood.render.NoteRenderer(self.font)}
+        for jobs in sorted({2, os.cpu_count() or 1} - {1}):
+            for name, notes in (("cold cache", midi), ("{} notes".format(busy.notecount), busy)):
+                yield "render ({}, {} jobs)".format(name, jobs), {
+                    "func": lambda renderer, notes=notes, jobs=jobs: renderer.render(notes, output, jobs=jobs),
+                    "setup": lambda: swood.render.NoteRenderer(self.font)}
+        warm = swood.render.NoteRenderer(self.font)
+        yield "render (warm cache)", {"func": lambda: warm.render(midi, output, clear_cache=False)}
+        yield "render (fullclip)", {
+            "func": lambda renderer: renderer.render(midi, output),
+            "setup": lambda: swood.render.NoteRenderer(self.font, fullclip=True)}
+
+    def backends(self):
+        """Yield (name, a function making a fresh output) for each wavout backend."""
+        wavout = swood.wavout
+        length = self.output_length
+        framerate = self.sample.framerate
+        channels = self.sample.channels
+        path = os.path.join(self.tempdir, "backend.wav")
+        yield "uncached", lambda: wavout.UncachedWavFile(length, path, framerate, channels)
+        yield "uncached (4 threads)", lambda: wavout.UncachedWavFile(length, path, framerate, channels, threads=4)
+        yield "memmap", lambda: self.memmap(length, path, framerate, channels)
+        yield "chunked", lambda: wavout.ChunkedWavFile(length, path, framerate, channels)
+        yield "chunked (gain)", lambda: wavout.ChunkedWavFile(length, path, framerate, channels, gain=1.0)
+        yield "streaming", lambda: wavout.StreamingWavFile(length, path, framerate, channels)
+        yield "blockstream", lambda: wavout.BlockStream(length, framerate, channels, gain=1.0)
+        yield "segment", lambda: wavout.SegmentWavFile(length // 4, length // 2, framerate, channels)
+
+    def memmap(self, *args):
+        try:
+            return swood.wavout.MemMapWavFile(*args)
+        except Exception as e:
+            raise Skip("can't memory-map the output here ({})".format(e))
+
+    def add_voices(self, output):
+        for start, (data, cutoffs) in self.voices:
+            output.add_voice(start, data, cutoffs, 0.5)
+        output.mix_pending()
+
+    def discard(self, output):
+        # saving isn't part of the benchmark, but it closes the file (segments don't have one)
+        if not isinstance(output, swood.wavout.SegmentWavFile):
+            output.save()
+
+
+def compare(results, baseline, threshold):
+    """Print how each result changed from the baseline, returning the names of the regressions."""
+    regressions = []
+    print("\nCompared to the baseline (a regression is over {:.0%} slower):".format(threshold))
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print("  {:<40} new".format(name))
+            continue
+        ratio = result["median"] / old["median"]
+        if ratio > 1 + threshold and result["q1"] > old["q3"]:
+            verdict = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold) and result["q3"] < old["q1"]:
+            verdict = "faster"
+        else:
+            verdict = "same"
+        print("  {:<40} {:>10} -> {:>10}  {:>6.2f}x  {}".format(
+            name, format_time(old["median"]), format_time(result["median"]), ratio, verdict))
+    if baseline.get("machine") != machine_info():
+        print("Warning: the baseline was saved on a different machine or Python, so the times may not be comparable.",
+              file=sys.stderr)
+    return regressions
+
+
+def machine_info():
+    return {
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main(argv=sys.argv[1:]):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="benchmark swood and compare against a baseline")
+    parser.add_argument("--sample", default=os.path.join(here, "samples", "doot.wav"),
+                        help="the WAV sample to benchmark with")
+    parser.add_argument("--midi", default=os.path.join(here, "midis", "beethoven.mid"),
+                        help="the (small) MIDI to parse and render")
+    parser.add_argument("--huge-notes", type=int, default=200000, metavar="N",
+                        help="how many notes the generated huge MIDI has")
+    parser.add_argument("--only", default=None, metavar="TEXT",
+                        help="only run the benchmarks with TEXT in their names")
+    parser.add_argument("--repeat", type=int, default=7, metavar="N",
+                        help="how many timed runs each benchmark gets")
+    parser.add_argument("--min-time", type=float, default=0.1, metavar="SECONDS",
+                        help="how long each run should take at least")
+    parser.add_argument("--save", default=None, metavar="FILE",
+                        help="save the results as a baseline")
+    parser.add_argument("--compare", default=None, metavar="FILE",
+                        help="compare the results to a saved baseline, exiting with 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="how much slower than the baseline counts as a regression (0.1 is 10%%)")
+    args = parser.parse_args(argv)
+
+    print(ascii_art)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("version") != BASELINE_VERSION:
+            parser.error("the baseline is from a different version of swoodmark")
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="swoodmark-") as tempdir:
+        print("Setting up... ", end="", flush=True)
+        start = perf_counter()
+        benchmarks = Benchmarks(args.sample, args.midi, tempdir, args.huge_notes)
+        print("Done in {}s".format(round(perf_counter() - start, 2)))
+
+        for name, kwargs in benchmarks.all():
+            if args.only is not None and args.only not in name:
+                continue
+            print("  {:<40} ".format(name), end="", flush=True)
+            try:
+                times, loops = measure(repeat=args.repeat, min_time=args.min_time, **kwargs)
+            except Skip as e:
+                print("skipped: {}".format(e))
+                continue
+            result = results[name] = summarize(times, loops)
+            print("{:>10}  (IQR {} to {}, {} runs)".format(
+                format_time(result["median"]), format_time(result["q1"]),
+                format_time(result["q3"]), result["runs"]))
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump({"version": BASELINE_VERSION, "machine": machine_info(), "results": results}, f, indent=2)
+        print("Saved the results to '{}'.".format(args.save))
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+import swood.render
+import numpy
+
+
+def loop_cutoffs(note_ending, distance_multiplier):
+    # the per-sample loop cut() used before find_cutoffs
+    cutoffs = numpy.zeros(note_ending.shape[0], dtype=numpy.int32)
+    cutoff_scores = numpy.full(note_ending.shape[0], 2**63 - 1, dtype=numpy.int64)
+    for channel, audio in enumerate(note_ending):
+        for distance, val in enumerate(audio):
+            score = abs(val) + (distance * distance_multiplier)
+            if score < cutoff_scores[channel]:
+                cutoff_scores[channel] = score
+                cutoffs[channel] = distance
+    return cutoffs
+
+
+def loop_cut(scaled, length, channels, threshold, distance_multiplier):
+    # cut() with the old loop in place of find_cutoffs
+    if scaled.shape[1] > length:
+        note_ending = scaled[:, length:length + threshold]
+    else:
+        distance_multiplier = -distance_multiplier
+        start = min(0, length - threshold)
+        note_ending = scaled[start:]
+    cutoffs = numpy.zeros(channels, dtype=numpy.int32)
+    cutoffs[:note_ending.shape[0]] = loop_cutoffs(note_ending, distance_multiplier)
+    cutoffs += length
+    return cutoffs
+
+
+def check(note_ending, distance_multiplier):
+    expected = loop_cutoffs(note_ending, distance_multiplier)
+    found = swood.render.find_cutoffs(note_ending, distance_multiplier)
+    assert numpy.array_equal(found, expected), (note_ending, distance_multiplier, found, expected)
+
+
+def test_random_windows():
+    rand = numpy.random.RandomState(0)
+    threshold = 33
+    multiplier = (2**32 - 1) / threshold * 0.5
+    for _ in range(200):
+        channels = rand.randint(1, 4)
+        length = rand.randint(1, 80)
+        scale = 2 ** rand.randint(1, 32)
+        ending = rand.randint(-scale // 2, scale // 2, size=(channels, length), dtype=numpy.int64)
+        ending = ending.astype(numpy.int32)
+        for distance_multiplier in (multiplier, -multiplier, 0.0, 1.0, -1.0, 0.3, -0.3, 1e-9, 2.5e8):
+            check(ending, distance_multiplier)
+
+
+def test_ties():
+    rand = random.Random(1)
+    for _ in range(300):
+        length = rand.randint(1, 12)
+        # a handful of values, so lots of samples score the same
+        values = [rand.choice((0, 1, -1, 2, -2, 3)) for _ in range(length)]
+        ending = numpy.array([values, values[::-1]], dtype=numpy.int32)
+        for distance_multiplier in (0.0, 1.0, -1.0, 0.5, -0.5, 0.25, -0.75, -1.5, 2.0):
+            check(ending, distance_multiplier)
+    # every sample the same
+    for distance_multiplier in (0.0, -0.5, -1.0, 0.5):
+        check(numpy.zeros((2, 9), dtype=numpy.int32), distance_multiplier)
+        check(numpy.full((2, 9), -7, dtype=numpy.int32), distance_multiplier)
+
+
+def test_extremes():
+    loudest = numpy.array([[2**31 - 1, -2**31, 2**31 - 1],
+                           [-2**31, -2**31, -2**31]], dtype=numpy.int32)
+    # abs(-2**31) overflows back to -2**31 in int32, in both the loop and find_cutoffs
+    with numpy.errstate(over="ignore"):
+        for distance_multiplier in (0.0, 1.0, -1.0, 2**31 * 1.0, -2**31 * 1.0):
+            check(loudest, distance_multiplier)
+    # windows with one sample or none at all
+    for distance_multiplier in (1.0, -1.0):
+        check(numpy.array([[5], [-5]], dtype=numpy.int32), distance_multiplier)
+        check(numpy.zeros((2, 0), dtype=numpy.int32), distance_multiplier)
+
+
+def test_cut_edges():
+    rand = numpy.random.RandomState(2)
+    threshold = 16
+    multiplier = (2**32 - 1) / threshold * 0.5
+    for scaled_length in (0, 1, 15, 16, 17, 40):
+        scaled = rand.randint(-2**20, 2**20, size=(2, scaled_length)).astype(numpy.int32)
+        # notes that end well inside the clip, with the window running off its end,
+        # exactly at the end and past it
+        for length in range(0, scaled_length + threshold + 2):
+            for channels in (2, 3):
+                expected = loop_cut(scaled, length, channels, threshold, multiplier)
+                found = swood.render.cut(scaled, length, channels, threshold, multiplier)
+                assert numpy.array_equal(found, expected), (scaled_length, length, channels)
+
+
+if __name__ == "__main__":
+    print("~~~~~~~~~~ Testing cutoff search ~~~~~~~~~~")
+    start = time.perf_counter()
+    test_random_windows()
+    test_ties()
+    test_extremes()
+    test_cut_edges()
+    print("Finished cutoff search in {} seconds.".format(
+        round(time.perf_counter() - start, 2)))
@@ -0,0 +1,86 @@
+import tempfile
+import random
+import wave
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+import swood.sample
+import numpy
+
+
+def loop_decode(buf, sampwidth, channels):
+    # the per-frame loop Sample.parse_raw used before decode_pcm
+    framesize = channels * sampwidth
+    length = len(buf) // framesize
+    wav = numpy.zeros((channels, length), dtype=swood.sample.pcm_dtype(sampwidth))
+    for i in range(length):
+        frame = buf[framesize * i:framesize * (i + 1)]
+        for chan in range(channels):
+            wav[chan][i] = int.from_bytes(
+                frame[sampwidth * chan:sampwidth * (chan + 1)], byteorder="little", signed=True)
+    return wav
+
+
+def reference(buf, sampwidth, channels):
+    if sampwidth == 1:
+        # the loop read 8-bit WAV data as signed, but it's unsigned with 128 as silence
+        buf = bytes(byte ^ 0x80 for byte in buf)
+    return loop_decode(buf, sampwidth, channels)
+
+
+def test_decode_pcm():
+    rand = random.Random(1)
+    for sampwidth in (1, 2, 3, 4):
+        for channels in (1, 2, 3):
+            for frames in (0, 1, 7, 500):
+                framesize = sampwidth * channels
+                # a partial frame on the end gets ignored
+                extra = rand.randrange(framesize)
+                buf = bytes(rand.randrange(256) for _ in range(frames * framesize + extra))
+                decoded = swood.sample.decode_pcm(buf, sampwidth, channels)
+                expected = reference(buf, sampwidth, channels)
+                assert decoded.shape == (channels, frames), (sampwidth, channels, frames)
+                assert decoded.dtype == expected.dtype, (sampwidth, channels, frames)
+                assert numpy.array_equal(decoded, expected), (sampwidth, channels, frames)
+
+
+def test_extremes():
+    # the loudest and quietest values, where sign extension and recentering go wrong
+    for sampwidth, values in ((1, (0, 1, 127, 128, 255)),
+                              (2, (0, 1, -1, 32767, -32768)),
+                              (3, (0, 1, -1, 2 ** 23 - 1, -2 ** 23)),
+                              (4, (0, 1, -1, 2 ** 31 - 1, -2 ** 31))):
+        if sampwidth == 1:
+            buf = bytes(values)
+            expected = [value - 128 for value in values]
+        else:
+            buf = b"".join(value.to_bytes(sampwidth, "little", signed=True) for value in values)
+            expected = list(values)
+        assert swood.sample.decode_pcm(buf, sampwidth, 1)[0].tolist() == expected, sampwidth
+        assert numpy.array_equal(swood.sample.decode_pcm(buf, sampwidth, 1), reference(buf, sampwidth, 1))
+
+
+def test_parse_wav():
+    rand = random.Random(2)
+    with tempfile.TemporaryDirectory(prefix="swood-") as tempdir:
+        for sampwidth in (1, 2, 3, 4):
+            path = os.path.join(tempdir, "{}.wav".format(sampwidth))
+            frames = bytes(rand.randrange(256) for _ in range(300 * sampwidth * 2))
+            with wave.open(path, "wb") as wav:
+                wav.setparams((2, sampwidth, 44100, 300, "NONE", "not compressed"))
+                wav.writeframes(frames)
+            for memmap in (False, True):
+                sample = swood.sample.Sample(path, pbar=False, memmap=memmap)
+                assert numpy.array_equal(sample.wav, reference(frames, sampwidth, 2)), (sampwidth, memmap)
+
+
+if __name__ == "__main__":
+    print("~~~~~~~~~~ Testing PCM decoding ~~~~~~~~~~")
+    start = time.perf_counter()
+    test_decode_pcm()
+    test_extremes()
+    test_parse_wav()
+    print("Finished PCM decoding in {} seconds.".format(
+        round(time.perf_counter() - start, 2)))
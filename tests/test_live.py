@@ -0,0 +1,60 @@
+import tempfile
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+import swood.sample, swood.soundfont, swood.midiparse, swood.render, swood.live
+import numpy
+import mido
+
+import stresscorpus
+
+# notes are added up in a different order live, so the float32 mix can round
+# differently by a step, which at full scale is this many int32 LSBs
+TOLERANCE = int(numpy.spacing(numpy.float32(2 ** 31)))
+
+
+def test_scripted_input():
+    with tempfile.TemporaryDirectory(prefix="swood-") as tempdir:
+        sample_path = os.path.join(tempdir, "sample.wav")
+        midi_path = os.path.join(tempdir, "notes.mid")
+        stresscorpus.write_sample(sample_path, duration=0.5)
+        stresscorpus.write_midi(midi_path, duration=6, density=30, polyphony=4, spread=12)
+        font = swood.soundfont.DefaultFont(swood.sample.Sample(sample_path, pbar=False))
+
+        for fullclip in (False, True):
+            for block_frames in (512, 1000):
+                renderer = swood.render.NoteRenderer(font, fullclip)
+                output_path = os.path.join(tempdir, "live.raw")
+                engine = swood.live.LiveEngine(renderer, swood.midiparse.LiveMIDIParser(font),
+                                               swood.live.ScriptedInput(mido.MidiFile(midi_path)), output_path,
+                                               block_frames=block_frames)
+                assert not engine.realtime
+                engine.prewarm()
+                engine.run()
+                stats = engine.stats
+                assert stats["underruns"] == 0, stats
+                with open(output_path, "rb") as f:
+                    live = numpy.frombuffer(f.read(), dtype=numpy.int32).reshape(-1, font.channels).T
+
+                midi = swood.midiparse.MIDIParser(midi_path, font)
+                renderer = swood.render.NoteRenderer(font, fullclip)
+                expected = numpy.concatenate(list(renderer.render_iter(midi, block_frames, gain=engine.gain)), axis=1)
+                length = renderer.output_length(midi)
+                assert expected.shape[1] == length
+                # the live output is padded out to whole blocks
+                assert length <= live.shape[1] < length + 2 * block_frames, (live.shape, length)
+                assert stats["blocks"] * block_frames == live.shape[1]
+                assert not live[:, length:].any()
+                diff = numpy.abs(live[:, :length].astype(numpy.int64) - expected).max()
+                assert diff <= TOLERANCE, (fullclip, block_frames, diff)
+                assert numpy.abs(expected).max() > 1000 * TOLERANCE
+
+
+if __name__ == "__main__":
+    print("~~~~~~~~~~ Testing live rendering ~~~~~~~~~~")
+    start = time.perf_counter()
+    test_scripted_input()
+    print("Finished live rendering in {} seconds.".format(
+        round(time.perf_counter() - start, 2)))
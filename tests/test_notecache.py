@@ -0,0 +1,180 @@
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+from swood.notecache import NoteCache
+from swood.render import CachedNote
+import numpy
+
+PITCH_BYTES = 1000
+
+
+def pitch_data():
+    return numpy.zeros((1, PITCH_BYTES), dtype=numpy.int8)
+
+
+def note(length=10):
+    return CachedNote(length, None, numpy.zeros(2, dtype=numpy.int32))
+
+
+def check_budget(cache):
+    assert cache.bytes <= cache.max_bytes, cache.stats
+    assert cache.stats["bytes"] == cache.bytes
+    # everything that's left adds up to what the cache thinks it holds
+    entries = list(cache._entries.values()) + list(cache._pinned.values())
+    assert cache.bytes == sum(entry.nbytes for entry in entries)
+
+
+def test_budget():
+    cache = NoteCache(max_bytes=3 * PITCH_BYTES + 100)
+    for pitch in "abc":
+        cache.put_pitch(pitch, pitch_data())
+        check_budget(cache)
+    assert cache.pitches == 3 and cache.evictions == 0
+    cache.put_pitch("d", pitch_data())
+    check_budget(cache)
+    # the least recently used pitch goes first
+    assert "a" not in cache and all(pitch in cache for pitch in "bcd")
+    assert cache.evictions == 1
+
+    # looking a pitch up makes it the most recently used
+    assert cache.get_pitch("b") is not None
+    cache.put_pitch("e", pitch_data())
+    check_budget(cache)
+    assert "c" not in cache and all(pitch in cache for pitch in "bde")
+
+    # notes count towards the budget too, and go with their pitch
+    cache.put_note("b", 10, note())
+    check_budget(cache)
+    assert len(cache) == 1
+    cache.put_pitch("f", pitch_data())
+    check_budget(cache)
+    assert "d" not in cache
+    cache.discard_note("b", 10)
+    check_budget(cache)
+    assert len(cache) == 0 and "b" in cache
+
+    # a pitch that can never fit isn't cached at all
+    cache.put_pitch("huge", numpy.zeros((1, 4 * PITCH_BYTES), dtype=numpy.int8))
+    check_budget(cache)
+    assert "huge" not in cache and cache.pitches == 3
+
+
+def test_unbounded():
+    cache = NoteCache()
+    for pitch in range(50):
+        cache.put_pitch(pitch, pitch_data())
+    assert cache.pitches == 50 and cache.evictions == 0
+    assert cache.bytes == 50 * PITCH_BYTES
+
+
+def test_second_chance():
+    cache = NoteCache(max_bytes=3 * PITCH_BYTES + 100, reuse_threshold=3)
+    cache.put_pitch("a", pitch_data())
+    cache.put_note("a", 10, note())
+    assert cache.get_note("a", 10) is not None
+    assert cache.get_note("a", 10) is not None
+    assert cache._entries["a"].used == 3
+    cache.put_pitch("b", pitch_data())
+    cache.put_pitch("c", pitch_data())
+
+    # "a" is the least recently used, but it's been used enough to stay
+    cache.put_pitch("d", pitch_data())
+    check_budget(cache)
+    assert "a" in cache and "b" not in cache
+    # and its count was halved, so it has to earn its next second chance
+    assert cache._entries["a"].used == 1
+    cache.put_pitch("e", pitch_data())
+    check_budget(cache)
+    assert "c" not in cache
+    # the second chance moved "a" behind "d", which goes next
+    cache.put_pitch("f", pitch_data())
+    check_budget(cache)
+    assert "d" not in cache and "a" in cache
+    cache.put_pitch("g", pitch_data())
+    check_budget(cache)
+    assert "a" not in cache
+    assert cache.evictions == 4
+
+
+def test_pinned():
+    cache = NoteCache(max_bytes=2 * PITCH_BYTES + 100)
+    cache.put_pitch("bank1", pitch_data(), pinned=True)
+    cache.put_pitch("bank2", pitch_data(), pinned=True)
+    for pitch in "abc":
+        cache.put_pitch(pitch, pitch_data())
+        check_budget(cache)
+    # pinned pitches use up the budget, so there's no room for anything else
+    assert "bank1" in cache and "bank2" in cache
+    assert all(pitch not in cache for pitch in "abc")
+    assert cache.evictions == 3
+
+    # pinned pitches are kept even when they're over budget on their own
+    cache.put_pitch("bank3", pitch_data(), pinned=True)
+    assert cache.pitches == 3 and cache.bytes == 3 * PITCH_BYTES
+    cache.put_note("bank3", 10, note())
+    assert cache.get_note("bank3", 10) is not None
+    cache.discard("bank1")
+    cache.discard("bank2")
+    check_budget(cache)
+    cache.clear()
+    assert cache.pitches == 0 and cache.bytes == 0
+
+
+def test_belady():
+    cache = NoteCache(max_bytes=3 * PITCH_BYTES + 100)
+    cache.next_use = {"a": 10, "b": 2, "c": 5, "d": 1, "e": 3}
+    for pitch in "abc":
+        cache.put_pitch(pitch, pitch_data())
+    # "a" is needed furthest in the future, even though it's been used recently
+    cache.get_pitch("a")
+    cache.put_pitch("d", pitch_data())
+    check_budget(cache)
+    assert "a" not in cache and all(pitch in cache for pitch in "bcd")
+
+    # a pitch that's never needed again goes first
+    cache.put_pitch("unused", pitch_data())
+    cache.put_pitch("e", pitch_data())
+    check_budget(cache)
+    assert "unused" not in cache and "c" not in cache
+    assert all(pitch in cache for pitch in "bde")
+    assert cache.evictions == 3
+
+
+def test_stats():
+    cache = NoteCache(max_bytes=3 * PITCH_BYTES + 100)
+    stats = cache.stats
+    assert (stats["hits"], stats["misses"], stats["hit_ratio"]) == (0, 0, 0.0)
+    assert cache.get_note("a", 10) is None
+    cache.put_pitch("a", pitch_data())
+    assert cache.get_note("a", 10) is None
+    cache.put_note("a", 10, note())
+    cache.put_note("a", 20, note(20))
+    for _ in range(3):
+        assert cache.get_note("a", 10) is not None
+    assert cache.get_note("a", 20).used == 2
+    for pitch in "bcd":
+        cache.put_pitch(pitch, pitch_data())
+
+    stats = cache.stats
+    assert stats["hits"] == 4 and stats["misses"] == 2
+    assert stats["hit_ratio"] == 4 / 6
+    assert stats["evictions"] == 1
+    assert stats["pitches"] == 3
+    assert stats["entries"] == len(cache)
+    assert stats["max_bytes"] == cache.max_bytes
+    assert stats["bytes"] <= stats["max_bytes"]
+
+
+if __name__ == "__main__":
+    print("~~~~~~~~~~ Testing note cache ~~~~~~~~~~")
+    start = time.perf_counter()
+    test_budget()
+    test_unbounded()
+    test_second_chance()
+    test_pinned()
+    test_belady()
+    test_stats()
+    print("Finished note cache in {} seconds.".format(
+        round(time.perf_counter() - start, 2)))
@@ -0,0 +1,58 @@
+import tempfile
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+import swood.sample, swood.soundfont, swood.midiparse, swood.render, swood.parallel
+assert(os.path.realpath(swood.render.__file__) ==
+       os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "swood", "render.py")))
+import numpy
+
+import stresscorpus
+
+
+def test_jobs():
+    with tempfile.TemporaryDirectory(prefix="swood-") as tempdir:
+        sample_path = os.path.join(tempdir, "sample.wav")
+        midi_path = os.path.join(tempdir, "notes.mid")
+        stresscorpus.write_sample(sample_path, duration=0.5)
+        stresscorpus.write_midi(midi_path, duration=8, density=40, polyphony=4, spread=12)
+        font = swood.soundfont.DefaultFont(swood.sample.Sample(sample_path, pbar=False))
+        midi = swood.midiparse.MIDIParser(midi_path, font)
+
+        def render(jobs, mix_threads, filename=None, cache_mem=None):
+            renderer = swood.render.NoteRenderer(font, cache_mem=cache_mem)
+            savetype = swood.render.FileSaveType.SMART_CACHING if filename else swood.render.FileSaveType.ARRAY_IN_MEM
+            return renderer.render(midi, filename, savetype=savetype, jobs=jobs, mix_threads=mix_threads)
+
+        # the stretched pitches live in shared memory that's freed as the render goes
+        expected = render(1, 1)
+        for jobs, mix_threads in ((2, 1), (1, 2), (2, 2), (3, 4)):
+            assert numpy.array_equal(render(jobs, mix_threads), expected), (jobs, mix_threads)
+            # pitches get evicted (and their blocks freed) partway through
+            assert numpy.array_equal(render(jobs, mix_threads, cache_mem=300000), expected), (jobs, mix_threads)
+
+        render(1, 1, os.path.join(tempdir, "expected.wav"))
+        render(2, 2, os.path.join(tempdir, "parallel.wav"))
+        with open(os.path.join(tempdir, "expected.wav"), "rb") as a, \
+                open(os.path.join(tempdir, "parallel.wav"), "rb") as b:
+            assert a.read() == b.read()
+
+
+def test_useful_jobs():
+    few, many = swood.parallel.MIN_PARALLEL_NOTES - 1, swood.parallel.MIN_PARALLEL_NOTES
+    assert swood.parallel.useful_jobs(4, few) == 1
+    if (os.cpu_count() or 1) == 1:
+        assert swood.parallel.useful_jobs(4, many) == 1
+    else:
+        assert swood.parallel.useful_jobs(4, many) == 4
+
+
+if __name__ == "__main__":
+    print("~~~~~~~~~~ Testing --jobs with --mix-threads ~~~~~~~~~~")
+    start = time.perf_counter()
+    test_jobs()
+    test_useful_jobs()
+    print("Finished --jobs with --mix-threads in {} seconds.".format(
+        round(time.perf_counter() - start, 2)))
@@ -0,0 +1,94 @@
+import tempfile
+import argparse
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+import swood
+import swood.complain
+import swood.sample
+import stresscorpus
+import numpy
+
+# how close YIN has to get, in cents (it's usually within a few hundredths)
+YIN_TOLERANCE = 1.0
+
+
+def cents(found, expected):
+    return abs(1200 * numpy.log2(found / expected))
+
+
+def test_yin_period():
+    framerate = 44100
+    for frequency in (55.0, 110.0, 261.63, 440.0, 1000.0, 3520.0):
+        tone = numpy.sin(2 * numpy.pi * frequency * numpy.arange(4096) / framerate)
+        period = swood.sample.yin_period(tone, 2048, 2048)
+        assert cents(framerate / period, frequency) < YIN_TOLERANCE, (frequency, framerate / period)
+
+
+def test_yin_sample():
+    with tempfile.TemporaryDirectory(prefix="swood-") as tempdir:
+        for frequency, framerate, sampwidth in ((440.0, 44100, 2), (440.0, 48000, 3),
+                                                (196.0, 44100, 2), (1318.5, 96000, 4)):
+            path = os.path.join(tempdir, "{}.wav".format(frequency))
+            stresscorpus.write_sample(path, duration=1.0, framerate=framerate, sampwidth=sampwidth,
+                                      frequency=frequency)
+            yin = swood.sample.Sample(path, pbar=False, pitch_method="yin").fundamental_freq
+            assert cents(yin, frequency) < YIN_TOLERANCE, (frequency, yin)
+            # the FFT can only be as close as its bin spacing
+            fft_sample = swood.sample.Sample(path, pbar=False)
+            fft = fft_sample.fundamental_freq
+            assert abs(fft - frequency) <= fft_sample.fft.spacing, (frequency, fft)
+            assert abs(yin - frequency) < abs(fft - frequency), (frequency, yin, fft)
+
+
+def parse_font_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile")
+    swood.add_font_arguments(parser)
+    swood.add_common_arguments(parser, "test")
+    return parser, parser.parse_args(argv)
+
+
+def font_sample(font):
+    return next(iter(font.instruments.values()))[0].sample
+
+
+def test_pitch_method_switch():
+    with tempfile.TemporaryDirectory(prefix="swood-") as tempdir:
+        path = os.path.join(tempdir, "tone.wav")
+        stresscorpus.write_sample(path, duration=1.0)
+
+        parser, args = parse_font_args([path, "-p"])
+        assert args.pitch_method == "fft"
+        sample = font_sample(swood.load_font(args, parser))
+        assert sample.pitch_method == "fft"
+        fft = sample.fundamental_freq
+        # the FFT was used, not YIN
+        assert sample._fft is not None
+
+        parser, args = parse_font_args([path, "-p", "--pitch-method", "yin"])
+        sample = font_sample(swood.load_font(args, parser))
+        assert sample.pitch_method == "yin"
+        yin = sample.fundamental_freq
+        assert sample._fft is None
+        assert yin != fft
+        assert cents(yin, 440.0) < YIN_TOLERANCE
+
+        try:
+            swood.sample.Sample(path, pbar=False, pitch_method="guess")
+        except swood.complain.ComplainToUser:
+            pass
+        else:
+            raise AssertionError("Sample took an unknown pitch method")
+
+
+if __name__ == "__main__":
+    print("~~~~~~~~~~ Testing pitch detection ~~~~~~~~~~")
+    start = time.perf_counter()
+    test_yin_period()
+    test_yin_sample()
+    test_pitch_method_switch()
+    print("Finished pitch detection in {} seconds.".format(
+        round(time.perf_counter() - start, 2)))
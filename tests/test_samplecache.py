@@ -0,0 +1,128 @@
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
+import swood.samplecache
+import swood.sample
+import stresscorpus
+import numpy
+
+
+def entry_names(directory):
+    return sorted(os.listdir(directory))
+
+
+def test_content_hit():
+    with tempfile.TemporaryDirectory(prefix="swood-") as tempdir:
+        cache = swood.samplecache.SampleCache(os.path.join(tempdir, "cache"))
+        original = os.path.join(tempdir, "tone.wav")
+        stresscorpus.write_sample(original, duration=0.5)
+        first = swood.sample.Sample(original, pbar=False, cache=cache)
+        first.fundamental_freq
+
+        # a copy under another name has the same contents, so it's the same entry
+        copy = os.path.join(tempdir, "renamed.wav")
+        shutil.copyfile(original, copy)
+        assert cache.key(copy) == cache.key(original)
+        with open(copy, "rb") as f:
+            assert cache.key(f) == cache.key(original)
+            assert f.tell() == 0
+        assert cache.load(cache.key(copy)) is not None
+        assert cache.load_analysis(cache.key(copy), first.binsize) is not None
+
+        second = swood.sample.Sample(copy, pbar=False, cache=cache)
+        assert numpy.array_equal(second.wav, first.wav)
+        assert (second.sampwidth, second.framerate, second.max_amplitude) == \
+            (first.sampwidth, first.framerate, first.max_amplitude)
+        # the analysis came from the cache, so the FFT never ran
+        assert second._fft is not None
+        assert second.fundamental_freq == first.fundamental_freq
+
+        # a different file is a different entry
+        other = os.path.join(tempdir, "other.wav")
+        stresscorpus.write_sample(other, duration=0.5, frequency=220.0)
+        assert cache.key(other) != cache.key(original)
+        assert cache.load(cache.key(other)) is None
+
+
+def test_mmap_reload():
+    with tempfile.TemporaryDirectory(prefix="swood-") as tempdir:
+        cache = swood.samplecache.SampleCache(os.path.join(tempdir, "cache"))
+        wav = numpy.arange(-3000, 3000, dtype=numpy.int32).reshape(2, 3000)
+        cache.store("abc", wav, sampwidth=4, framerate=44100, max_amplitude=3000)
+        loaded, metadata = cache.load("abc")
+        assert isinstance(loaded, numpy.memmap)
+        assert not loaded.flags.writeable
+        assert numpy.array_equal(loaded, wav)
+        assert metadata == {"sampwidth": 4, "framerate": 44100, "max_amplitude": 3000}
+
+        # a sample loaded from the cache is mapped too
+        path = os.path.join(tempdir, "tone.wav")
+        stresscorpus.write_sample(path, duration=0.25)
+        swood.sample.Sample(path, pbar=False, cache=cache)
+        sample = swood.sample.Sample(path, pbar=False, cache=cache)
+        assert isinstance(sample.wav, numpy.memmap)
+
+
+def test_broken_entry():
+    with tempfile.TemporaryDirectory(prefix="swood-") as tempdir:
+        directory = os.path.join(tempdir, "cache")
+        cache = swood.samplecache.SampleCache(directory)
+        cache.store("abc", numpy.zeros((1, 100), dtype=numpy.int16), sampwidth=2)
+        cache.store_analysis("abc", 8192, numpy.zeros(10), spacing=1.0)
+        os.remove(os.path.join(directory, "abc.json"))
+        os.remove(os.path.join(directory, "abc-8192.fft.npy"))
+        # half an entry is a miss, and what's left of it gets deleted
+        assert cache.load("abc") is None
+        assert cache.load_analysis("abc", 8192) is None
+        assert entry_names(directory) == []
+
+
+def test_eviction():
+    with tempfile.TemporaryDirectory(prefix="swood-") as tempdir:
+        directory = os.path.join(tempdir, "cache")
+        wav = numpy.zeros((2, 10000), dtype=numpy.int32)
+        cache = swood.samplecache.SampleCache(directory, max_size=10 ** 9)
+        cache.store("probe", wav, sampwidth=4)
+        entry_size = sum(os.path.getsize(os.path.join(directory, name))
+                         for name in entry_names(directory))
+        os.remove(os.path.join(directory, "probe.npy"))
+        os.remove(os.path.join(directory, "probe.json"))
+
+        # room for three entries and a bit
+        cache = swood.samplecache.SampleCache(directory, max_size=entry_size * 3 + entry_size // 2)
+        keys = ["key{}".format(i) for i in range(6)]
+        for i, key in enumerate(keys):
+            cache.store(key, wav + i, sampwidth=4)
+            # mtimes are the LRU order, so make sure they differ on coarse clocks
+            stamp = time.time() - 100 + i
+            for name in (key + ".npy", key + ".json"):
+                os.utime(os.path.join(directory, name), (stamp, stamp))
+            if i == 2:
+                # using the first entry again makes it the most recently used
+                assert cache.load(keys[0]) is not None
+
+        names = entry_names(directory)
+        total = sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+        assert total <= cache.max_size
+        # whole entries are deleted, never just one of their files
+        stems = set(name.partition(".")[0] for name in names)
+        for stem in stems:
+            assert stem + ".npy" in names and stem + ".json" in names, names
+        assert not any(name.endswith(".tmp") for name in names)
+        assert stems == {keys[0], keys[4], keys[5]}, stems
+        assert numpy.array_equal(cache.load(keys[5])[0], wav + 5)
+
+
+if __name__ == "__main__":
+    print("~~~~~~~~~~ Testing sample cache ~~~~~~~~~~")
+    start = time.perf_counter()
+    test_content_hit()
+    test_mmap_reload()
+    test_broken_entry()
+    test_eviction()
+    print("Finished sample cache in {} seconds.".format(
+        round(time.perf_counter() - start, 2)))